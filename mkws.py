@@ -1,43 +1,165 @@
 #!/usr/bin/python3
 import whitespace as ws
+import os
+import shutil
 import sys
+import tempfile
+# ------------------------------ CONSTANTS
+CHUNK_SIZE = 65536  # characters of Whitespace written at a time
+SPOOL_SIZE = 1 << 24 # characters of Whitespace held in memory before they go to a temporary file
+
 # -------------------------------CLASSES
-class WhitespaceConverter(ws.WhitespaceVM):
+class WhitespaceConverter:
+    # Converts readable source into Whitespace, one line at a time, so that
+    # any amount of source can be converted in a bounded amount of memory.
+    # Every line holds an operation, followed by its argument when it takes
+    # one: a number, or a label made of S and T characters.  Blank lines are
+    # skipped, and # starts a comment.
+    #
+    # Rather than stopping at the first mistake, the converter carries on
+    # and collects (line number, message) pairs in self.errors.
+    #
+    # In compact mode labels can have any name, and assign_labels() gives
+    # them codes before anything is converted: the shortest codes go to the
+    # labels used most often.  Zero is then also written without any digits.
+
+    OPERATIONS = ws.WhitespaceVM.OPERATIONS
+    LABEL_OPS = ws.WhitespaceVM.LABEL_OPS
+    NUMBER_OPS = ws.WhitespaceVM.NUMBER_OPS
+
+    def __init__(self, compact=False):
+        self.errors = []        # (line number, message) for every bad line
+        self.compact = compact  # whether labels are names, to get the shortest codes
+        self.labels = {}        # in compact mode: name --> code (of S and T)
 
-    def __init__(self, nicecode):
-        super().__init__()
+    def error(self, lineno, message):
+        self.errors.append((lineno, f"SYNTAX ERROR : {message}"))
 
-        # read each line of the source and build the Whitespace code
-        for line in nicecode.split("\n"):
-            if line.strip() == "":
+    def tokens(self, lines):
+        # Yields the instruction on each of the lines, as a Token whose
+        # argument is given the way --describe shows it.
+        Token = ws.WhitespaceVM.Token
+        for lineno, line in enumerate(lines, 1):
+            line = line.partition("#")[0].strip() # drop comments
+            if line == "":
                 continue # skip blank lines
 
             (operation, sep, arg) = line.partition(" ")
             arg = arg.strip()
-            opchars = self.find_opchars(operation)
-            if opchars != "":
-                self.code += opchars
-                if operation in ("MARK", "CALL", "JUMP", "JUMPZERO", "JUMPNEG"):
-                    self.code += self.label_to_ws(arg)
-                elif operation in ("PUSH", "COPY", "SLIDE"):
-                    self.code += self.num_to_ws(arg)
+            if operation not in self.OPERATIONS:
+                self.error(lineno, f"BAD OPERATION : -{operation}-")
+            elif operation in self.LABEL_OPS:
+                if arg.strip("ST") and not self.compact:
+                    self.error(lineno, f"BAD LABEL : -{arg}-")
+                else:
+                    yield Token(operation, arg)
+            elif operation in self.NUMBER_OPS:
+                try:
+                    yield Token(operation, int(arg))
+                except ValueError:
+                    self.error(lineno, f"BAD NUMBER : -{arg}-")
             else:
-                exit(f"SYNTAX ERROR : BAD OPERATION : -{operation}-")
+                yield Token(operation)
+
+    def convert(self, lines):
+        # Yields the Whitespace code of each of the lines.
+        compact = self.compact
+        labels = self.labels
+        for token in self.tokens(lines):
+            code = self.OPERATIONS[token.op]
+            if token.op in self.LABEL_OPS:
+                code += self.label_to_ws(labels[token.arg] if compact else token.arg)
+            elif token.op in self.NUMBER_OPS:
+                if compact and token.arg == 0:
+                    code += ws.SPACE + ws.LF
+                else:
+                    code += self.num_to_ws(token.arg)
+            yield code
+
+    def write(self, lines, out):
+        # Writes the Whitespace code of the lines to the text stream out, in
+        # chunks of about CHUNK_SIZE characters.  Returns the number of
+        # characters written.
+        chunk = []
+        size = 0
+        total = 0
+        for code in self.convert(lines):
+            chunk.append(code)
+            size += len(code)
+            if size >= CHUNK_SIZE:
+                out.write("".join(chunk))
+                total += size
+                chunk = []
+                size = 0
+        out.write("".join(chunk))
+        return total + size
+
+    def assign_labels(self, lines):
+        # The first pass of compact mode: counts how often each label is used
+        # and gives the labels codes, from the shortest up, in order of use.
+        # Returns the number of characters the program would take without
+        # compacting: with every number written plainly, S and T labels kept
+        # as they are, and other labels numbered in the order they show up.
+        counts = {}
+        plain = {}
+        size = 0
+        for token in self.tokens(lines):
+            size += len(self.OPERATIONS[token.op])
+            if token.op in self.LABEL_OPS:
+                name = token.arg
+                counts[name] = counts.get(name, 0) + 1
+                if name not in plain:
+                    plain[name] = len(name) if not name.strip("ST") else max(1, len(plain).bit_length())
+                size += plain[name] + 1
+            elif token.op in self.NUMBER_OPS:
+                size += len(self.num_to_ws(token.arg))
+        codes = self.label_codes()
+        self.labels = {name: next(codes)
+                       for name in sorted(counts, key=counts.get, reverse=True)}
+        return size
 
-    def find_opchars(self, operation):
-        # Return the Whitespace characters repsenting the given operation.
-        # Return empty string if there is no such operation.
-        if operation in self.OPERATIONS: return self.OPERATIONS[operation]
-        else: return ""
+    def label_codes(self):
+        # Yields every label from the shortest up: S, T, SS, ST, TS, TT, SSS, ...
+        # (the empty label is legal, but not every interpreter takes it).
+        length = 1
+        while True:
+            for n in range(1 << length):
+                yield bin(n)[2:].zfill(length).replace("0", "S").replace("1", "T")
+            length += 1
 
-    def num_to_ws(self, numstr):
+    def program(self, lines):
+        # Returns the lines as a linked whitespace.Program, ready to run,
+        # without producing any Whitespace code.  Returns None if a line was
+        # bad, and raises a WhitespaceError if the program doesn't link.
+        vm = ws.WhitespaceVM()
+        vm.tokens = list(self.tokens(lines))
+        if self.errors:
+            return None
+        # the VM knows labels by id: S and T labels have their own, and in
+        # compact mode names get the ids of the labels from label_codes()
+        ids = {}
+        codes = self.label_codes()
+        for token in vm.tokens:
+            if token.op in self.LABEL_OPS:
+                if not self.compact:
+                    token.arg = ws.label_id(token.arg)
+                    continue
+                if token.arg not in ids:
+                    ids[token.arg] = ws.label_id(next(codes))
+                    vm.label_names[ids[token.arg]] = token.arg
+                token.arg = ids[token.arg]
+        vm.scan_labels()
+        vm.link()
+        return vm.program()
+
+    def num_to_ws(self, num):
         # Convert a number to its Whitespace representation.
         sign = ""
-        if int(numstr) < 0:
+        if num < 0:
             sign = ws.TAB
         else:
             sign = ws.SPACE
-        binstr = bin(abs(int(numstr)))[2:] # slicing off the initial '0b'
+        binstr = bin(abs(num))[2:] # slicing off the initial '0b'
         return sign + binstr.replace("0", ws.SPACE).replace("1", ws.TAB) + ws.LF
 
     def label_to_ws(self, label):
@@ -45,25 +167,47 @@ class WhitespaceConverter(ws.WhitespaceVM):
         # (S becomes space, T becomes tab, and it is terminated with a \n)
         return label.replace("S", ws.SPACE).replace("T", ws.TAB) + ws.LF
 
-    def output(self):
-        pass
 
+# -------------------------------FUNCTIONS
+def run_program(program, program_input):
+    # Runs a linked program the way whitespace.py does.
+    io = ws.WhitespaceIO(program_input, sys.stdout.buffer)
+    vm = ws.WhitespaceVM(io=io)
+    vm.use_program(program)
+    try:
+        vm.execute()
+    except ws.WhitespaceError as e:
+        exit(str(e))
+    finally:
+        io.flush()
+    if vm.ended:
+        exit("\nPROGRAM COMPLETED SUCCESSFULLY.")
 
 # -------------------------------MAIN PROGRAM
 def main():
     # Handle command arguments
     purpose_string = "mkws.py - convert an easy-to-read program into Whitespace code.\n"
     usage_string = (
-        "usage: mkws.py - | filename\n"
+        "usage: mkws.py [--run] [--compact] - | filename\n"
         "\n"
         "Options:\n"
         "  filename                An input file containing readable source code.\n"
         "  -                       Get the source code from STDIN (overrides filename)\n"
+        "  --run                   Runs the program instead of printing its Whitespace\n"
+        "                          code (the input comes from STDIN, or the terminal\n"
+        "                          when the source does)\n"
+        "  --compact               Lets labels have any name, gives the labels used most\n"
+        "                          the shortest codes and writes numbers as short as\n"
+        "                          possible, then reports the size saved (on STDERR).\n"
+        "                          This reads the source twice, so source from STDIN\n"
+        "                          is kept in memory.\n"
         "  --help                  Prints this help info\n"
         )
 
     filename = ""
     stdinarg = False
+    runarg = False
+    compactarg = False
     for arg in sys.argv[1:]:
         if arg == "--help":
             print(purpose_string)
@@ -71,6 +215,10 @@ def main():
             exit()
         elif arg == "-":
             stdinarg = True
+        elif arg == "--run":
+            runarg = True
+        elif arg == "--compact":
+            compactarg = True
         elif arg[0] == "-":
             print(f"{sys.argv[0]}: error: unknown option {arg}\n")
             print(usage_string)
@@ -83,20 +231,59 @@ def main():
             print(usage_string)
             exit()
 
-    # Get the source code
-    source_code = ""
+    # Open the source code
     if stdinarg:
-        source_code = sys.stdin.read()
+        source = sys.stdin
     else:
         try:
-            with open(filename) as f:
-                source_code = f.read()
+            source = open(filename)
         except IOError:
             exit(f"{sys.argv[0]}: error: Could not open file {filename}")
 
-    # Convert the source code to Whitespace
-    wsc = WhitespaceConverter(source_code)
-    print(wsc.code, end='')
+    # Convert the source code to Whitespace, or run it
+    def check(converter):
+        for lineno, message in converter.errors:
+            print(f"{'-' if stdinarg else filename}, line {lineno}: {message}", file=sys.stderr)
+        if converter.errors:
+            exit(f"{sys.argv[0]}: error: {len(converter.errors)} bad lines")
+
+    converter = WhitespaceConverter(compactarg)
+    with source:
+        if runarg:
+            try:
+                program = converter.program(source)
+            except ws.WhitespaceError as e:
+                exit(str(e))
+        elif compactarg:
+            lines = list(source) if stdinarg else source
+            before = converter.assign_labels(lines)
+            check(converter)
+            if not stdinarg:
+                source.seek(0)
+            after = converter.write(lines, sys.stdout)
+            print(f"{len(converter.labels)} labels, {before} bytes before, {after} bytes after "
+                  f"({100 * (before - after) / max(1, before):.1f}% smaller)", file=sys.stderr)
+        else:
+            # nothing is written until every line has converted, so a bad
+            # line doesn't leave half a program behind
+            with tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+") as spool:
+                converter.write(source, spool)
+                if not converter.errors:
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, sys.stdout, CHUNK_SIZE)
+    check(converter)
+
+    if runarg:
+        if stdinarg:
+            # The source code used up stdin, so read the input from the
+            # terminal (if there is one).
+            try:
+                program_input = open(os.ctermid(), "rb")
+            except OSError:
+                program_input = None
+        else:
+            program_input = sys.stdin.buffer
+        run_program(program, program_input)
 
 if __name__ == "__main__":
     main()
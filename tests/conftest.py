@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts aren't installed, so the tests import them from the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,147 @@
+from functools import partial
+from io import BytesIO
+
+import mkws
+import whitespace as ws
+
+# Random programs for the tests that compare one way of running a program
+# with another.  They're written in the readable source mkws.py takes,
+# with a few labels that are jumped to and called from anywhere, so they
+# run out of stack, divide by zero, return with no caller and loop for
+# ever about as often as they end.  Now and then one jumps to a label that
+# isn't marked.
+
+SIMPLE_OPS = ["DUPLICATE", "SWAP", "DISCARD", "ADD", "SUBTRACT", "MULTIPLY", "DIVIDE",
+              "MODULO", "STORE", "RETRIEVE", "OUTNUM", "OUTCH"]
+JUMP_OPS = ["JUMP", "JUMPZERO", "JUMPNEG"]
+LABELS = ["S", "T", "SS", "ST", "TS"]
+UNMARKED = "TT"
+INPUT = b"12\n3\n"
+STEP_LIMITS = (1, 2, 3, 50, 5000)
+
+def random_lines(rnd, size):
+    # Returns a random program of about size instructions, as lines.
+    lines = []
+    for _ in range(size):
+        r = rnd.random()
+        if r < 0.3:
+            lines.append(f"PUSH {rnd.randint(-5, 9)}")
+        elif r < 0.6:
+            lines.append(rnd.choice(SIMPLE_OPS))
+        elif r < 0.66:
+            lines.append(f"{rnd.choice(['COPY', 'SLIDE'])} {rnd.randint(0, 3)}")
+        elif r < 0.74:
+            lines.append(f"CALL {random_label(rnd)}")
+        elif r < 0.84:
+            lines.append(f"{rnd.choice(JUMP_OPS)} {random_label(rnd)}")
+        elif r < 0.9:
+            lines.append("RETURN")
+        elif r < 0.92:
+            lines.append("ENDPROGRAM")
+        elif r < 0.94:
+            lines.append(rnd.choice(["INCH", "INNUM"]))
+    for label in LABELS:
+        lines.insert(rnd.randint(0, len(lines)), f"MARK {label}")
+    return lines
+
+def random_label(rnd):
+    return UNMARKED if rnd.random() < 0.01 else rnd.choice(LABELS)
+
+def random_program(rnd, size):
+    # Returns a random program of about size instructions, as Whitespace.
+    return "".join(mkws.WhitespaceConverter().convert(random_lines(rnd, size)))
+
+def outcome(result):
+    # What a whitespace.Result shows of a run, to compare runs by.
+    return result.output, result.status, str(result.error), result.steps, result.ended
+
+def label(n):
+    # A label for the nth branch of a loop, unlike the labels above.
+    return "TT" + bin(n)[2:].replace("0", "S").replace("1", "T")
+
+def random_loop_lines(rnd, iterations, size):
+    # Returns a program that runs a random loop body iterations times, as
+    # lines: hot enough for the JIT to trace, with branches inside the loop
+    # for its guards, and calls of a pure subroutine for the memo.  The
+    # body works on a value kept in heap[1], and the count is in heap[0].
+    lines = ["PUSH 0", f"PUSH {iterations}", "STORE",
+             "PUSH 1", f"PUSH {rnd.randint(-9, 9)}", "STORE",
+             "MARK S", "PUSH 1", "PUSH 1", "RETRIEVE"]
+    for n in range(size):
+        r = rnd.random()
+        if r < 0.3:
+            lines += [f"PUSH {rnd.randint(-9, 9)}", rnd.choice(["ADD", "SUBTRACT"])]
+        elif r < 0.4:
+            lines += [f"PUSH {rnd.randint(-9, 9)}", "MULTIPLY", "PUSH 1000", "MODULO"]
+        elif r < 0.43:
+            lines += [f"PUSH {rnd.choice([-3, -2, 2, 3, 7])}", rnd.choice(["DIVIDE", "MODULO"])]
+        elif r < 0.45:
+            # divides by zero when the count gets down to some number
+            lines += ["PUSH 0", "RETRIEVE", f"PUSH {rnd.randint(0, iterations)}", "SUBTRACT",
+                      rnd.choice(["DIVIDE", "MODULO"])]
+        elif r < 0.55:
+            lines += ["DUPLICATE", "OUTNUM"]
+        elif r < 0.6:
+            lines += ["DUPLICATE", "PUSH 26", "MODULO", "PUSH 97", "ADD", "OUTCH"]
+        elif r < 0.8:
+            lines += ["CALL TS"]
+        else:
+            lines += ["DUPLICATE", f"{rnd.choice(['JUMPNEG', 'JUMPZERO'])} {label(2 * n)}",
+                      f"PUSH {rnd.randint(1, 9)}", "ADD", f"JUMP {label(2 * n + 1)}",
+                      f"MARK {label(2 * n)}", "PUSH -1", "MULTIPLY", "PUSH 3", "SUBTRACT",
+                      f"MARK {label(2 * n + 1)}"]
+    lines += ["STORE",
+              "PUSH 0", "PUSH 0", "RETRIEVE", "PUSH 1", "SUBTRACT", "STORE",
+              "PUSH 0", "RETRIEVE", "JUMPZERO T", "JUMP S",
+              "MARK T", "PUSH 1", "RETRIEVE", "OUTNUM", "ENDPROGRAM",
+              "MARK TS", "DUPLICATE", "MULTIPLY", f"PUSH {rnd.randint(2, 50)}", "MODULO",
+              "RETURN"]
+    return lines
+
+def random_loop(rnd, iterations, size):
+    # Returns a random loop (see random_loop_lines) as Whitespace.
+    return "".join(mkws.WhitespaceConverter().convert(random_loop_lines(rnd, iterations, size)))
+
+def run_with(code, stdin=b"", max_steps=None, jit=False, memo=False, optimize=False):
+    # Runs code like whitespace.run() does, with the JIT and the memo on or
+    # off, and returns its outcome.
+    io = ws.WhitespaceIO(BytesIO(stdin), None)
+    vm = ws.WhitespaceVM(code, io=io)
+    vm.jit_flag = jit
+    vm.memo_flag = memo
+    vm.optimize_flag = optimize
+    result = ws.Result()
+    try:
+        vm.load()
+        vm.execute(max_steps)
+    except ws.WhitespaceError as e:
+        result.status = 1
+        result.error = e
+    result.output = bytes(io.out)
+    result.steps = vm.steps
+    result.ended = vm.ended
+    return outcome(result)
+
+def random_programs(rnd, count, limits=STEP_LIMITS):
+    # Returns count random programs of 5 to 60 instructions, each with the
+    # step limits to run it at, for check_runs().
+    return [(random_program(rnd, rnd.randint(5, 60)), limits) for _ in range(count)]
+
+def random_loops(rnd, count):
+    # Returns count random loops, each with the step limits to run it at
+    # (none, and two that may stop it in the loop), for check_runs().
+    return [(random_loop(rnd, rnd.randint(1500, 4000), rnd.randint(1, 12)),
+             (None, rnd.randint(1, 100000), rnd.randint(1, 3000))) for _ in range(count)]
+
+def check_runs(runs, stdin=b"", reference=run_with, run=None, **options):
+    # Runs every program of runs (code, step limits) at each of its step
+    # limits, with run and with reference (functions of the code, the input
+    # and the step limit: by default run_with(options) and the interpreter),
+    # and checks the outcomes are the same.  A reference that returns None
+    # leaves that run out.
+    run = run or partial(run_with, **options)
+    for code, limits in runs:
+        for max_steps in limits:
+            want = reference(code, stdin, max_steps)
+            if want is not None:
+                assert run(code, stdin, max_steps) == want, (code, max_steps)
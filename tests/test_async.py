@@ -0,0 +1,63 @@
+import asyncio
+import random
+
+import mkws
+import whitespace as ws
+from programs import INPUT, outcome, random_program
+
+class Writer:
+    # A stream writer that notes down who wrote what, in order.
+    def __init__(self, name, writes):
+        self.name = name
+        self.writes = writes
+
+    def write(self, data):
+        self.writes.append((self.name, data))
+
+    async def drain(self):
+        pass
+
+def reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+def test_programs_match_run():
+    rnd = random.Random(14)
+    codes = [random_program(rnd, rnd.randint(5, 60)) for _ in range(200)]
+
+    async def main():
+        # all of them at once, taking turns every few steps
+        return await asyncio.gather(*[ws.run_async(code, reader(INPUT), quantum=rnd.randint(1, 9),
+                                                   max_steps=5000)
+                                      for code in codes])
+
+    for code, result in zip(codes, asyncio.run(main())):
+        assert outcome(result) == outcome(ws.run(code, INPUT, 5000)), code
+
+def test_programs_take_turns():
+    # reads a number and prints it, 50 times over
+    code = "".join(mkws.WhitespaceConverter().convert([
+        "PUSH 50", "MARK S", "PUSH 0", "INNUM", "PUSH 0", "RETRIEVE", "OUTNUM",
+        "PUSH 1", "SUBTRACT", "DUPLICATE", "JUMPZERO T", "JUMP S", "MARK T"]))
+    program = ws.load(code)
+    writes = []
+
+    async def main():
+        return await asyncio.gather(*[ws.run_async(program, reader(b"%d\n" % n * 50),
+                                                   Writer(n, writes), quantum=20)
+                                      for n in range(3)])
+
+    results = asyncio.run(main())
+    assert all(result.error is None and result.output == b"" for result in results)
+    for n in range(3):
+        assert b"".join(data for name, data in writes if name == n) == b"%d" % n * 50
+    # each of them wrote something before any of them was done
+    names = [name for name, _ in writes]
+    assert set(names[:3]) == {0, 1, 2}
+
+def test_step_limit():
+    code = "".join(mkws.WhitespaceConverter().convert(["MARK S", "JUMP S"]))
+    result = asyncio.run(ws.run_async(code, max_steps=1001, quantum=100))
+    assert isinstance(result.error, ws.StepLimitExceeded) and result.steps == 1001
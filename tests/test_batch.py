@@ -0,0 +1,69 @@
+import json
+from io import StringIO
+
+import pytest
+
+import mkws
+import whitespace as ws
+
+def program(lines):
+    return "".join(mkws.WhitespaceConverter().convert(lines))
+
+@pytest.fixture
+def manifest(tmp_path):
+    # a manifest of jobs that pass, fail and can't run
+    (tmp_path / "double.ws").write_text(program(["PUSH 0", "INNUM", "PUSH 0", "RETRIEVE",
+                                                 "PUSH 2", "MULTIPLY", "OUTNUM"]))
+    (tmp_path / "loop.ws").write_text(program(["MARK S", "JUMP S"]))
+    (tmp_path / "bad.ws").write_text(program(["JUMP S"]))
+    (tmp_path / "21.txt").write_text("21\n")
+    (tmp_path / "42.txt").write_text("42")
+    (tmp_path / "43.txt").write_text("43")
+    (tmp_path / "jobs.txt").write_text(
+        "# program input expected\n"
+        "double.ws 21.txt 42.txt\n"
+        "double.ws 21.txt 43.txt\n"
+        "\n"
+        "double.ws 42.txt\n"
+        "double.ws - 42.txt\n"
+        "double.ws missing.txt 42.txt\n"
+        "missing.ws 21.txt\n"
+        "bad.ws\n"
+        "loop.ws - 42.txt\n")
+    return str(tmp_path / "jobs.txt")
+
+def run_batch(manifest, **options):
+    out = StringIO()
+    summary = ws.run_batch(manifest, 2, max_steps=1000, file=out, **options)
+    return summary, [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_batch(manifest, tmp_path):
+    summary, records = run_batch(manifest)
+    shown = [(r["job"], r["status"], r["passed"], r["error"] and r["error"].split(" AT ")[0])
+             for r in records]
+    assert shown == [
+        (0, "ok", True, None),
+        (1, "ok", False, None),
+        (2, "ok", None, None),
+        (3, "error", False, "RUNTIME ERROR : END OF INPUT WHILE READING A NUMBER"),
+        (4, "error", None, f"could not read {tmp_path / 'missing.txt'}"),
+        (5, "error", None, f"could not read {tmp_path / 'missing.ws'}"),
+        (6, "error", None, "SYNTAX ERROR : UNDEFINED LABEL"),
+        (7, "error", False, "RUNTIME ERROR : STEP LIMIT REACHED")]
+    assert records[7]["steps"] == 1000
+    assert {key: summary[key] for key in ("jobs", "programs", "ok", "errors", "passed",
+                                          "failed", "steps")} == \
+        {"jobs": 8, "programs": 4, "ok": 3, "errors": 5, "passed": 1, "failed": 3,
+         "steps": records[0]["steps"] * 3 + records[3]["steps"] + 1000}
+
+def test_unordered(manifest):
+    _, records = run_batch(manifest)
+    _, unordered = run_batch(manifest, ordered=False, optimize=True)
+    assert sorted(r["job"] for r in unordered) == list(range(8))
+    assert [r["passed"] for r in sorted(unordered, key=lambda r: r["job"])] == \
+        [r["passed"] for r in records]
+
+def test_bad_manifest(tmp_path):
+    (tmp_path / "jobs.txt").write_text("a.ws b.txt c.txt d.txt\n")
+    with pytest.raises(ValueError, match="line 1: too many fields"):
+        ws.run_batch(str(tmp_path / "jobs.txt"))
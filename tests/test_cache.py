@@ -0,0 +1,61 @@
+import os
+
+import whitespace as ws
+import wsbench
+
+CODE = wsbench.generate_program(5000)
+
+def linked(vm):
+    # everything a cache entry gives a VM
+    return ([(token.op, token.arg) for token in vm.tokens], vm.opcodes, vm.operands,
+            vm.labels, vm.label_names, vm.safe, vm.pure)
+
+def loaded(directory, code=CODE, optimize=False):
+    # Loads code through the cache in directory, and returns whether it
+    # was found there and the VM.
+    vm = ws.WhitespaceVM(code)
+    vm.optimize_flag = optimize
+    vm.cache = ws.ProgramCache(directory)
+    hit = vm.cache.load(vm)
+    if not hit:
+        vm.load()
+    return hit, vm
+
+def test_miss_then_hit(tmp_path):
+    hit, first = loaded(str(tmp_path))
+    assert not hit and len(os.listdir(tmp_path)) == 1
+    hit, second = loaded(str(tmp_path))
+    assert hit and linked(second) == linked(first)
+    assert ws.run(second.program()).output == ws.run(CODE).output
+    # the optimized program is another entry, and so is another program
+    for code, optimize in ((CODE, True), (ws.WhitespaceVM.test_code, False)):
+        hit, vm = loaded(str(tmp_path), code, optimize)
+        assert not hit
+        assert loaded(str(tmp_path), code, optimize)[0]
+    assert len(os.listdir(tmp_path)) == 3
+
+def test_stale_entries(tmp_path, monkeypatch):
+    _, first = loaded(str(tmp_path))
+    path = first.cache.path(first)
+    with open(path, "rb") as f:
+        data = f.read()
+    # an entry written by an older version, or cut short, is loaded anew
+    # and written over
+    for stale in (b"WSC2" + data[4:], data[:len(data) // 2], b""):
+        with open(path, "wb") as f:
+            f.write(stale)
+        hit, vm = loaded(str(tmp_path))
+        assert not hit and linked(vm) == linked(first)
+        hit, vm = loaded(str(tmp_path))
+        assert hit and linked(vm) == linked(first)
+    # and a change to the interpreter leaves the old entries behind
+    monkeypatch.setattr(ws.ProgramCache, "_interpreter_hash", b"another interpreter")
+    assert not loaded(str(tmp_path))[0]
+    assert len(os.listdir(tmp_path)) == 2
+
+def test_unwritable_directory(tmp_path, capsys):
+    directory = tmp_path / "file"
+    directory.write_text("")
+    hit, vm = loaded(str(directory))
+    assert not hit and vm.opcodes
+    assert "could not write to the program cache" in capsys.readouterr().err
@@ -0,0 +1,87 @@
+import random
+from io import BytesIO
+
+import pytest
+
+import mkws
+import whitespace as ws
+from programs import random_loop
+
+# adds up the characters of its input, writing the sum after each one
+SUMS = "".join(mkws.WhitespaceConverter().convert([
+    "MARK S", "PUSH 1", "INCH", "PUSH 1", "RETRIEVE", "DUPLICATE", "JUMPNEG T",
+    "PUSH 2", "RETRIEVE", "ADD", "PUSH 2", "SWAP", "STORE",
+    "PUSH 2", "RETRIEVE", "OUTNUM", "PUSH 32", "OUTCH", "JUMP S",
+    "MARK T", "ENDPROGRAM"]))
+
+def run_part(code, stdin, path, max_steps=None, resume=False, every=100):
+    # Runs code (on to the end, or max_steps) with snapshots every so many
+    # steps, from the start or from the last snapshot, and returns what it
+    # wrote, the error and the steps.
+    out = BytesIO()
+    io = ws.WhitespaceIO(BytesIO(stdin), out)
+    vm = ws.WhitespaceVM(code, io=io)
+    vm.checkpoints = ws.Checkpoints(path)
+    vm.checkpoint_every = every
+    if resume:
+        vm.resume_from = ws.Checkpoints.read(path)
+    error = None
+    try:
+        vm.load()
+        vm.execute(max_steps)
+    except ws.WhitespaceError as e:
+        error = e
+    io.flush()
+    return out.getvalue(), error, vm.steps
+
+def run_in_parts(code, stdin, path, parts):
+    # Runs code that many steps at a time (a resumed run gets max_steps on
+    # top of the steps of the snapshot), resuming from the snapshot every
+    # time, and then to the end.  Returns what it all wrote, the last error
+    # and the steps.
+    output = b""
+    steps = 0
+    for max_steps in parts + [None]:
+        out, error, now = run_part(code, stdin, path, max_steps, steps > 0)
+        output += out
+        if max_steps is not None:
+            assert isinstance(error, ws.StepLimitExceeded) and now == steps + max_steps
+        steps = now
+    return output, error, steps
+
+def test_resumed_run_matches_full_run(tmp_path):
+    path = str(tmp_path / "run.wss")
+    stdin = bytes(random.Random(24).randrange(256) for _ in range(300))
+    whole = ws.run(SUMS, stdin)
+    # far enough apart that the file gets written anew on the way
+    output, error, steps = run_in_parts(SUMS, stdin, path, [1, 6, 493, 1800, 1701])
+    assert (output, error, steps) == (whole.output, whole.error, whole.steps)
+
+def test_resumed_loops_match_full_runs(tmp_path):
+    rnd = random.Random(25)
+    for n in range(10):
+        path = str(tmp_path / f"loop{n}.wss")
+        code = random_loop(rnd, rnd.randint(200, 600), rnd.randint(1, 8))
+        whole = ws.run(code)
+        parts = [rnd.randint(1, whole.steps // 3) for _ in range(3)]
+        output, error, steps = run_in_parts(code, b"", path, parts)
+        assert (output, str(error), steps) == (whole.output, str(whole.error), whole.steps)
+
+def test_record_cut_short(tmp_path):
+    # a crash while writing a snapshot leaves the one before it
+    path = str(tmp_path / "run.wss")
+    run_part(SUMS, b"abcdef", path, 40, every=10)
+    state = ws.Checkpoints.read(path)
+    with open(path, "ab") as f:
+        f.write((1000).to_bytes(4, "little") + b"cut")
+    assert ws.Checkpoints.read(path) == state
+    with open(path, "wb") as f:
+        f.write(ws.Checkpoints.MAGIC + b"\0\0")
+    with pytest.raises(ValueError):
+        ws.Checkpoints.read(path)
+
+def test_input_gone(tmp_path):
+    path = str(tmp_path / "run.wss")
+    run_part(SUMS, b"abcdef", path, 100)
+    output, error, _ = run_part(SUMS, b"ab", path, resume=True)
+    assert (output, error.message) == (b"", "THE INPUT ENDS BEFORE WHERE THE SNAPSHOT WAS")
@@ -0,0 +1,60 @@
+import asyncio
+from io import BytesIO
+
+import mkws
+import whitespace as ws
+
+def program(lines):
+    return "".join(mkws.WhitespaceConverter().convert(lines))
+
+def run(code, stdin, compiled):
+    # Runs code with the interpreter or compiled, and returns the error
+    # and how much of the input it used.
+    io = ws.WhitespaceIO(BytesIO(stdin), None)
+    vm = ws.WhitespaceVM(code, io=io)
+    vm.load()
+    try:
+        if compiled:
+            vm.execute_compiled()
+        else:
+            vm.execute()
+        error = None
+    except ws.WhitespaceError as e:
+        error = str(e)
+    return error, io.position(), bytes(io.out)
+
+def test_input_on_empty_stack():
+    # running out of stack comes first, before any input is taken
+    for op in ("INCH", "INNUM"):
+        code = program([op])
+        for stdin in (b"", b"12\n"):
+            interpreted = run(code, stdin, False)
+            assert interpreted == run(code, stdin, True)
+            assert interpreted == (f"RUNTIME ERROR : STACK UNDERFLOW AT INSTRUCTION #0 : {op} ",
+                                   0, b"")
+
+def test_input_matches_compiled():
+    code = program(["PUSH 0", "INCH", "PUSH 1", "INNUM", "PUSH 0", "RETRIEVE", "OUTCH",
+                    "PUSH 1", "RETRIEVE", "OUTNUM", "PUSH 2", "INCH", "PUSH 2", "RETRIEVE",
+                    "OUTNUM"])
+    for stdin in (b"x42\n", b"x 7", b"y\n-3\nz", b"", b"x"):
+        assert run(code, stdin, False) == run(code, stdin, True), stdin
+
+def test_async_input_in_pieces():
+    # the program waits for input halfway through INNUM and INCH, and
+    # carries on with the same addresses once it comes
+    code = program(["PUSH 5", "PUSH 0", "INNUM", "PUSH 1", "INCH", "PUSH 0", "RETRIEVE",
+                    "OUTNUM", "PUSH 1", "RETRIEVE", "OUTCH", "OUTNUM"])
+
+    async def main():
+        reader = asyncio.StreamReader()
+        task = asyncio.create_task(ws.run_async(code, reader))
+        for piece in (b"1", b"2", b"\n", b"", b"a"):
+            await asyncio.sleep(0.01)
+            if piece:
+                reader.feed_data(piece)
+        reader.feed_eof()
+        return await task
+
+    result = asyncio.run(main())
+    assert (result.output, result.error) == (b"12a5", None)
@@ -0,0 +1,14 @@
+import random
+from functools import partial
+
+from programs import INPUT, check_runs, random_loops, random_programs, run_with
+
+def test_traces_match_interpreter():
+    check_runs(random_loops(random.Random(20), 30), jit=True)
+
+def test_optimized_traces_match_interpreter():
+    runs = [(code, (None,)) for code, _ in random_loops(random.Random(21), 10)]
+    check_runs(runs, reference=partial(run_with, optimize=True), jit=True, optimize=True)
+
+def test_random_programs_match_interpreter():
+    check_runs(random_programs(random.Random(22), 300), INPUT, jit=True)
@@ -0,0 +1,22 @@
+import random
+
+import mkws
+from programs import INPUT, check_runs, random_loops, random_programs, run_with
+
+def test_memoized_loops_match_interpreter():
+    runs = random_loops(random.Random(21), 20)
+    check_runs(runs, memo=True)
+    check_runs(runs, jit=True, memo=True)
+
+def test_random_programs_match_interpreter():
+    check_runs(random_programs(random.Random(23), 300), INPUT, memo=True)
+
+def test_step_limit_is_exact():
+    # every call of the subroutine misses, so at some limits there's one
+    # step left just as a CALL runs
+    lines = ["PUSH 0", "MARK S", "PUSH 1", "ADD", "DUPLICATE", "PUSH 5000", "MODULO",
+             "CALL T", "DISCARD", "JUMP S",
+             "MARK T", "DUPLICATE", "MULTIPLY", "RETURN"]
+    code = "".join(mkws.WhitespaceConverter().convert(lines))
+    for max_steps in range(1, 600):
+        assert run_with(code, max_steps=max_steps, memo=True)[3] == max_steps
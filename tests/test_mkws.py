@@ -0,0 +1,99 @@
+import io
+import os
+import random
+import subprocess
+import sys
+
+import mkws
+import whitespace as ws
+from programs import INPUT, outcome, random_lines
+
+MKWS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mkws.py")
+
+def mkws_py(*args, stdin=b""):
+    return subprocess.run([sys.executable, MKWS, *args], input=stdin, capture_output=True)
+
+def test_write_in_chunks(monkeypatch):
+    rnd = random.Random(16)
+    lines = [line + "\n" for line in random_lines(rnd, 500)]
+    code = "".join(mkws.WhitespaceConverter().convert(lines))
+    monkeypatch.setattr(mkws, "CHUNK_SIZE", 7)
+    out = io.StringIO()
+    assert mkws.WhitespaceConverter().write(lines, out) == len(code)
+    assert out.getvalue() == code
+
+def test_bad_lines_write_nothing(tmp_path):
+    source = tmp_path / "bad.mkws"
+    source.write_text("PUSH 1\nPUSH one\n\nJUMP SX  # comment\nOUTNUM\nPOP\n")
+    with open(tmp_path / "bad.ws", "wb") as out:
+        result = subprocess.run([sys.executable, MKWS, str(source)], stdout=out,
+                                stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    assert os.path.getsize(tmp_path / "bad.ws") == 0
+    assert result.stderr.decode().splitlines() == [
+        f"{source}, line 2: SYNTAX ERROR : BAD NUMBER : -one-",
+        f"{source}, line 4: SYNTAX ERROR : BAD LABEL : -SX-",
+        f"{source}, line 6: SYNTAX ERROR : BAD OPERATION : -POP-",
+        f"{MKWS}: error: 3 bad lines"]
+
+def test_run_matches_converted_program():
+    rnd = random.Random(17)
+    for _ in range(200):
+        lines = random_lines(rnd, rnd.randint(5, 60))
+        code = "".join(mkws.WhitespaceConverter().convert(lines))
+        try:
+            program = mkws.WhitespaceConverter().program(lines)
+        except ws.WhitespaceError as e:
+            assert str(ws.run(code).error) == str(e)
+            continue
+        assert outcome(ws.run(program, INPUT, 5000)) == outcome(ws.run(code, INPUT, 5000)), lines
+
+def test_run_from_the_command_line(tmp_path):
+    source = tmp_path / "add.mkws"
+    source.write_text("PUSH 0\nINNUM\nPUSH 0\nRETRIEVE\nPUSH 1\nADD\nOUTNUM\nENDPROGRAM\n")
+    result = mkws_py("--run", str(source), stdin=b"41\n")
+    assert (result.returncode, result.stdout) == (1, b"42")
+    assert result.stderr == b"\nPROGRAM COMPLETED SUCCESSFULLY.\n"
+    source.write_text("PUSH 1\nJUMP S\n")
+    result = mkws_py("--run", str(source))
+    assert result.stderr.decode().startswith("SYNTAX ERROR : UNDEFINED LABEL")
+
+def compact(lines):
+    converter = mkws.WhitespaceConverter(compact=True)
+    converter.assign_labels(lines)
+    return "".join(converter.convert(lines)), converter.labels
+
+def shown(result):
+    # labels get other codes, so errors only match up to the instruction
+    return result.output, result.status, result.error and result.error.message, result.steps
+
+def test_compact_runs_the_same():
+    rnd = random.Random(17)
+    for _ in range(200):
+        lines = random_lines(rnd, rnd.randint(5, 60))
+        code, _ = compact(lines)
+        plain = "".join(mkws.WhitespaceConverter().convert(lines))
+        assert len(code) <= len(plain)
+        assert shown(ws.run(code, INPUT, 5000)) == shown(ws.run(plain, INPUT, 5000)), lines
+
+def test_compact_labels():
+    # the label used most gets the shortest code, and zero has no digits
+    lines = ["PUSH 0", "MARK loop", "PUSH 1", "ADD", "DUPLICATE", "PUSH 5", "SUBTRACT",
+             "JUMPZERO the end", "DUPLICATE", "OUTNUM", "JUMP loop", "MARK the end"]
+    code, labels = compact(lines)
+    assert labels == {"loop": "S", "the end": "T"}
+    assert code.startswith(ws.WhitespaceVM.OPERATIONS["PUSH"] + ws.SPACE + ws.LF)
+    assert ws.run(code).output == b"1234"
+    program = mkws.WhitespaceConverter(compact=True).program(lines)
+    assert ws.run(program).output == b"1234"
+
+def test_compact_from_the_command_line():
+    source = "MARK start\nPUSH 0\nOUTNUM\nJUMP end\nMARK end\n"
+    result = mkws_py("--compact", "-", stdin=source.encode())
+    assert result.stdout.decode() == compact(source.splitlines())[0]
+    assert result.stderr.decode().startswith("2 labels, ")
+    result = mkws_py("--compact", "--run", "-", stdin=source.encode())
+    assert result.stdout == b"0"
+    # a bad line still writes nothing
+    result = mkws_py("--compact", "-", stdin=source.replace("PUSH 0", "PUSH x").encode())
+    assert result.stdout == b"" and result.returncode == 1
@@ -0,0 +1,35 @@
+import random
+
+import mkws
+import whitespace as ws
+from programs import INPUT, check_runs, random_programs
+
+def program(lines):
+    return "".join(mkws.WhitespaceConverter().convert(lines))
+
+def shown(result):
+    # the instruction an error is at moves when the optimizer drops code
+    return result.output, result.status, result.error and result.error.message
+
+def test_no_op_still_runs_out_of_stack():
+    # PUSH 0; PUSH -4; DIVIDE; SUBTRACT folds down to ADD_IMM 0
+    code = program(["PUSH 0", "PUSH -4", "DIVIDE", "SUBTRACT", "PUSH 7", "OUTNUM"])
+    assert shown(ws.run(code, optimize=True)) == (b"", 1, "STACK UNDERFLOW")
+
+def test_branch_never_taken_to_undefined_label():
+    code = program(["PUSH 1", "JUMPZERO T", "ENDPROGRAM"])
+    assert shown(ws.run(code)) == (b"", 1, "UNDEFINED LABEL")
+    assert shown(ws.run(code, optimize=True)) == (b"", 1, "UNDEFINED LABEL")
+
+def test_optimized_runs_match():
+    def plain(code, stdin, max_steps):
+        # the optimized program runs fewer steps, so it may stop on the
+        # step limit somewhere else
+        result = ws.run(code, stdin, max_steps)
+        if not isinstance(result.error, ws.StepLimitExceeded):
+            return shown(result)
+
+    def optimized(code, stdin, max_steps):
+        return shown(ws.run(code, stdin, max_steps, optimize=True))
+
+    check_runs(random_programs(random.Random(4), 500, (3000,)), INPUT, plain, optimized)
@@ -0,0 +1,79 @@
+import random
+from io import BytesIO, StringIO
+
+import pytest
+
+import mkws
+import whitespace as ws
+from programs import INPUT, random_program
+
+ENGINES = [{}, {"memo_flag": False}, {"optimize_flag": True}, {"jit_flag": True},
+           {"compile_flag": True}]
+
+def program(lines):
+    return "".join(mkws.WhitespaceConverter().convert(lines))
+
+def record(code, stdin, max_steps=None):
+    # Runs code on stdin with the interpreter, and returns the recording
+    # and the error it stopped with.
+    log = StringIO()
+    io = ws.IORecorder(BytesIO(stdin), None, log, code)
+    vm = ws.WhitespaceVM(code, io=io)
+    vm.max_steps = max_steps
+    error = None
+    try:
+        vm.run()
+    except ws.WhitespaceError as e:
+        error = e
+    io.finish(vm.ended, error)
+    return log.getvalue(), error
+
+def replay(recording, code, source=None, **flags):
+    # Plays the recording back to code, and returns how it differs (see
+    # IOReplayer.difference) and what the program wrote.
+    io = ws.IOReplayer(StringIO(recording), None, source)
+    vm = ws.WhitespaceVM(code, io=io)
+    for flag, value in flags.items():
+        setattr(vm, flag, value)
+    error = None
+    try:
+        vm.run()
+    except ws.WhitespaceError as e:
+        error = e
+    return io.difference(vm.ended, error), bytes(io.out)
+
+def test_random_programs_replay_on_every_engine():
+    rnd = random.Random(22)
+    replayed = 0
+    while replayed < 100:
+        code = random_program(rnd, rnd.randint(5, 60))
+        recording, error = record(code, INPUT, 5000)
+        if isinstance(error, ws.StepLimitExceeded):
+            continue    # the compiled program can't be stopped
+        output = ws.run(code, INPUT).output
+        for flags in ENGINES:
+            assert replay(recording, code, code, **flags) == (None, output), (code, flags)
+        replayed += 1
+
+def test_input_in_the_recording():
+    # the replay gets the input the recording took, and no more
+    code = program(["PUSH 0", "INNUM", "PUSH 0", "RETRIEVE", "OUTNUM",
+                    "PUSH 1", "INCH", "PUSH 1", "RETRIEVE", "OUTCH", "ENDPROGRAM"])
+    recording, error = record(code, b" 42\nxyz")
+    assert error is None
+    for flags in ENGINES:
+        assert replay(recording, code, code, **flags) == (None, b"42x")
+
+def test_other_program():
+    code = program(["PUSH 65", "OUTCH", "PUSH 66", "OUTCH"])
+    recording, _ = record(code, b"")
+    other = program(["PUSH 65", "OUTCH", "PUSH 67", "OUTCH"])
+    with pytest.raises(ValueError, match="another program"):
+        ws.IOReplayer(StringIO(recording), None, other)
+    difference, output = replay(recording, other)
+    assert difference == "it ended with no error" and output == b"AC"
+    # stopping early or reading past the recording are differences too
+    assert replay(recording, program(["PUSH 65", "OUTCH"]))[0] == \
+        "the output stopped at byte 1 of 2"
+    difference, _ = replay(recording, program(["PUSH 0", "INCH"]))
+    assert difference == "it ended with no error"
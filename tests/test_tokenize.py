@@ -0,0 +1,63 @@
+import glob
+import os
+import random
+
+import whitespace as ws
+import wsbench
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def tokens(code, chunk_size=None, processes=1, monkeypatch=None):
+    # The tokens of code, as (operation, argument) pairs, or the error.
+    vm = ws.WhitespaceVM(code)
+    try:
+        if chunk_size is None:
+            vm.tokenize()
+        else:
+            monkeypatch.setattr(ws, "TOKENIZE_CHUNK_SIZE", chunk_size)
+            vm.tokenize_chunked(processes)
+    except ws.WhitespaceError as e:
+        return str(e)
+    return [(token.op, token.arg) for token in vm.tokens]
+
+def random_source(rnd):
+    # Random operations with random arguments, and comments (some of them
+    # not ASCII) in between, now and then cut short or with a character too
+    # many, to make syntax errors.
+    parts = []
+    for _ in range(rnd.randint(0, 30)):
+        name, chars = rnd.choice(list(ws.WhitespaceVM.OPERATIONS.items()))
+        parts.append(chars)
+        if name in ws.WhitespaceVM.NUMBER_OPS:
+            parts.append(rnd.choice(" \t") + "".join(rnd.choice(" \t")
+                                                     for _ in range(rnd.randint(0, 6))) + "\n")
+        elif name in ws.WhitespaceVM.LABEL_OPS:
+            parts.append("".join(rnd.choice(" \t") for _ in range(rnd.randint(0, 6))) + "\n")
+        if rnd.random() < 0.3:
+            parts.append(rnd.choice(["x", "é", "\r", "comment"]))
+    code = "".join(parts)
+    r = rnd.random()
+    if r < 0.15:
+        code = code[:rnd.randint(0, len(code))]
+    elif r < 0.25 and code:
+        i = rnd.randrange(len(code))
+        code = code[:i] + rnd.choice(" \t\n") + code[i:]
+    return code
+
+def test_random_sources(monkeypatch):
+    rnd = random.Random(23)
+    for _ in range(300):
+        code = random_source(rnd)
+        want = tokens(code)
+        for chunk_size in (1, 2, 3, 5, 8, 13, 64):
+            assert tokens(code, chunk_size, 1, monkeypatch) == want, (code, chunk_size)
+
+def test_programs_over_processes(monkeypatch):
+    codes = [ws.WhitespaceVM.test_code, wsbench.generate_program(20000)]
+    for filename in sorted(glob.glob(os.path.join(HERE, "..", "*.ws"))):
+        with open(filename) as f:
+            codes.append(f.read())
+    for code in codes:
+        want = tokens(code)
+        assert tokens(code, 97, 1, monkeypatch) == want
+        assert tokens(code, 997, 3, monkeypatch) == want
@@ -0,0 +1,41 @@
+import random
+from functools import partial
+
+import mkws
+import whitespace as ws
+from programs import INPUT, check_runs, random_programs, run_with
+
+def verifier(code):
+    vm = ws.WhitespaceVM(code)
+    vm.tokenize()
+    vm.scan_labels()
+    vm.link()
+    return ws.Verifier(vm)
+
+def test_test_program_is_all_safe():
+    # the subroutines of the test program leave the stack as they found
+    # it, so nothing after a CALL may run out of stack
+    assert all(verifier(ws.WhitespaceVM.test_code).safe_blocks())
+
+def test_subroutine_effect_after_call():
+    # PUSH 1; PUSH 2; CALL S; ADD; ENDPROGRAM;  S: DISCARD; RETURN
+    lines = ["PUSH 1", "PUSH 2", "CALL S", "ADD", "ENDPROGRAM", "MARK S", "DISCARD", "RETURN"]
+    code = "".join(mkws.WhitespaceConverter().convert(lines))
+    v = verifier(code)
+    after = v.block_of[3]
+    assert v.depths[after] == 1
+    assert not v.safe_blocks()[after]
+    assert ws.run(code).error.kind == "RUNTIME ERROR"
+
+def test_unchecked_runs_match_checked(monkeypatch):
+    # every instruction the verifier lets skip its checks must run the same
+    # as it would checked
+    def checked(code, stdin, max_steps, optimize):
+        with monkeypatch.context() as m:
+            m.setattr(ws.Verifier, "safe_instructions",
+                      lambda self: [False] * len(self.vm.tokens))
+            return run_with(code, stdin, max_steps, optimize=optimize)
+
+    runs = random_programs(random.Random(19), 300, (3000,))
+    for optimize in (False, True):
+        check_runs(runs, INPUT, partial(checked, optimize=optimize), optimize=optimize)
@@ -0,0 +1,113 @@
+import json
+import os
+import random
+import socket
+import threading
+
+import pytest
+
+import mkws
+import whitespace as ws
+import wsserver
+from programs import random_program
+
+def expected(program, record, max_steps=None):
+    result = ws.run(program, record, max_steps)
+    return {"status": result.status, "output": result.output.decode("latin-1"),
+            "steps": result.steps,
+            "error": str(result.error) if result.error is not None else None}
+
+def test_vm_runs_again_from_scratch():
+    # one VM answers one record after another as a new one would
+    rnd = random.Random(13)
+    for _ in range(100):
+        try:
+            program = ws.load(random_program(rnd, rnd.randint(5, 60)))
+        except ws.WhitespaceError:
+            continue    # doesn't link
+        vm = ws.WhitespaceVM(io=ws.WhitespaceIO())
+        vm.use_program(program)
+        vm.prepare()
+        for record in (b"12\n3\n", b"", b"7\n", b"12\n3\n"):
+            reply = json.loads(wsserver.answer(vm, record, 3000, None))
+            assert reply == expected(program, record, 3000)
+
+def test_nothing_left_over():
+    # the first record stops inside the subroutine with items on the stack
+    # and a value in the heap, which the next run mustn't see
+    program = ws.load("".join(mkws.WhitespaceConverter().convert([
+        "PUSH 0", "RETRIEVE", "OUTNUM", "PUSH 0", "PUSH 5", "STORE", "PUSH 7", "CALL S",
+        "OUTNUM", "RETURN", "MARK S", "PUSH 1", "INNUM", "RETURN"])))
+    vm = ws.WhitespaceVM(io=ws.WhitespaceIO())
+    vm.use_program(program)
+    for record in (b"", b"3\n", b"", b"4\n"):
+        assert json.loads(wsserver.answer(vm, record, None, None)) == expected(program, record)
+
+def ask(path, data):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(data)
+        conn.shutdown(socket.SHUT_WR)
+        replies = b""
+        while True:
+            received = conn.recv(65536)
+            if not received:
+                return replies
+            replies += received
+
+def serving(server, client):
+    # Runs client() in a thread while the server serves, and returns what
+    # it returned.
+    found = []
+    thread = threading.Thread(target=lambda: found.append(client()))
+    thread.start()
+    server.serve(lambda: not thread.is_alive())
+    thread.join()
+    return found[0]
+
+def test_replies_in_order(tmp_path):
+    program = ws.load(ws.WhitespaceVM.test_code)
+    path = str(tmp_path / "ws.sock")
+    records = [b"x%d\n" % n for n in range(200)] + [b"last"]
+    server = wsserver.Server(program, path, 3)
+    try:
+        replies = serving(server, lambda: ask(path, b"".join(records)))
+    finally:
+        server.stop()
+    assert [json.loads(line) for line in replies.splitlines()] == \
+        [expected(program, record) for record in records]
+    assert not os.path.exists(path)
+
+def test_dead_worker_is_replaced(tmp_path):
+    program = ws.load(ws.WhitespaceVM.test_code)
+    path = str(tmp_path / "ws.sock")
+    server = wsserver.Server(program, path, 2)
+    try:
+        pids = set(server.workers)
+        os.kill(next(iter(pids)), 9)
+        server.serve(lambda: server.workers.keys() != pids)
+        assert len(server.workers) == 2
+        reply = serving(server, lambda: ask(path, b"x\nx\n"))
+        assert [json.loads(line) for line in reply.splitlines()] == \
+            [expected(program, b"x\n")] * 2
+    finally:
+        server.stop()
+
+def test_socket_in_use(tmp_path):
+    program = ws.load(ws.WhitespaceVM.test_code)
+    path = str(tmp_path / "ws.sock")
+    server = wsserver.Server(program, path, 1)
+    try:
+        with pytest.raises(OSError, match="already listening"):
+            wsserver.Server(program, path, 1)
+    finally:
+        server.stop()
+    # a socket nobody listens on is replaced, but not a file
+    socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).bind(path)
+    wsserver.Server(program, path, 1).stop()
+    with open(path, "w") as f:
+        f.write("keep me")
+    with pytest.raises(OSError, match="isn't a socket"):
+        wsserver.Server(program, path, 1)
+    with open(path) as f:
+        assert f.read() == "keep me"
@@ -1,15 +1,930 @@
 #!/usr/bin/python3
-from collections import deque
+from array import array
+import asyncio
+import bisect
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import json
+import marshal
+import multiprocessing
 import sys
 import os
+import tempfile
+import time
 import re
 # ------------------------------ CONSTANTS
 SPACE = ' '
 TAB = '\t'
 LF = '\n'
-HEAPSIZE = 512
+HEAP_PAGE_SIZE = 512
+MAX_CALL_DEPTH = 1000000
+OUTPUT_BUFFER_SIZE = 8192
+INPUT_CHUNK_SIZE = 65536
+QUANTUM = 65536             # instructions execute() runs between checks
+JIT_THRESHOLD = 1000        # times a loop runs before the JIT records a trace of it
+JIT_MAX_TRACE = 1000        # longest trace the JIT records, in instructions
+JIT_ATTEMPTS = 3            # times the JIT tries to record a trace of a loop
+JIT_ITERATIONS = 1000       # most iterations of a trace per call
+MEMO_SIZE = 10000           # results of pure subroutines kept
+MEMO_MAX_DEPTH = 100        # most memoized calls running at once
+MEMO_TRIAL = 1000           # calls of a subroutine before it has to have paid off
+TOKENIZE_CHUNK_SIZE = 1 << 20       # bytes of source in each chunk of tokenize_chunked()
+CHUNKED_TOKENIZE_SIZE = 1 << 22     # load() tokenizes sources this long in chunks
+CHECKPOINT_EVERY = 5000000  # instructions between snapshots, by default
+CHECKPOINT_COMPACT = 16     # snapshots appended to a file before it is rewritten
+WHITESPACE = SPACE + TAB + LF
+# the chunked tokenizer drops every other byte, and reads spaces and tabs as 0 and 1
+WHITESPACE_BITS = bytes.maketrans(b" \t", b"01")
+COMMENT_BYTES = bytes(c for c in range(256) if c not in b" \t\n")
+
+# states of the tokenizer's DFA (see WhitespaceVM.tokenize)
+IN_OPERATION = 0    # walking the operation trie
+IN_SIGN = 1         # expecting the sign of a numeric argument
+IN_NUMBER = 2       # reading the binary digits of a numeric argument
+IN_LABEL = 3        # reading the characters of a label argument
+
+# -------------------------------FUNCTIONS
+def build_trie(operations):
+    # Builds a prefix tree out of the operations dictionary.  Each node is a
+    # dictionary keyed by SPACE, TAB or LF.  Following the characters of an
+    # operation from the root leads to the name of that operation.
+    # No operation is a prefix of another one, so a leaf is always a name.
+    # Every node also remembers, under the key "", the characters that lead
+    # to it, which comes in handy for error messages.
+    trie = {"": ""}
+    for name, opchars in operations.items():
+        node = trie
+        for n, ch in enumerate(opchars[:-1]):
+            node = node.setdefault(ch, {"": opchars[:n+1]})
+        node[opchars[-1]] = name
+    return trie
+
+def build_token_patterns(operations, opcodes, label_ops, number_ops):
+    # Builds the regular expressions of the chunked tokenizer (see
+    # WhitespaceVM.tokenize_chunked), which reads source with the comments
+    # taken out and spaces and tabs turned into 0 and 1.  Returns the
+    # pattern of a whole token, with a group for each operation; a list
+    # giving the (opcode, argument kind, length) of the operation of each
+    # group (the kind is "number", "label" or ""); and the pattern of the
+    # start of a token, which the next chunk may finish.
+    bits = str.maketrans(" \t", "01")
+    tokens = []
+    starts = []
+    groups = [None]
+    for name, opchars in operations.items():
+        pattern = re.escape(opchars.translate(bits))
+        if name in number_ops:
+            tokens.append(f"({pattern}[01][01]*\n)")
+            starts.append(f"{pattern}(?:[01][01]*)?")
+            kind = "number"
+        elif name in label_ops:
+            tokens.append(f"({pattern}[01]*\n)")
+            starts.append(f"{pattern}[01]*")
+            kind = "label"
+        else:
+            tokens.append(f"({pattern})")
+            kind = ""
+        groups.append((opcodes[name], kind, len(opchars)))
+    # and every operation cut short
+    starts += sorted({re.escape(opchars[:n].translate(bits))
+                      for opchars in operations.values() for n in range(1, len(opchars))})
+    return re.compile("|".join(tokens)), groups, re.compile("|".join(starts))
+
+def label_id(text):
+    # Returns the id of the label shown as text (a string of S and T, the
+    # way --describe shows labels).  The id is the label's bits, read as a
+    # binary number with S for 0 and T for 1, behind an extra 1 bit that
+    # keeps labels which only differ in leading spaces apart.
+    return int("1" + text.replace("S", "0").replace("T", "1"), 2)
+
+def label_text(label):
+    # Returns the label with id label as a string of S and T (see label_id).
+    return bin(label)[3:].replace("0", "S").replace("1", "T")
+
+def source_hash(source):
+    # Returns the SHA-256 of the source code of a program, in hex.
+    return hashlib.sha256(source.encode("utf-8", "surrogatepass")).hexdigest()
 
 # -------------------------------CLASSES
+class WhitespaceError(Exception):
+    # An error in a Whitespace program.  kind is "SYNTAX ERROR" or "RUNTIME
+    # ERROR" and message says what went wrong.  When the error belongs to an
+    # instruction, instruction is its index and op and arg are its operation
+    # and argument (as shown by --describe), otherwise they are None.
+
+    def __init__(self, kind, message, instruction=None, op=None, arg=None):
+        super().__init__(kind, message, instruction, op, arg)
+        self.kind = kind
+        self.message = message
+        self.instruction = instruction
+        self.op = op
+        self.arg = arg
+
+    def __str__(self):
+        if self.instruction is None:
+            return f"{self.kind} : {self.message}"
+        return (f"{self.kind} : {self.message} AT INSTRUCTION #{self.instruction} : "
+                f"{self.op} {self.arg}")
+
+class StepLimitExceeded(WhitespaceError):
+    # The program ran for more instructions than it was allowed.
+    pass
+
+class TimeLimitExceeded(WhitespaceError):
+    # The program ran for longer than it was allowed.
+    pass
+
+class Halt(Exception):
+    # Raised when the program stops (see WhitespaceVM.start).
+    pass
+
+class NeedInput(Exception):
+    # Raised by an AsyncIO that has used up the input it was given.
+    pass
+
+class Preempted(Exception):
+    # Raised by a trace of the JIT (see TraceCompiler) or a memoized call
+    # (see Memo) that has used up the steps it was given, to end run_for()
+    # early.  next is the instruction to carry on from.
+
+    def __init__(self, next):
+        super().__init__(next)
+        self.next = next
+
+class Program:
+    # A loaded (tokenized and linked) program, which any number of VMs can
+    # run without loading it again (see load() and WhitespaceVM.use_program).
+
+    def __init__(self, tokens, labels, opcodes, operands, label_names, safe, pure):
+        self.tokens = tokens
+        self.labels = labels
+        self.opcodes = opcodes
+        self.operands = operands
+        self.label_names = label_names
+        self.safe = safe
+        self.pure = pure
+
+class Result:
+    # What run() returns.  output is everything the program wrote (as
+    # bytes), status is 0 when it finished normally and 1 when it stopped
+    # with an error, which is then in error (a WhitespaceError).  steps is
+    # the number of instructions executed and ended is True when the program
+    # stopped with an ENDPROGRAM (rather than by running off its end).
+
+    def __init__(self, output=b"", status=0, error=None, steps=0, ended=False):
+        self.output = output
+        self.status = status
+        self.error = error
+        self.steps = steps
+        self.ended = ended
+
+class PagedHeap:
+    # The heap of a Whitespace program.  Any integer is a valid address
+    # (including negative ones), so rather than one big list the heap is cut
+    # into pages of page_size cells, which are only allocated the first time
+    # something is stored in them.  Reading a cell that was never stored to
+    # gives 0.
+    #
+    # Pages are arrays of 64 bit integers.  When a value doesn't fit in 64
+    # bits, its page is turned into a plain list so it can hold any Python
+    # integer.
+
+    def __init__(self, page_size=HEAP_PAGE_SIZE, max_pages=None):
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError(f"heap page size must be a power of two, not {page_size}")
+        self.page_size = page_size
+        self.shift = page_size.bit_length() - 1  # addr >> shift is the page number
+        self.mask = page_size - 1                # addr & mask is the offset in the page
+        self.max_pages = max_pages               # None means no limit
+        self.pages = {}                          # page number --> page
+        self.zero_page = self.new_page()         # stands in for missing pages on reads
+
+    def new_page(self):
+        return array("q", bytes(8 * self.page_size))
+
+    def __getitem__(self, addr):
+        return self.pages.get(addr >> self.shift, self.zero_page)[addr & self.mask]
+
+    def __setitem__(self, addr, val):
+        try:
+            self.pages[addr >> self.shift][addr & self.mask] = val
+        except (KeyError, OverflowError):
+            self.store(addr, val)
+
+    def store(self, addr, val):
+        # The slow path of storing a value, for when its page doesn't exist
+        # yet or can't hold it.
+        number = addr >> self.shift
+        page = self.pages.get(number)
+        if page is None:
+            if self.max_pages is not None and len(self.pages) >= self.max_pages:
+                raise ValueError(f"HEAP FULL : cannot store at address {addr}, "
+                                 f"all {self.max_pages} pages are in use")
+            page = self.pages[number] = self.new_page()
+        try:
+            page[addr & self.mask] = val
+        except OverflowError:
+            page = self.pages[number] = list(page)
+            page[addr & self.mask] = val
+
+    def high_water(self):
+        # Returns the highest address holding a non-zero value, or None.
+        for number in sorted(self.pages, reverse=True):
+            page = self.pages[number]
+            for offset in range(self.page_size - 1, -1, -1):
+                if page[offset]:
+                    return (number << self.shift) + offset
+        return None
+
+    def stats(self):
+        # Returns a short description of how much of the heap is in use.
+        big = sum(1 for page in self.pages.values() if type(page) is list)
+        return (f"heap: {len(self.pages)} pages of {self.page_size} cells "
+                f"({big} holding big integers), high-water mark: {self.high_water()}")
+
+class WhitespaceIO:
+    # The input and output of a Whitespace program, as bytes.
+    #
+    # Output collects in a buffer that is written out when it gets big, when
+    # the program needs more input (so that a prompt shows up before we wait
+    # for the answer) and when the program ends.  Input is read from a binary
+    # stream in chunks of whatever is available.  INCH gets one byte at a
+    # time (newlines included) and -1 once the input is used up.  INNUM skips
+    # leading whitespace and reads the rest of the line as a number.
+    #
+    # Either stream may be None: no input behaves like an empty file, and no
+    # output is simply collected in self.out until someone takes it.
+
+    # whether OUTCH may append ASCII characters to self.out itself, rather
+    # than call write_char (subclasses that look at every character don't)
+    direct = True
+
+    def __init__(self, input=None, output=None, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.input = input
+        self.output = output
+        self.buffer_size = buffer_size
+        self.out = bytearray()  # output not yet written
+        self.inbuf = b""        # input read but not used yet ...
+        self.inpos = 0          # ... starting at this position
+        self.used = 0           # input used before self.inbuf
+        self.eof = input is None
+
+    def write_char(self, n):
+        try:
+            self.out += chr(n).encode("utf-8")
+        except (ValueError, OverflowError):
+            raise ValueError(f"CANNOT OUTPUT CHARACTER {n}")
+        if len(self.out) >= self.buffer_size:
+            self.flush()
+
+    def write_num(self, n):
+        self.out += str(n).encode("ascii")
+        if len(self.out) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.output is not None and self.out:
+            self.output.write(self.out)
+            self.output.flush()
+            self.out.clear()
+
+    def reset(self, input=None):
+        # Starts over with the input stream input, and no output.
+        self.input = input
+        self.out.clear()
+        self.inbuf = b""
+        self.inpos = 0
+        self.used = 0
+        self.eof = input is None
+
+    def fill(self):
+        # Reads the next chunk of input.  Returns False at end of input.
+        if self.eof:
+            return False
+        self.flush()
+        read = getattr(self.input, "read1", self.input.read)
+        data = read(INPUT_CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.used += self.inpos
+        self.inbuf = self.inbuf[self.inpos:] + data
+        self.inpos = 0
+        return True
+
+    def position(self):
+        # Returns the number of bytes of input used so far.
+        return self.used + self.inpos
+
+    def skip(self, count):
+        # Skips count bytes of input.  Returns False if the input ends first.
+        while count > 0:
+            if self.inpos >= len(self.inbuf) and not self.fill():
+                return False
+            n = min(count, len(self.inbuf) - self.inpos)
+            self.inpos += n
+            count -= n
+        return True
+
+    def read_char(self):
+        if self.inpos >= len(self.inbuf) and not self.fill():
+            return -1
+        self.inpos += 1
+        return self.inbuf[self.inpos - 1]
+
+    def read_num(self):
+        # skip whitespace (so a number can follow a character read on its own line)
+        while True:
+            if self.inpos >= len(self.inbuf) and not self.fill():
+                raise ValueError("END OF INPUT WHILE READING A NUMBER")
+            if self.inbuf[self.inpos] not in b" \t\r\n":
+                break
+            self.inpos += 1
+        # then take everything up to the end of the line
+        while True:
+            end = self.inbuf.find(b"\n", self.inpos)
+            if end >= 0 or not self.fill():
+                break
+        if end < 0:
+            end = len(self.inbuf)
+        text = self.inbuf[self.inpos:end]
+        self.inpos = min(end + 1, len(self.inbuf))
+        try:
+            return int(text)
+        except ValueError:
+            raise ValueError(f"BAD NUMBER INPUT {text.decode('utf-8', 'replace')!r}")
+
+class AsyncIO(WhitespaceIO):
+    # The input and output of a program run by WhitespaceVM.execute_async().
+    # Rather than reading from a stream and blocking, it raises NeedInput
+    # when it runs out of input, and execute_async() then awaits receive()
+    # to get more from reader, which is anything with a coroutine read(n)
+    # (like an asyncio.StreamReader).  The output collects in self.out, and
+    # send() writes it to writer, which is anything with write() and a
+    # coroutine drain() (like an asyncio.StreamWriter).  Without a writer
+    # the output is simply kept in self.out.
+
+    def __init__(self, reader=None, writer=None, buffer_size=OUTPUT_BUFFER_SIZE):
+        super().__init__(None, None, buffer_size)
+        self.reader = reader
+        self.writer = writer
+        self.eof = reader is None
+
+    def fill(self):
+        if self.eof:
+            return False
+        raise NeedInput
+
+    async def receive(self):
+        data = await self.reader.read(INPUT_CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return
+        self.used += self.inpos
+        self.inbuf = self.inbuf[self.inpos:] + data
+        self.inpos = 0
+
+    async def send(self):
+        if self.out and self.writer is not None:
+            self.writer.write(bytes(self.out))
+            self.out.clear()
+            await self.writer.drain()
+
+class IORecorder(WhitespaceIO):
+    # A WhitespaceIO that also writes down, in log (a text stream), every
+    # byte of input the program takes and all of its output, with the number
+    # of instructions executed before each, so that IOReplayer can play the
+    # run back.  The log is JSON lines: first {"program": hash of the source},
+    # then {"step": s, "in": text} for every INCH and INNUM (text is empty at
+    # the end of the input), {"step": s, "out": text} for the output written
+    # between two of them, and last {"step": s, "end": ..., "error": ...}
+    # saying how the program stopped.  Bytes are written as latin-1 text, so
+    # that any bytes survive.
+    #
+    # WhitespaceVM.start() hands the VM over in self.vm, for its step count,
+    # and makes sure that the count is exact at every I/O instruction.
+
+    direct = False
+
+    def __init__(self, input, output, log, source):
+        super().__init__(input, output)
+        self.log = log
+        self.vm = None
+        self.taken = bytearray()    # all the input read so far (see position())
+        self.pending = None         # (step, bytes) of the output not logged yet
+        self.write_event({"program": source_hash(source)})
+
+    def write_event(self, event):
+        self.log.write(json.dumps(event) + "\n")
+
+    def step(self):
+        return 0 if self.vm is None else self.vm.steps
+
+    def log_output(self, data):
+        if self.pending is None:
+            self.pending = (self.step(), bytearray())
+        self.pending[1].extend(data)
+
+    def log_input(self, start):
+        self.flush_log()
+        data = self.taken[start:self.position()]
+        self.write_event({"step": self.step(), "in": data.decode("latin-1")})
+
+    def flush_log(self):
+        if self.pending is not None:
+            step, data = self.pending
+            self.write_event({"step": step, "out": data.decode("latin-1")})
+            self.pending = None
+
+    def finish(self, ended, error=None):
+        # Writes the end of the run: whether the program stopped with
+        # ENDPROGRAM, and the error that stopped it, if any.
+        self.flush_log()
+        self.write_event({"step": self.step(), "end": ended,
+                          "error": None if error is None else f"{error.kind} : {error.message}"})
+        self.log.flush()
+
+    def write_char(self, n):
+        super().write_char(n)
+        self.log_output(chr(n).encode("utf-8"))
+
+    def write_num(self, n):
+        super().write_num(n)
+        self.log_output(str(n).encode("ascii"))
+
+    def fill(self):
+        unused = len(self.inbuf) - self.inpos
+        if not super().fill():
+            return False
+        self.taken += self.inbuf[unused:]
+        return True
+
+    def read_char(self):
+        start = self.position()
+        try:
+            return super().read_char()
+        finally:
+            self.log_input(start)
+
+    def read_num(self):
+        start = self.position()
+        try:
+            return super().read_num()
+        finally:
+            self.log_input(start)
+
+class IOReplayer(WhitespaceIO):
+    # A WhitespaceIO that plays back a log written by IORecorder, with no
+    # terminal involved: the program gets the recorded input, and its output
+    # is checked against the recorded output as it is written (it is still
+    # written to output too).  Output that differs raises a ValueError, which
+    # stops the program at the instruction that wrote it.  difference() then
+    # compares the way the program stopped with the recording.
+    #
+    # The recorded step numbers say where the output went wrong.  They are
+    # not checked, as --optimize (for one) changes the number of steps.
+
+    direct = False
+
+    def __init__(self, log, output=None, source=None):
+        try:
+            header = json.loads(log.readline())
+            events = [json.loads(line) for line in log]
+        except ValueError:
+            raise ValueError("not a recording")
+        if not isinstance(header, dict) or "program" not in header:
+            raise ValueError("not a recording")
+        if source is not None and header["program"] != source_hash(source):
+            raise ValueError("the recording is of another program")
+        inputs = []
+        self.expected = bytearray()     # the recorded output
+        self.offsets = []               # where each recorded write starts in it ...
+        self.steps = []                 # ... and the step it was made at
+        self.end = None                 # the end of the run, if it was recorded
+        self.reads_left = 0             # INCH and INNUM the program has to go
+        for event in events:
+            if "in" in event:
+                inputs.append(event["in"].encode("latin-1"))
+                self.reads_left += 1
+            elif "out" in event:
+                self.offsets.append(len(self.expected))
+                self.steps.append(event["step"])
+                self.expected += event["out"].encode("latin-1")
+            elif "end" in event:
+                self.end = event
+        # the step of the last event: the length of the run, if it has an end
+        self.recorded_steps = events[-1]["step"] if events else 0
+        super().__init__(BytesIO(b"".join(inputs)), output)
+        self.checked = 0                # how much of the output matched so far
+
+    def check(self, data):
+        start = self.checked
+        if self.expected[start:start + len(data)] != data:
+            pos = start
+            while pos < len(self.expected) and self.expected[pos] == data[pos - start]:
+                pos += 1
+            if pos >= len(self.expected):
+                raise ValueError(f"OUTPUT GOES ON PAST THE RECORDING AT BYTE {pos}")
+            step = self.steps[bisect.bisect_right(self.offsets, pos) - 1]
+            raise ValueError(f"OUTPUT DIFFERS FROM THE RECORDING AT BYTE {pos} "
+                             f"(RECORDED AT STEP {step})")
+        self.checked += len(data)
+
+    def write_char(self, n):
+        super().write_char(n)
+        self.check(chr(n).encode("utf-8"))
+
+    def read_char(self):
+        self.count_read()
+        return super().read_char()
+
+    def read_num(self):
+        self.count_read()
+        return super().read_num()
+
+    def count_read(self):
+        # the recorded run may have stopped (or been stopped) waiting for
+        # input, and past its last read this one would only see the end of
+        # the input
+        if self.reads_left == 0:
+            raise ValueError("INPUT READ PAST THE END OF THE RECORDING")
+        self.reads_left -= 1
+
+    def write_num(self, n):
+        super().write_num(n)
+        self.check(str(n).encode("ascii"))
+
+    def difference(self, ended, error=None):
+        # Returns how the end of the replay differs from the end of the
+        # recording, or None when it doesn't.
+        if self.end is None:
+            return "the recording has no end"
+        error = None if error is None else f"{error.kind} : {error.message}"
+        if error != self.end["error"]:
+            return f"it ended with {self.end['error'] or 'no error'}"
+        if self.checked < len(self.expected):
+            return f"the output stopped at byte {self.checked} of {len(self.expected)}"
+        if ended != self.end["end"]:
+            return "it ended with ENDPROGRAM" if self.end["end"] else "it ran off the end"
+        return None
+
+class DebugTracer:
+    # A trace hook (see WhitespaceVM.execute_traced) that describes every
+    # instruction, and the stack it finds, on a text file.
+    #
+    # Tracing huge runs is only practical for part of the program, so the
+    # tracer can be told to start when the program reaches the MARK of one
+    # label (start_label) and to stop when it reaches the MARK of another one
+    # (stop_label).  Labels are given the way --describe shows them.
+
+    def __init__(self, vm, file, start_label=None, stop_label=None):
+        self.vm = vm
+        self.file = file
+        self.start = vm.find_label(start_label) if start_label is not None else None
+        self.stop = vm.find_label(stop_label) if stop_label is not None else None
+        self.active = start_label is None
+        self.last = -1      # the instruction traced last
+        # interleave the trace with the program's output when both go to the
+        # terminal
+        self.interleave = file is sys.stdout
+
+    def __call__(self, i, op, arg, stack):
+        if i == self.start:
+            self.active = True
+        elif i == self.stop:
+            self.active = False
+        if not self.active:
+            return
+        if self.interleave:
+            self.vm.io.flush()
+        if i != self.last + 1:
+            print(f"  Continuing at instruction #{i}", file=self.file)
+        self.last = i
+        if op in self.vm.LABEL_OPS:
+            arg = self.vm.label_name(arg)
+        items = ",".join([str(item) for item in reversed(stack)])
+        print(f"#{i} {op} {arg} stack=[{items}]", file=self.file, flush=self.interleave)
+
+class Profiler:
+    # A trace hook (see WhitespaceVM.execute_traced) that finds out where a
+    # program spends its time.  It counts the instructions executed per
+    # instruction, per operation and per label region (the code from one MARK
+    # up to the next), the calls and the inclusive and exclusive steps of
+    # every subroutine (by the label it is called with), the peak stack and
+    # call depths, and the heap cells used.
+    #
+    # With sample > 1 the hook is only called on every sample-th instruction
+    # (see WhitespaceVM.execute_traced) and every call stands for sample
+    # instructions.  Subroutine steps are then worked out from the return
+    # addresses at each sample, and calls can't be counted.
+
+    def __init__(self, vm, sample=1):
+        self.vm = vm
+        self.sample = sample
+        self.steps = 0                              # instructions seen
+        self.counts = [0] * len(vm.tokens)          # per instruction
+        self.calls = {}                             # label --> number of calls
+        self.inclusive = {}                         # label --> steps in it and what it calls
+        self.exclusive = {}                         # label --> steps in it alone
+        self.frames = []                            # [label, steps at call, steps of callees]
+        self.active = {}                            # label --> frames open for it
+        self.peak_stack = 0
+        self.peak_calls = 0
+        self.heap_cells = set()
+
+        # the label region of every instruction
+        self.regions = []
+        region = "(start)"
+        for token in vm.tokens:
+            if token.op == "MARK":
+                region = vm.label_name(token.arg)
+            self.regions.append(region)
+
+    def __call__(self, i, op, arg, stack):
+        self.steps += 1
+        self.counts[i] += 1
+        if len(stack) > self.peak_stack:
+            self.peak_stack = len(stack)
+        if op in self.HEAP_OPS:
+            self.heap_access(op, arg, stack)
+        if self.sample == 1:
+            if op == "CALL":
+                self.enter(arg)
+            elif op == "RETURN" and self.frames:
+                self.leave()
+        else:
+            self.attribute_sample()
+
+    HEAP_OPS = ("STORE", "RETRIEVE", "INCH", "INNUM", "LOAD_IMM")
+
+    def heap_access(self, op, arg, stack):
+        if op == "LOAD_IMM":
+            self.heap_cells.add(arg)
+        elif op == "STORE":
+            if len(stack) >= 2:
+                self.heap_cells.add(stack[-2])
+        elif stack:
+            self.heap_cells.add(stack[-1])
+
+    def enter(self, label):
+        self.calls[label] = self.calls.get(label, 0) + 1
+        self.frames.append([label, self.steps, 0])
+        self.active[label] = self.active.get(label, 0) + 1
+        if len(self.frames) > self.peak_calls:
+            self.peak_calls = len(self.frames)
+
+    def leave(self):
+        # called on RETURN, which counts as a step of the subroutine
+        label, start, callees = self.frames.pop()
+        steps = self.steps - start
+        self.exclusive[label] = self.exclusive.get(label, 0) + steps - callees
+        self.active[label] -= 1
+        if not self.active[label]:
+            # only the outermost of recursive calls counts as inclusive
+            self.inclusive[label] = self.inclusive.get(label, 0) + steps
+        if self.frames:
+            self.frames[-1][2] += steps
+
+    def attribute_sample(self):
+        vm = self.vm
+        if len(vm.return_addrs) > self.peak_calls:
+            self.peak_calls = len(vm.return_addrs)
+        seen = set()
+        for addr in vm.return_addrs:
+            # the CALL that pushed addr sits just before it
+            label = vm.tokens[addr - 1].arg
+            if label not in seen:
+                seen.add(label)
+                self.inclusive[label] = self.inclusive.get(label, 0) + 1
+        if vm.return_addrs:
+            label = vm.tokens[vm.return_addrs[-1] - 1].arg
+            self.exclusive[label] = self.exclusive.get(label, 0) + 1
+
+    def results(self):
+        # Returns everything the profiler found, as a dictionary (steps are
+        # scaled up to estimates when sampling).
+        while self.frames:
+            self.steps += 1 # subroutines that never returned
+            self.leave()
+            self.steps -= 1
+        scale = self.sample
+        tokens = self.vm.tokens
+        by_op = {}
+        by_region = {}
+        for i, count in enumerate(self.counts):
+            if count:
+                by_op[tokens[i].op] = by_op.get(tokens[i].op, 0) + count * scale
+                by_region[self.regions[i]] = by_region.get(self.regions[i], 0) + count * scale
+        subroutines = {}
+        for label in set(self.calls) | set(self.inclusive) | set(self.exclusive):
+            subroutines[self.vm.label_name(label)] = {
+                "calls": self.calls.get(label) if scale == 1 else None,
+                "inclusive": self.inclusive.get(label, 0) * scale,
+                "exclusive": self.exclusive.get(label, 0) * scale,
+            }
+        return {
+            "steps": self.steps * scale,
+            "sample": scale,
+            "peak_stack_depth": self.peak_stack,
+            "peak_call_depth": self.peak_calls,
+            "heap_cells_touched": len(self.heap_cells),
+            "operations": by_op,
+            "regions": by_region,
+            "subroutines": subroutines,
+            "instructions": {i: count * scale for i, count in enumerate(self.counts) if count},
+        }
+
+    def report(self, file, top=20):
+        # Prints the results, busiest first.
+        results = self.results()
+        steps = results["steps"] or 1
+        sampled = f" (sampled every {self.sample})" if self.sample > 1 else ""
+        print(f"\nPROFILE: {results['steps']} instructions{sampled}", file=file)
+        print(f"  peak stack depth {results['peak_stack_depth']}, "
+              f"peak call depth {results['peak_call_depth']}, "
+              f"heap cells touched {results['heap_cells_touched']}", file=file)
+        print("By operation:", file=file)
+        for op, count in sorted(results["operations"].items(), key=lambda x: -x[1]):
+            print(f"  {count:12} {100 * count / steps:6.2f}%  {op}", file=file)
+        print("By label region:", file=file)
+        for region, count in sorted(results["regions"].items(), key=lambda x: -x[1])[:top]:
+            print(f"  {count:12} {100 * count / steps:6.2f}%  {region}", file=file)
+        print("By subroutine:        calls    inclusive    exclusive", file=file)
+        subroutines = results["subroutines"].items()
+        for label, sub in sorted(subroutines, key=lambda x: -x[1]["inclusive"])[:top]:
+            calls = "-" if sub["calls"] is None else sub["calls"]
+            print(f"  {calls:>19} {sub['inclusive']:12} {sub['exclusive']:12}  {label}", file=file)
+        print("Hottest instructions:", file=file)
+        tokens = self.vm.tokens
+        for i, count in sorted(results["instructions"].items(), key=lambda x: -x[1])[:top]:
+            print(f"  {count:12} {100 * count / steps:6.2f}%  "
+                  f"#{i} {tokens[i].op} {self.vm.shown_arg(tokens[i])}", file=file)
+
+class ProgramCache:
+    # An on-disk cache of linked programs, so that a program that was
+    # loaded before doesn't have to be tokenized, optimized and linked again.
+    #
+    # Each entry is a file named after a hash of the source code, the
+    # options that change the linked program, and this interpreter's own
+    # source (so that any change to the interpreter invalidates the cache).
+    # The entry holds the tokens, labels, opcodes and operands, serialized
+    # with marshal.  Entries are written to a temporary file that is then
+    # renamed into place, so runners sharing the directory never see half
+    # written entries.  An entry that can't be read is simply ignored.
+
+    MAGIC = b"WSC3"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.parse_time = 0.0   # how long loading took the first time, for a hit
+
+    def path(self, vm):
+        h = hashlib.sha256()
+        h.update(self.interpreter_hash())
+        h.update(b"optimize" if vm.optimize_flag else b"plain")
+        h.update(vm.code.encode("utf-8", "surrogatepass"))
+        return os.path.join(self.directory, h.hexdigest() + ".wsc")
+
+    _interpreter_hash = None
+
+    @classmethod
+    def interpreter_hash(cls):
+        if cls._interpreter_hash is None:
+            with open(__file__, "rb") as f:
+                cls._interpreter_hash = hashlib.sha256(f.read()).digest()
+        return cls._interpreter_hash
+
+    def load(self, vm):
+        # Fills in vm from the cache.  Returns False when there's no entry.
+        try:
+            with open(self.path(vm), "rb") as f:
+                data = f.read()
+            if not data.startswith(self.MAGIC):
+                return False
+            (parse_time, opcodes, operands, args, labels, label_names, safe, pure) = \
+                marshal.loads(data[len(self.MAGIC):])
+        except (OSError, ValueError, EOFError, TypeError):
+            return False
+        names = vm.OPNAMES
+        Token = vm.Token
+        vm.tokens = [Token(names[op], arg) for op, arg in zip(opcodes, args)]
+        vm.opcodes = opcodes
+        vm.operands = operands
+        vm.labels = labels
+        vm.label_names = label_names
+        vm.safe = safe
+        vm.pure = pure
+        self.parse_time = parse_time
+        return True
+
+    def save(self, vm, parse_time):
+        data = marshal.dumps((parse_time, vm.opcodes, vm.operands,
+                              [token.arg for token in vm.tokens], vm.labels,
+                              vm.label_names, vm.safe, vm.pure))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.MAGIC + data)
+                os.replace(temp, self.path(vm))
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            print(f"warning: could not write to the program cache: {e}", file=sys.stderr)
+
+class Checkpoints:
+    # Writes snapshots of a running VM to a file, so that the run can be
+    # carried on from the last of them (see read() and WhitespaceVM.restore)
+    # after it was stopped, or crashed, or on another machine.
+    #
+    # The file is MAGIC followed by one record per snapshot: 4 bytes of
+    # length, then the marshal data of a dictionary with the hash of the
+    # program, whether it was optimized, the number of steps run, the next
+    # instruction, the stack, the return addresses, the input used so far
+    # and the heap pages that changed since the snapshot before.  Records are
+    # only ever appended, so a crash while writing one only loses that one.
+    # Every CHECKPOINT_COMPACT snapshots the file is written anew (to a
+    # temporary file that then takes its place), starting with a record that
+    # holds the whole heap.
+
+    MAGIC = b"WSS1"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = 0        # records in the file, since it was written anew
+        self.saved = {}         # page number --> copy of the page as last written
+
+    def write(self, vm):
+        vm.io.flush()   # what was written before the snapshot stays written
+        full = self.records == 0 or self.records >= CHECKPOINT_COMPACT
+        if full:
+            self.saved = {}
+        saved = self.saved
+        pages = {}
+        for number, page in vm.heap.pages.items():
+            if saved.get(number) != page:
+                if type(page) is list:
+                    pages[number] = saved[number] = list(page)
+                else:
+                    saved[number] = array("q", page)
+                    pages[number] = page.tobytes()
+        data = marshal.dumps({"program": source_hash(vm.code), "optimize": vm.optimize_flag,
+                              "steps": vm.steps, "pc": vm.pc, "stack": vm.stack,
+                              "return_addrs": vm.return_addrs, "input": vm.io.position(),
+                              "page_size": vm.heap.page_size, "pages": pages})
+        record = len(data).to_bytes(4, "little") + data
+        if full:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.MAGIC + record)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.filename)
+            except BaseException:
+                os.unlink(temp)
+                raise
+            self.records = 1
+        else:
+            with open(self.filename, "ab") as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records += 1
+
+    @classmethod
+    def read(cls, filename):
+        # Returns the last snapshot in the file, with all the heap pages
+        # that were written before it.  A record cut short (by a crash) and
+        # anything after it are ignored.  Raises OSError when the file can't
+        # be read, and ValueError when it holds no snapshot.
+        with open(filename, "rb") as f:
+            data = f.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("not a snapshot")
+        state = None
+        pages = {}
+        pos = len(cls.MAGIC)
+        while pos + 4 <= len(data):
+            size = int.from_bytes(data[pos:pos + 4], "little")
+            if pos + 4 + size > len(data):
+                break
+            try:
+                record = marshal.loads(data[pos + 4:pos + 4 + size])
+            except (ValueError, EOFError, TypeError):
+                break
+            pages.update(record["pages"])
+            state = record
+            pos += 4 + size
+        if state is None:
+            raise ValueError("no complete snapshot in the file")
+        state["pages"] = pages
+        return state
+
 class WhitespaceVM:
 
     OPERATIONS = {
@@ -38,60 +953,94 @@ class WhitespaceVM:
         "INCH":       TAB   + LF    + TAB   + SPACE,
         "INNUM":      TAB   + LF    + TAB   + TAB
     }
+    OP_TRIE = build_trie(OPERATIONS)
+    # Superinstructions are never written in Whitespace.  They only appear
+    # after optimize() has fused a sequence of ordinary operations:
+    #   ADD_IMM n   top of stack += n     (PUSH n; ADD  or  PUSH -n; SUBTRACT)
+    #   MUL_IMM n   top of stack *= n     (PUSH n; MULTIPLY)
+    #   LOAD_IMM a  push heap[a]          (PUSH a; RETRIEVE)
+    #   DUP_JZ l    jump to l if top == 0, without popping  (DUPLICATE; JUMPZERO l)
+    #   DUP_JN l    jump to l if top < 0, without popping   (DUPLICATE; JUMPNEG l)
+    SUPERINSTRUCTIONS = ("ADD_IMM", "MUL_IMM", "LOAD_IMM", "DUP_JZ", "DUP_JN")
+    LABEL_OPS = ("MARK", "CALL", "JUMP", "JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN")
+    NUMBER_OPS = ("PUSH", "COPY", "SLIDE", "ADD_IMM", "MUL_IMM", "LOAD_IMM")
+    OPNAMES = list(OPERATIONS) + list(SUPERINSTRUCTIONS)
+    OPCODES = {name: opcode for opcode, name in enumerate(OPNAMES)}
+    TOKEN_RE, TOKEN_GROUPS, TOKEN_START_RE = build_token_patterns(OPERATIONS, OPCODES,
+                                                                  LABEL_OPS, NUMBER_OPS)
+    # finds the label operations in the opcodes of a program, as bytes
+    LABEL_OP_RE = re.compile(b"[" + re.escape(bytes(map(OPCODES.get, LABEL_OPS))) + b"]")
+    IMPURE_OPS = ("STORE", "RETRIEVE", "LOAD_IMM", "INCH", "INNUM", "OUTCH", "OUTNUM",
+                  "ENDPROGRAM")
+    # the operations that leave at least one item on the stack when they work
+    LEAVE_TOP_OPS = ("PUSH", "DUPLICATE", "COPY", "SWAP", "ADD", "SUBTRACT", "MULTIPLY",
+                     "DIVIDE", "MODULO", "RETRIEVE", "ADD_IMM", "MUL_IMM", "LOAD_IMM")
+    FLOW_OPS = ("CALL", "JUMP", "JUMPZERO", "JUMPNEG", "RETURN", "ENDPROGRAM",
+                "DUP_JZ", "DUP_JN")
 
     class Token:
+        __slots__ = ("op", "arg")
+
         def __init__(self, op="", arg=""):
             self.op = op
             self.arg = arg
 
-    def __init__(self, code='', heapsize=HEAPSIZE):
+    def __init__(self, code='', heap_page_size=HEAP_PAGE_SIZE, heap_max_pages=None, io=None):
         self.ip = 0                 # instruction pointer
         self.code = code            # string containing Whitespace code
-        self.stack = deque()        # the internal data stack
+        self.stack = []             # the internal data stack (top is the last item)
         self.tokens = []            # contains the instructions after tokenizing
-        self.heap = [0] * heapsize  # memory heap
+        self.heap = PagedHeap(heap_page_size, heap_max_pages) # memory heap
         self.labels = {}            # dictionary of label,addr pairs for flow
-        self.return_addrs = deque() # where to go back to when subroutine ends
-        self.input_stream = ""      # a buffer to hold input
-        self.next_input = 0         # the next thing to read from the stream
+        self.label_names = {}       # label --> name, for labels not shown as S and T
+        self.opcodes = []           # the opcode of each instruction, after linking
+        self.operands = []          # the argument of each instruction, after linking
+        self.safe = []              # whether each instruction is in a safe block (see Verifier)
+        self.pure = {}              # the pure subroutines (see pure_subroutines)
+        self.compiled_lines = {}    # file name of compiled code --> {line: instruction}
+        self.return_addrs = []      # where to go back to when subroutine ends
+        self.max_call_depth = MAX_CALL_DEPTH # how deep subroutine calls can nest
+        if io is None:              # the program's input and output
+            io = WhitespaceIO(sys.stdin.buffer, sys.stdout.buffer)
+        self.io = io
         self.debug_flag = False     # flag to control debug statements
         self.describe_flag = False  # flag to control whether we describe the source
+        self.compile_flag = False   # flag to run the program as compiled Python
+        self.jit_flag = False       # flag to compile the hot loops as the program runs
+        self.jit = None             # the Jit, with jit_flag
+        self.memo_flag = True       # flag to memoize the pure subroutines
+        self.memo = None            # the Memo, with memo_flag
+        self.memo_stats_flag = False # flag to report how memoizing went at the end
+        self.optimize_flag = False  # flag to run the peephole optimizer
+        self.heap_stats_flag = False # flag to report heap usage at the end
+        self.debug_file = sys.stdout # where debug statements go
+        self.trace_hook = None      # called before every instruction (see execute_traced)
+        self.trace_from = None      # with debug_flag, only trace from this label ...
+        self.trace_to = None        # ... up to this one
+        self.profile_flag = False   # flag to profile the program
+        self.profile_sample = 1     # when profiling, only look at every n-th step
+        self.profile_json = ""      # file to write the profile to, as JSON
+        self.profiler = None        # the Profiler, when profiling
+        self.cache = None           # the ProgramCache, if any
+        self.load_processes = None  # processes tokenize_chunked() uses (None: one per CPU)
+        self.max_steps = None       # instructions run() may execute (None: no limit)
+        self.time_limit = None      # seconds run() may run for (None: no limit)
+        self.checkpoints = None     # the Checkpoints that execute() writes snapshots to
+        self.checkpoint_every = CHECKPOINT_EVERY # instructions between snapshots
+        self.resume_from = None     # snapshot (see Checkpoints.read) that start() restores
+        self.timing_flag = False    # flag to report how long loading and running took
+        self.steps = 0              # instructions executed (counted by execute() only)
+        self.ended = False          # whether the program stopped with ENDPROGRAM
+        self.pc = 0                 # the next instruction run_for() executes
+        self.budget = 0             # steps the JIT's traces may still run in this run_for()
+        self.halted = False         # whether the program has stopped
+        self.funcs = None           # the handler of every instruction (see prepare)
 
-    def debug_token(self, token):
-        self.debug(f"{token.op} {token.arg}", showstack=True)
-
-    def debug(self, str, end='\n', showstack=False):
+    def debug(self, str, end='\n'):
         if (self.debug_flag):
-            print(str, end="")
-            if showstack:
-                s = "["
-                sep = ""
-                for item in self.stack:
-                    s = f"{s}{sep}{item}"
-                    sep = ","
-                print(f" stack={s}]")
-            else:
-                print("", end=end)
-
-    def strip_comments(self):
-        # since comments can be ANYWHERE, including in the middle of the
-        # string of characters that represents a command, I decided the
-        # easiest thing to do was to kill all the comments before parsing
-        self.debug("Stripping comments ...")
-        self.code = "".join([ch for ch in self.code if ch in (SPACE, TAB, LF)])
-
-    def user_input(self):
-        # read one character at a time from stdin.
-        # can handle case where user types more than 1 character
-        # by buffering the input into an input stream, and subsequetly
-        # getting input from there until no more characters are left there.
-        if self.next_input >= len(self.input_stream):
-            self.next_input = 0
-            self.input_stream = input()
-
-        retval = self.input_stream[self.next_input]
-        self.next_input += 1
-        return retval
+            # flushed right away, so it can't get out of order with the
+            # program's own (binary) output
+            print(str, end=end, file=self.debug_file, flush=True)
 
     def unwhite(self, s, max=-1):
         # Converts whitespace to letters, and converts everything else
@@ -102,213 +1051,1044 @@ class WhitespaceVM:
         if max >= 0: return ret[:max]
         else: return ret
 
-    def parse_arg(self, operation):
-        if operation in ("MARK", "CALL", "JUMP", "JUMPNEG", "JUMPZERO"):
-            label = ""
-            while self.ip < len(self.code) and self.code[self.ip] != LF:
-                label += self.code[self.ip]
-                self.ip += 1
-            # not sure if python can index a dictionary with whitespace characters
-            # so I'll "unwhite" the labels first.  it will be easier to read
-            # during debug or describe mode anyway.
-            label = self.unwhite(label)
-            self.ip += 1
-            return label
-
-        elif operation in ("PUSH", "COPY", "SLIDE"):
-            num = 0
-            mult = 0
-            if self.code[self.ip] == SPACE:
-                # start of positive number
-                mult = 1
-            elif self.code[self.ip] == TAB:
-                # start of negative number
-                mult = -1
-            else:
-                exit("SYNTAX ERROR : BAD SIGN")
-
-            self.ip = self.ip + 1
-            while self.ip < len(self.code) and self.code[self.ip] != LF:
-                # about to add a new digit, so left shift the digits we have so far
-                num = num << 1
-                if self.code[self.ip] == TAB:
-                    # found a 1
-                    num = num | 1
-                elif self.code[self.ip] == SPACE:
-                    # found a 0 (the left shift already put a zero in there)
-                    pass
-                else:
-                    exit("SYNTAX ERROR : BAD NUMBER")
-                self.ip = self.ip + 1
-            self.ip = self.ip + 1 # ip now points to the character after the LF
-
-            return num * mult
-        else:
-            return ""
+    def label_name(self, label):
+        # Returns the label (an id, see label_id) the way --describe shows it.
+        if label in self.label_names:
+            return self.label_names[label]
+        return label_text(label)
 
-    def is_op(self, candidate):
-        left = len(self.code) - self.ip
+    def find_label(self, name):
+        # Returns the index of the MARK of the label shown as name, or None.
+        for label, label_name in self.label_names.items():
+            if label_name == name:
+                return self.labels.get(label)
+        if name.strip("ST"):
+            return None
+        return self.labels.get(label_id(name))
 
-        if left < len(candidate):
-            # return false when there aren't enough chars left for this candidate
-            return False
-        elif self.code[self.ip:self.ip+len(candidate)] == candidate:
-            # the current code matches the candidate we're looking for
-            # so return true and move the instruction pointer so that
-            # it points to the character after the instruction
-            self.ip = self.ip + len(candidate)
-            return True
-        else:
-            # we didn't find the candidate here
-            return False
+    def shown_arg(self, token):
+        # Returns the argument of the token the way --describe shows it.
+        if token.op in self.LABEL_OPS:
+            return self.label_name(token.arg)
+        return token.arg
 
     def describe(self):
         for token in self.tokens:
-            print(f"{token.op} {token.arg}")
+            print(f"{token.op} {self.shown_arg(token)}")
+        Verifier(self).report(sys.stdout)
+
+    def optimize(self):
+        # A peephole optimizer over the tokens.  Every token is appended to
+        # a new list, and then the tail of that list is rewritten for as long
+        # as one of the rules below matches it:
+        #   PUSH a; PUSH b; ADD         -->  PUSH a+b   (and the other arithmetic)
+        #   PUSH b; ADD                 -->  ADD_IMM b
+        #   PUSH b; SUBTRACT            -->  ADD_IMM -b
+        #   PUSH b; MULTIPLY            -->  MUL_IMM b
+        #   PUSH a; ADD_IMM b           -->  PUSH a+b   (and MUL_IMM)
+        #   ADD_IMM a; ADD_IMM b        -->  ADD_IMM a+b  (and MUL_IMM)
+        #   ADD_IMM 0  or  MUL_IMM 1    -->  (nothing), after an instruction
+        #                                    that leaves something on the stack
+        #   PUSH a; RETRIEVE            -->  LOAD_IMM a
+        #   PUSH a; DISCARD             -->  (nothing)
+        #   PUSH a; JUMPZERO l          -->  JUMP l  or nothing, depending on a
+        #   PUSH a; JUMPNEG l           -->  JUMP l  or nothing, depending on a
+        #   DUPLICATE; JUMPZERO l       -->  DUP_JZ l
+        #   DUPLICATE; JUMPNEG l        -->  DUP_JN l
+        # Everything after a JUMP, RETURN or ENDPROGRAM up to the next MARK can
+        # never run, so it is dropped.  A MARK is never part of a rule, so no
+        # code is ever moved across a place that can be jumped to.
+        #
+        # Dropping code can drop the only use of a label, so call
+        # check_labels() first, for a jump to a label that doesn't exist to
+        # be caught all the same.
+        self.debug("Optimizing ...")
+        Token = self.Token
+        folds = {
+            "ADD": lambda a, b: a + b,
+            "SUBTRACT": lambda a, b: a - b,
+            "MULTIPLY": lambda a, b: a * b,
+            "DIVIDE": lambda a, b: a // b,
+            "MODULO": lambda a, b: a % b,
+        }
+        out = []
+        reachable = True
+        for token in self.tokens:
+            if token.op == "MARK":
+                reachable = True
+            if not reachable:
+                continue
+            out.append(token)
+            while len(out) >= 2:
+                last, prev = out[-1], out[-2]
+                if (last.op in folds and prev.op == "PUSH" and len(out) >= 3
+                        and out[-3].op == "PUSH"
+                        and not (last.op in ("DIVIDE", "MODULO") and prev.arg == 0)):
+                    out[-3:] = [Token("PUSH", folds[last.op](out[-3].arg, prev.arg))]
+                elif prev.op == "PUSH" and last.op == "ADD":
+                    out[-2:] = [Token("ADD_IMM", prev.arg)]
+                elif prev.op == "PUSH" and last.op == "SUBTRACT":
+                    out[-2:] = [Token("ADD_IMM", -prev.arg)]
+                elif prev.op == "PUSH" and last.op == "MULTIPLY":
+                    out[-2:] = [Token("MUL_IMM", prev.arg)]
+                elif prev.op == "PUSH" and last.op == "ADD_IMM":
+                    out[-2:] = [Token("PUSH", prev.arg + last.arg)]
+                elif prev.op == "PUSH" and last.op == "MUL_IMM":
+                    out[-2:] = [Token("PUSH", prev.arg * last.arg)]
+                elif prev.op == last.op == "ADD_IMM":
+                    out[-2:] = [Token("ADD_IMM", prev.arg + last.arg)]
+                elif prev.op == last.op == "MUL_IMM":
+                    out[-2:] = [Token("MUL_IMM", prev.arg * last.arg)]
+                elif ((last.op == "ADD_IMM" and last.arg == 0) or
+                        (last.op == "MUL_IMM" and last.arg == 1)) and prev.op in self.LEAVE_TOP_OPS:
+                    # (on an empty stack it would have failed)
+                    out.pop()
+                elif prev.op == "PUSH" and last.op == "RETRIEVE":
+                    out[-2:] = [Token("LOAD_IMM", prev.arg)]
+                elif prev.op == "PUSH" and last.op == "DISCARD":
+                    del out[-2:]
+                elif prev.op == "PUSH" and last.op in ("JUMPZERO", "JUMPNEG"):
+                    if prev.arg == 0 if last.op == "JUMPZERO" else prev.arg < 0:
+                        out[-2:] = [Token("JUMP", last.arg)]
+                    else:
+                        del out[-2:]
+                elif prev.op == "DUPLICATE" and last.op == "JUMPZERO":
+                    out[-2:] = [Token("DUP_JZ", last.arg)]
+                elif prev.op == "DUPLICATE" and last.op == "JUMPNEG":
+                    out[-2:] = [Token("DUP_JN", last.arg)]
+                else:
+                    break
+            if out and out[-1].op in ("JUMP", "RETURN", "ENDPROGRAM"):
+                reachable = False
+        self.debug(f"  {len(self.tokens)} instructions optimized down to {len(out)}")
+        self.tokens = out
+        self.opcodes = []
+
+    def check_labels(self):
+        # Raises the error link() would for a jump to a label that isn't
+        # marked anywhere.
+        marked = {token.arg for token in self.tokens if token.op == "MARK"}
+        for i, token in enumerate(self.tokens):
+            if token.op in self.LABEL_OPS and token.op != "MARK" and token.arg not in marked:
+                raise WhitespaceError("SYNTAX ERROR", "UNDEFINED LABEL", i,
+                                      token.op, self.label_name(token.arg))
 
     def scan_labels(self):
         # We have to scan the entire program for labels (before execution)
         # otherwise we might encounter a jump-to-label command for a label
-        # that hasn't been encountered yet.
+        # that hasn't been encountered yet.  A label can only be marked once.
         self.debug("Scanning for labels ...")
+        labels = self.labels
         for i, token in enumerate(self.tokens):
             if token.op == "MARK":
-                self.debug(f"  Marking token #{i} with label {token.arg}")
-                self.labels[token.arg] = i
+                if token.arg in labels:
+                    raise WhitespaceError("SYNTAX ERROR",
+                                          f"DUPLICATE LABEL (FIRST MARKED AT INSTRUCTION "
+                                          f"#{labels[token.arg]})", i, token.op,
+                                          self.label_name(token.arg))
+                self.debug(f"  Marking token #{i} with label {self.label_name(token.arg)}")
+                labels[token.arg] = i
 
     def tokenize(self):
         # Converts the code string of incomprehensible whitespace
         # into a nice list of readable tokens for execution (and display).
+        #
+        # This is a single forward pass over the code.  Each character moves
+        # a small state machine: while reading an operation we walk down
+        # OP_TRIE, and once we reach a leaf we read the operation's argument
+        # (if any) up to its terminating LF.  Anything that isn't whitespace
+        # is a comment, and since comments can be ANYWHERE (even in the
+        # middle of an operation or a number) they are simply skipped here.
         self.debug("Tokenizing ...")
-        while self.ip < len(self.code):
-            self.debug(f"  {self.unwhite(self.code[self.ip:], max=45)}")
-            found = False
-            for name, opchars in self.OPERATIONS.items():
-                if self.is_op(opchars):
-                    arg = self.parse_arg(name)
-                    self.debug(f"  Parsed this: {self.unwhite(opchars)}-->{name} {arg}")
-                    token = self.Token(name, arg)
-                    self.tokens.append(token)
-                    found = True
-                    break
-            if not found:
-                exit(f"SYNTAX ERROR : BAD OPERATION : "
-                    f"{self.unwhite(self.code[self.ip:], max=45)}")
+        code = self.code
+        tokens = self.tokens
+        Token = self.Token
+        root = self.OP_TRIE
+        label_ops = self.LABEL_OPS
+        number_ops = self.NUMBER_OPS
+
+        state = IN_OPERATION
+        node = root         # current trie node while reading an operation
+        name = ""           # the operation whose argument we are reading
+        num = 0             # the number read so far
+        mult = 1            # the sign of the number read so far
+        label = 1           # the id of the label read so far (see label_id)
+        chars = iter(code)
+        for ch in chars:
+            if state == IN_OPERATION:
+                nxt = node.get(ch)
+                if nxt is None:
+                    if ch in WHITESPACE:
+                        self.bad_operation(node[""] + ch, chars)
+                    continue # a comment
+                if type(nxt) is dict:
+                    node = nxt
+                    continue
+                node = root
+                name = nxt
+                if name in number_ops:
+                    state = IN_SIGN
+                elif name in label_ops:
+                    state = IN_LABEL
+                else:
+                    tokens.append(Token(name, ""))
+            elif state == IN_LABEL:
+                if ch == LF:
+                    tokens.append(Token(name, label))
+                    label = 1
+                    state = IN_OPERATION
+                elif ch == SPACE:
+                    label <<= 1
+                elif ch == TAB:
+                    label = (label << 1) | 1
+            elif state == IN_NUMBER:
+                if ch == TAB:
+                    num = (num << 1) | 1
+                elif ch == SPACE:
+                    num = num << 1
+                elif ch == LF:
+                    tokens.append(Token(name, num * mult))
+                    state = IN_OPERATION
+            elif ch in WHITESPACE: # state == IN_SIGN
+                if ch == SPACE:
+                    mult = 1
+                elif ch == TAB:
+                    mult = -1
+                else:
+                    raise WhitespaceError("SYNTAX ERROR", "BAD SIGN")
+                num = 0
+                state = IN_NUMBER
+
+        # the last argument is allowed to run into the end of the code,
+        # but an operation or a sign is not.
+        if state == IN_LABEL:
+            tokens.append(Token(name, label))
+        elif state == IN_NUMBER:
+            tokens.append(Token(name, num * mult))
+        elif state == IN_SIGN:
+            raise WhitespaceError("SYNTAX ERROR", "BAD SIGN")
+        elif node is not root:
+            self.bad_operation(node[""], chars)
+        self.ip = len(code)
+
+        if self.debug_flag:
+            for token in tokens:
+                self.debug(f"  Parsed this: {token.op} {self.shown_arg(token)}")
+
+    def tokenize_chunked(self, processes=None):
+        # Tokenizes the code like tokenize() does, a chunk at a time (see
+        # tokenize_chunk), over processes worker processes: one per CPU by
+        # default, and with one the chunks are done in this process.  The
+        # tokens of every chunk are taken from where the token left
+        # unfinished by the chunk before ends, so they are exactly the ones
+        # tokenize() finds.  When that isn't one of the positions the chunk
+        # was tokenized from, or the code has a syntax error, tokenize()
+        # does it all over again (and reports the error).
+        self.debug("Tokenizing in chunks ...")
+        source = self.code.encode("utf-8", "surrogatepass")
+        jobs = [(start, start + TOKENIZE_CHUNK_SIZE)
+                for start in range(0, len(source), TOKENIZE_CHUNK_SIZE)]
+        processes = min(processes or os.cpu_count() or 1, len(jobs))
+        if processes > 1:
+            with multiprocessing.Pool(processes, init_tokenize_worker, (source,)) as pool:
+                done = self.stitch_chunks(pool.imap(tokenize_chunk, jobs))
+        else:
+            init_tokenize_worker(source)
+            try:
+                done = self.stitch_chunks(map(tokenize_chunk, jobs))
+            finally:
+                init_tokenize_worker(b"")
+        if not done:
+            self.tokenize()
+        self.ip = len(self.code)
+
+    def stitch_chunks(self, chunks):
+        # Joins up the opcodes and arguments of the chunks (see
+        # tokenize_chunk), and makes self.tokens out of them, with
+        # self.opcodes to go with them for link().  Returns False when that
+        # has to be left to tokenize().
+        match = self.TOKEN_RE.match
+        all_ops = bytearray()
+        all_args = []
+
+        def add(ops, args):
+            all_ops.extend(ops)
+            all_args.extend(args)
+
+        pending = ""    # the start of a token left unfinished by the last chunk
+        for head, whole, results in chunks:
+            start = 0
+            if pending:
+                text = pending + head
+                m = match(text)
+                if m is None:
+                    if whole and self.TOKEN_START_RE.fullmatch(text):
+                        pending = text  # the token goes on past this chunk too
+                        continue
+                    return False
+                ops, args, _, _ = scan_tokens(text[:m.end()], 0)
+                add(ops, args)
+                start = m.end() - len(pending)
+            if start not in results:
+                return False
+            ops, args, joined, pending = results[start]
+            add(ops, args)
+            if joined is not None:
+                ops, args = results[0][:2]
+                add(ops[joined:], args[joined:])
+            if pending is None:
+                return False
+        if pending:
+            # the last argument is allowed to run into the end of the code
+            vm = WhitespaceVM(pending.translate(str.maketrans("01", SPACE + TAB)))
+            try:
+                vm.tokenize()
+            except WhitespaceError:
+                return False
+            add([self.OPCODES[token.op] for token in vm.tokens],
+                [token.arg for token in vm.tokens])
+        names = self.OPNAMES
+        self.tokens = list(map(self.Token, map(names.__getitem__, all_ops), all_args))
+        self.opcodes = list(all_ops)
+        return True
+
+    def bad_operation(self, opchars, chars):
+        # Reports an unrecognized operation that starts with opchars and is
+        # followed by whatever the chars iterator has left.
+        for ch in chars:
+            if len(opchars) >= 45: break
+            if ch in WHITESPACE: opchars += ch
+        raise WhitespaceError("SYNTAX ERROR", f"BAD OPERATION : {self.unwhite(opchars, max=45)}")
+
+    def load(self):
+        # Turns the code into a linked program, or takes it from the cache.
+        start = time.perf_counter()
+        if self.cache is not None and self.cache.load(self):
+            if self.timing_flag:
+                elapsed = time.perf_counter() - start
+                print(f"load: {elapsed:.4f}s from the cache (loading took "
+                      f"{self.cache.parse_time:.4f}s, saved "
+                      f"{self.cache.parse_time - elapsed:.4f}s)", file=sys.stderr)
+            return
+        if len(self.code) >= CHUNKED_TOKENIZE_SIZE and not self.debug_flag:
+            self.tokenize_chunked(self.load_processes)
+        else:
+            self.tokenize()
+        if self.optimize_flag:
+            self.check_labels()
+            self.optimize()
+        self.scan_labels()
+        self.link()
+        elapsed = time.perf_counter() - start
+        if self.cache is not None:
+            self.cache.save(self, elapsed)
+        if self.timing_flag:
+            print(f"load: {elapsed:.4f}s", file=sys.stderr)
+
+    def program(self):
+        # Returns the loaded program, to share with other VMs.
+        return Program(self.tokens, self.labels, self.opcodes, self.operands, self.label_names,
+                       self.safe, self.pure)
+
+    def use_program(self, program):
+        # Takes over a program loaded by another VM, instead of loading the code.
+        self.tokens = program.tokens
+        self.labels = program.labels
+        self.opcodes = program.opcodes
+        self.operands = program.operands
+        self.label_names = program.label_names
+        self.safe = program.safe
+        self.pure = program.pure
 
     def run(self):
-        self.strip_comments()
-        self.tokenize()
         if (self.describe_flag):
+            self.tokenize()
+            if self.optimize_flag:
+                self.optimize()
             self.describe()
         else:
-            self.scan_labels()
-            self.execute()
+            if self.profile_flag and (self.debug_flag or self.trace_hook is not None):
+                # the profiler would take the place of the tracer
+                raise ValueError("profiling doesn't work with debugging or a trace hook")
+            self.load()
+            start = time.perf_counter()
+            if self.debug_flag and self.trace_hook is None:
+                for label in (self.trace_from, self.trace_to):
+                    if label is not None and self.find_label(label) is None:
+                        raise WhitespaceError("SYNTAX ERROR", f"UNDEFINED LABEL : {label}")
+                self.trace_hook = DebugTracer(self, self.debug_file,
+                                              self.trace_from, self.trace_to)
+            if self.profile_flag:
+                self.profiler = Profiler(self, self.profile_sample)
+                self.trace_hook = self.profiler
+            try:
+                if self.trace_hook is not None:
+                    self.execute_traced(self.trace_hook, self.profile_sample)
+                elif self.compile_flag:
+                    self.execute_compiled()
+                else:
+                    self.execute(self.max_steps, self.time_limit)
+            finally:
+                self.io.flush()
+                self.debug_file.flush()
+                if self.timing_flag:
+                    print(f"\nrun: {time.perf_counter() - start:.4f}s", file=sys.stderr)
+                    if self.jit is not None:
+                        print(self.jit.stats(), file=sys.stderr)
+                if self.memo_stats_flag and self.memo is not None:
+                    print(f"\n{self.memo.stats()}", file=sys.stderr)
+                if self.heap_stats_flag:
+                    print(f"\n{self.heap.stats()}", file=sys.stderr)
+                if self.profiler is not None:
+                    self.profiler.report(sys.stderr)
+                    if self.profile_json:
+                        with open(self.profile_json, "w") as f:
+                            json.dump(self.profiler.results(), f, indent=1)
+
+    def link(self):
+        # Turns the tokens into two compact parallel lists ready for
+        # execution: self.opcodes holds the index of each operation in
+        # OPNAMES, and self.operands holds its argument.  The label arguments
+        # of flow control operations are resolved to the instruction index
+        # they jump to, so that no label has to be looked up at runtime, and
+        # a jump to a label that doesn't exist is caught before we start.
+        # Then the Verifier works out which instructions can skip their
+        # stack checks (self.safe), and the pure subroutines are found.
+        self.debug("Linking ...")
+        tokens = self.tokens
+        labels = self.labels
+        opcodes = self.opcodes
+        if len(opcodes) != len(tokens):     # tokenize_chunked() made them already
+            names = self.OPCODES
+            opcodes = [names[token.op] for token in tokens]
+        # the argument of an operation without one is ""
+        operands = [token.arg or 0 for token in tokens]
+        mark = self.OPCODES["MARK"]
+        for m in self.LABEL_OP_RE.finditer(bytes(opcodes)):
+            i = m.start()
+            if opcodes[i] == mark:
+                operands[i] = 0
+            elif operands[i] in labels:
+                operands[i] = labels[operands[i]]
+            else:
+                raise WhitespaceError("SYNTAX ERROR", "UNDEFINED LABEL", i,
+                                      tokens[i].op, self.label_name(tokens[i].arg))
+        self.opcodes = opcodes
+        self.operands = operands
+        self.safe = Verifier(self).safe_instructions()
+        self.pure = self.pure_subroutines()
+
+    def make_handlers(self, unchecked=False):
+        # Returns the list of functions that carry out each operation,
+        # indexed by opcode.  Every handler takes the index of the
+        # instruction being executed and its operand, and returns the index
+        # of the next instruction to execute.  With unchecked, COPY and SLIDE
+        # trust that the stack is deep enough, which the Verifier proves for
+        # the instructions in safe blocks.
+        stack = self.stack
+        push = stack.append
+        pop = stack.pop
+        heap = self.heap
+        pages = heap.pages
+        page_get = pages.get
+        zero_page = heap.zero_page
+        shift = heap.shift
+        mask = heap.mask
+        return_addrs = self.return_addrs
+        max_call_depth = self.max_call_depth
+        io = self.io
+        out = io.out
+        out_limit = io.buffer_size if io.direct else 0
+        end = len(self.opcodes)
+
+        # The top of the stack is its last item.  Running out of stack raises
+        # an IndexError, which execute() turns into a stack underflow error.
+        def push_(i, arg):
+            push(arg)
+            return i + 1
+
+        def duplicate(i, arg):
+            push(stack[-1])
+            return i + 1
+
+        def copy(i, arg):
+            if arg < 0:
+                raise IndexError
+            push(stack[-1 - arg])
+            return i + 1
+
+        def swap(i, arg):
+            stack[-1], stack[-2] = stack[-2], stack[-1]
+            return i + 1
+
+        def discard(i, arg):
+            pop()
+            return i + 1
+
+        def slide(i, arg):
+            if not 0 <= arg < len(stack):
+                raise IndexError
+            del stack[-1 - arg:-1]
+            return i + 1
+
+        def copy_unchecked(i, arg):
+            push(stack[-1 - arg])
+            return i + 1
+
+        def slide_unchecked(i, arg):
+            del stack[-1 - arg:-1]
+            return i + 1
+
+        def add(i, arg):
+            data1 = pop()
+            stack[-1] += data1
+            return i + 1
+
+        def subtract(i, arg):
+            data1 = pop()
+            stack[-1] -= data1
+            return i + 1
+
+        def multiply(i, arg):
+            data1 = pop()
+            stack[-1] *= data1
+            return i + 1
+
+        def divide(i, arg):
+            data1 = pop()
+            stack[-1] //= data1
+            return i + 1
+
+        def modulo(i, arg):
+            data1 = pop()
+            stack[-1] %= data1
+            return i + 1
+
+        def store(i, arg):
+            val = pop()
+            addr = pop()
+            try:
+                pages[addr >> shift][addr & mask] = val
+            except (KeyError, OverflowError):
+                heap.store(addr, val)
+            return i + 1
+
+        def retrieve(i, arg):
+            addr = stack[-1]
+            stack[-1] = page_get(addr >> shift, zero_page)[addr & mask]
+            return i + 1
 
-    def execute(self):
+        def mark(i, arg):
+            # we've already handled this during scan_labels()
+            return i + 1
+
+        def call(i, arg):
+            if len(return_addrs) >= max_call_depth:
+                self.call_too_deep(i)
+            return_addrs.append(i + 1)
+            return arg
+
+        def jump(i, arg):
+            return arg
+
+        def jumpzero(i, arg):
+            if pop() == 0:
+                return arg
+            return i + 1
+
+        def jumpneg(i, arg):
+            if pop() < 0:
+                return arg
+            return i + 1
+
+        def return_(i, arg):
+            return return_addrs.pop()
+
+        def endprogram(i, arg):
+            self.ended = True
+            return end
+
+        def add_imm(i, arg):
+            stack[-1] += arg
+            return i + 1
+
+        def mul_imm(i, arg):
+            stack[-1] *= arg
+            return i + 1
+
+        def load_imm(i, arg):
+            push(page_get(arg >> shift, zero_page)[arg & mask])
+            return i + 1
+
+        def dup_jz(i, arg):
+            if stack[-1] == 0:
+                return arg
+            return i + 1
+
+        def dup_jn(i, arg):
+            if stack[-1] < 0:
+                return arg
+            return i + 1
+
+        def outch(i, arg):
+            c = pop()
+            if 0 <= c < 128 and len(out) < out_limit:
+                out.append(c)
+            else:
+                io.write_char(c)
+            return i + 1
+
+        def outnum(i, arg):
+            io.write_num(pop())
+            return i + 1
+
+        # The address is popped before the input is read, so that a program
+        # that runs out of stack doesn't take any input first.  With AsyncIO
+        # the read may raise NeedInput, and then the address goes back on
+        # the stack for when the instruction runs again.
+        def inch(i, arg):
+            addr = pop()
+            try:
+                heap[addr] = io.read_char()
+            except NeedInput:
+                push(addr)
+                raise
+            return i + 1
+
+        def innum(i, arg):
+            addr = pop()
+            try:
+                heap[addr] = io.read_num()
+            except NeedInput:
+                push(addr)
+                raise
+            return i + 1
+
+        handlers = {
+            "PUSH": push_, "DUPLICATE": duplicate, "COPY": copy, "SWAP": swap,
+            "DISCARD": discard, "SLIDE": slide, "ADD": add, "SUBTRACT": subtract,
+            "MULTIPLY": multiply, "DIVIDE": divide, "MODULO": modulo,
+            "STORE": store, "RETRIEVE": retrieve, "MARK": mark, "CALL": call,
+            "JUMP": jump, "JUMPZERO": jumpzero, "JUMPNEG": jumpneg,
+            "RETURN": return_, "ENDPROGRAM": endprogram, "OUTCH": outch,
+            "OUTNUM": outnum, "INCH": inch, "INNUM": innum,
+            "ADD_IMM": add_imm, "MUL_IMM": mul_imm, "LOAD_IMM": load_imm,
+            "DUP_JZ": dup_jz, "DUP_JN": dup_jn
+        }
+        if unchecked:
+            handlers["COPY"] = copy_unchecked
+            handlers["SLIDE"] = slide_unchecked
+        return [handlers[name] for name in self.OPNAMES]
+
+    def start(self):
+        # Gets the program ready to run from its first instruction, in steps
+        # of run_for().  The handlers are only set up the first time (see
+        # prepare), so after reset() the program runs again straight away.
+        if self.funcs is None:
+            self.prepare()
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        if self.resume_from is not None:
+            self.restore(self.resume_from)
+
+    def prepare(self):
+        # Sets up the handler of every instruction, and the Memo and the Jit.
+        #
+        # Rather than checking for the end of the program on every step, an
+        # extra instruction past the end raises Halt (a program stops by
+        # running off its end, and ENDPROGRAM jumps there).
+        checked = self.make_handlers()
+        unchecked = self.make_handlers(unchecked=True)
+        # look the handler of every instruction up once, rather than on
+        # every step
+        self.funcs = [(unchecked if safe else checked)[op]
+                      for op, safe in zip(self.opcodes, self.safe)]
+        self.args = self.operands + [0]
+
+        def halt(i, arg):
+            raise Halt
+        self.funcs.append(halt)
+        self.memo = Memo(self) if self.memo_flag and self.pure else None
+        recording = isinstance(self.io, IORecorder)
+        if recording:
+            # the recorder logs every read and write with the step it was
+            # made at, so the I/O instructions wait for run_for() to have
+            # counted the steps before them (and the JIT, which would run
+            # them from its traces, stays off)
+            self.io.vm = self
+            io_ops = [self.OPCODES[name] for name in ("OUTCH", "OUTNUM", "INCH", "INNUM")]
+            for i, op in enumerate(self.opcodes):
+                if op in io_ops:
+                    self.funcs[i] = self.counted(self.funcs[i])
+        if self.jit_flag and not recording:
+            self.jit = Jit(self)
+
+    def reset(self, input=None):
+        # Empties the stack, the heap, the calls in progress and the output,
+        # and takes the input from input, to run the program again from the
+        # start.  They're emptied rather than replaced, since the handlers
+        # hold on to them.  The Memo keeps its results, which still hold.
+        self.stack.clear()
+        self.return_addrs.clear()
+        self.heap.pages.clear()
+        self.io.reset(input)
+        self.ended = False
+
+    def restore(self, state):
+        # Puts the program back in the state of a snapshot taken by
+        # Checkpoints, which must be of this program, loaded the same way,
+        # with the same heap page size.  The input the program had used
+        # then is skipped, so it must be given the same input again.
+        if state["page_size"] != self.heap.page_size:
+            raise ValueError(f"the snapshot has heap pages of {state['page_size']} cells")
+        self.pc = state["pc"]
+        self.steps = state["steps"]
+        self.stack[:] = state["stack"]
+        self.return_addrs[:] = state["return_addrs"]
+        pages = self.heap.pages
+        pages.clear()
+        for number, page in state["pages"].items():
+            if type(page) is list:
+                pages[number] = page
+            else:
+                pages[number] = array("q")
+                pages[number].frombytes(page)
+        if not self.io.skip(state["input"]):
+            raise WhitespaceError("RUNTIME ERROR", "THE INPUT ENDS BEFORE WHERE THE SNAPSHOT WAS")
+
+    def counted(self, handler):
+        # Returns handler, wrapped so that it only runs first thing in
+        # run_for(), when self.steps counts every instruction before it.
+        # Anywhere else it raises Preempted to end run_for() just before it.
+        def counted(i, arg):
+            if self.pc != i:
+                raise Preempted(i)
+            self.pc = -1
+            return handler(i, arg)
+        return counted
+
+    def run_for(self, steps):
+        # Runs at most steps more instructions, from instruction #self.pc,
+        # and sets self.halted when the program stops.  The steps are only
+        # counted at the end.  An instruction that raises NeedInput (see
+        # AsyncIO) is left in self.pc, to run again once there's input.
+        #
+        # With the JIT the traces may run up to steps instructions on top of
+        # that (see TraceCompiler), and so may memoized calls (see Memo), so
+        # at most twice as many in all.  Once they've run their share, they
+        # raise Preempted, which ends run_for() where they stopped (they
+        # count their own steps then).
+        funcs = self.funcs
+        args = self.args
+        i = self.pc
+        k = 0
+        self.budget = steps
+        try:
+            for k in range(steps):
+                i = funcs[i](i, args[i])
+            k = steps
+            if i >= len(self.opcodes):
+                self.halted = True
+        except Halt:
+            self.halted = True
+        except Preempted as e:
+            i = e.next
+        except (IndexError, ValueError, ZeroDivisionError) as e:
+            self.instruction_failed(e, self.compiled_instruction(e, i))
+        finally:
+            self.pc = i
+            self.steps += k
+
+    def limit_reached(self, error, message):
+        token = self.tokens[self.pc]
+        raise error("RUNTIME ERROR", message, self.pc, token.op, self.shown_arg(token))
+
+    def quantum(self, quantum, max_steps):
+        # Returns the number of steps to give run_for() next: quantum, or
+        # fewer so as not to run past max_steps.  Raises StepLimitExceeded
+        # once max_steps have run.  As the JIT and the Memo may run twice the
+        # steps they're given, they only get half of what's left.
+        if max_steps is None:
+            return quantum
+        if self.steps >= max_steps:
+            self.limit_reached(StepLimitExceeded, "STEP LIMIT REACHED")
+        left = max_steps - self.steps
+        if self.jit_flag or self.memo is not None:
+            left = max(1, left // 2)
+        return min(quantum, left)
+
+    def execute(self, max_steps=None, time_limit=None):
+        # Runs the program, counting the instructions executed in self.steps.
+        # With max_steps, a program that hasn't stopped after that many
+        # instructions is stopped with a StepLimitExceeded error, and with
+        # time_limit one that runs for more than that many seconds with a
+        # TimeLimitExceeded error.  The limits are checked between quanta.
+        #
+        # With self.checkpoints, a snapshot is written every
+        # self.checkpoint_every instructions, and when a limit stops the
+        # program.  A run resumed from a snapshot (see start) carries on
+        # counting from the steps of the snapshot, and max_steps more.
+        self.start()
+        if max_steps is not None:
+            max_steps += self.steps
+        checkpoints = self.checkpoints
+        checkpoint = self.steps + self.checkpoint_every
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        try:
+            while not self.halted:
+                quantum = self.quantum(QUANTUM, max_steps)
+                if deadline is not None and time.perf_counter() > deadline:
+                    self.limit_reached(TimeLimitExceeded, "TIME LIMIT REACHED")
+                self.run_for(quantum)
+                if checkpoints is not None and self.steps >= checkpoint and not self.halted:
+                    checkpoints.write(self)
+                    checkpoint = self.steps + self.checkpoint_every
+        except (StepLimitExceeded, TimeLimitExceeded):
+            if checkpoints is not None:
+                checkpoints.write(self)
+            raise
+
+    async def execute_async(self, quantum=QUANTUM, max_steps=None):
+        # The coroutine version of execute(), for running many programs in
+        # one event loop: after every quantum instructions the other tasks
+        # get a turn, and a program waiting for input lets them run until
+        # the input arrives.  self.io must be an AsyncIO.
+        io = self.io
+        self.start()
+        while not self.halted:
+            steps = self.quantum(quantum, max_steps)
+            try:
+                self.run_for(steps)
+            except NeedInput:
+                await io.send()
+                await io.receive()
+                continue
+            await io.send()
+            await asyncio.sleep(0)
+        await io.send()
+
+    def execute_traced(self, hook, every=1):
+        # The instrumented twin of execute(): before every instruction it
+        # calls hook(i, op, arg, stack) with the index of the instruction, the
+        # name of its operation, its argument (labels as ids, see label_name)
+        # and the stack, whose top is its last item.  The hook must not change the
+        # stack.  Keeping this in a separate loop means that execute() itself
+        # pays nothing for tracing.  With every > 1 the hook is only called on
+        # every every-th instruction.
         self.debug("Executing ...\n")
+        handlers = self.make_handlers()
+        funcs = [handlers[op] for op in self.opcodes]
+        args = self.operands
+        tokens = self.tokens
+        stack = self.stack
+        n = len(funcs)
         i = 0
-        while i < len(self.tokens):
-            token = self.tokens[i]
-            self.debug_token(token)
-            if token.op == "PUSH":
-                self.stack.appendleft(token.arg)
-            elif token.op == "DUPLICATE":
-                self.stack.appendleft(self.stack[0]) # blows up if stack empty
-            elif token.op == "COPY":
-                val = self.stack[token.arg]
-                self.stack.appendleft(val)
-            elif token.op == "SWAP":
-                data0 = self.stack.popleft()
-                data1 = self.stack.popleft()
-                self.stack.appendleft(data0)
-                self.stack.appendleft(data1)
-            elif token.op == "DISCARD":
-                data = self.stack.popleft()
-            elif token.op == "SLIDE":
-                arg = token.arg
-                arg_saved = arg
-                data = self.stack.popleft()
-                while arg:
-                    arg = arg - 1
-                    slide_data = self.stack.popleft()
-                    self.debug(f"  Slided value={slide_data} off the stack")
-                self.stack.appendleft(data)
-            elif token.op == "ADD":
-                data1, data0 = self.stack.popleft(),  self.stack.popleft()
-                self.stack.appendleft(data0 + data1)
-            elif token.op == "SUBTRACT":
-                data1, data0 = self.stack.popleft(),  self.stack.popleft()
-                self.stack.appendleft(data0 - data1)
-            elif token.op == "MULTIPLY":
-                data1, data0 = self.stack.popleft(),  self.stack.popleft()
-                self.stack.appendleft(data0 * data1)
-            elif token.op == "DIVIDE":
-                data1, data0 = self.stack.popleft(),  self.stack.popleft()
-                self.stack.appendleft(data0 // data1)
-            elif token.op == "MODULO":
-                data1, data0 = self.stack.popleft(),  self.stack.popleft()
-                self.stack.appendleft(data0 % data1)
-            elif token.op == "STORE":
-                val, addr = self.stack.popleft(),  self.stack.popleft()
-                self.heap[addr] = val
-                self.debug(f"  Stored {val} at heap address {addr}")
-            elif token.op == "RETRIEVE":
-                addr = self.stack.popleft()
-                self.stack.appendleft(self.heap[addr])
-            elif token.op == "MARK":
-                # we've already handled this during scan_label()
-                pass
-            elif token.op == "CALL":
-                self.return_addrs.appendleft(i+1)
-                old_i = i
-                i = self.labels[token.arg]
-                self.debug(f"  Calling label {token.arg} instruction #{i} from #{old_i}")
+        k = 1
+        try:
+            while i < n:
+                k -= 1
+                if not k:
+                    k = every
+                    token = tokens[i]
+                    hook(i, token.op, token.arg, stack)
+                i = funcs[i](i, args[i])
+        except IndexError:
+            self.stack_underflow(i)
+        except ValueError as e:
+            self.runtime_error(i, str(e))
+        except ZeroDivisionError:
+            self.runtime_error(i, "DIVISION BY ZERO")
+
+    def runtime_error(self, i, message):
+        # Stops the program because of an error in instruction #i.
+        token = self.tokens[i]
+        raise WhitespaceError("RUNTIME ERROR", message, i, token.op, self.shown_arg(token))
+
+    def instruction_failed(self, e, i):
+        # Stops the program because instruction #i raised e: an IndexError
+        # when it ran out of stack, or a ZeroDivisionError or ValueError.
+        if isinstance(e, IndexError):
+            self.stack_underflow(i)
+        if isinstance(e, ZeroDivisionError):
+            self.runtime_error(i, "DIVISION BY ZERO")
+        self.runtime_error(i, str(e))
+
+    def stack_underflow(self, i):
+        # Instruction #i ran out of stack (or, for a RETURN, of callers).
+        if self.tokens[i].op == "RETURN":
+            self.runtime_error(i, "RETURN OUTSIDE OF A SUBROUTINE")
+        self.runtime_error(i, "STACK UNDERFLOW")
+
+    def call_too_deep(self, i):
+        self.runtime_error(i, f"CALLS NESTED DEEPER THAN {self.max_call_depth}")
+
+    def pure_subroutines(self):
+        # Finds the subroutines (the targets of CALLs) that are pure: that
+        # don't use the heap, read input, write output or end the program,
+        # and only call pure subroutines.  Every instruction of a pure
+        # subroutine has to run with the stack at the same height, whichever
+        # way the subroutine gets there, and every RETURN at the same height.
+        # Then its results only depend on the top items of the stack (see
+        # Memo).  Returns {subroutine: (inputs, effect)}, where inputs is the
+        # number of items the subroutine reads off the top of the stack, and
+        # effect what it does to the size of the stack.
+        #
+        # Subroutines can call each other (and themselves), so their effects
+        # are guessed first, leaving out the paths through calls of
+        # subroutines whose effect isn't known yet, and then checked.
+        names = self.OPNAMES
+        subs = {self.operands[i] for i, op in enumerate(self.opcodes) if names[op] == "CALL"}
+        pure = {}
+        for _ in range(10):
+            guesses = {}
+            for sub in subs:
+                found = self.stack_effect(sub, pure, strict=False)
+                if found is not None:
+                    guesses[sub] = found
+            if guesses == pure:
+                break
+            pure = guesses
+        for _ in range(10):
+            checked = {}
+            for sub in pure:
+                found = self.stack_effect(sub, pure, strict=True)
+                if found is not None:
+                    checked[sub] = found
+            if checked == pure:
+                return pure
+            pure = checked
+        return {}
+
+    def stack_effect(self, sub, pure, strict):
+        # Returns (inputs, effect) for the subroutine at instruction #sub,
+        # taking the subroutines in pure to be pure, or None if it isn't
+        # pure.  Unless strict, a call of a subroutine that isn't in pure is
+        # taken never to return.
+        names = self.OPNAMES
+        n = len(self.opcodes)
+        heights = {}    # instruction --> height of the stack before it
+        work = [(sub, 0)]
+        lowest = 0
+        effect = None
+        while work:
+            i, height = work.pop()
+            if i in heights:
+                if heights[i] != height:
+                    return None
                 continue
-            elif token.op == "JUMP":
-                i = self.labels[token.arg]
-                self.debug(f"  Jumping to label={token.arg}")
+            heights[i] = height
+            if i >= n:
+                return None
+            op = names[self.opcodes[i]]
+            arg = self.operands[i]
+            if op in self.IMPURE_OPS:
+                return None
+            if op == "RETURN":
+                if effect is not None and effect != height:
+                    return None
+                effect = height
                 continue
-            elif token.op == "JUMPZERO":
-                if self.stack.popleft() == 0:
-                    i = self.labels[token.arg]
-                    self.debug(f"  Jumping on ZERO to label={token.arg}")
-                    continue
-            elif token.op == "JUMPNEG":
-                if self.stack.popleft() < 0:
-                    i = self.labels[token.arg]
-                    self.debug(f"  Jumping on NEGATIVE to label={token.arg}")
+            if op == "CALL":
+                if arg not in pure:
+                    if strict:
+                        return None
                     continue
-            elif token.op == "RETURN":
-                i = self.return_addrs.popleft()
-                self.debug(f"  Returning to instruction #{i}")
-                continue
-            elif token.op == "ENDPROGRAM":
-                exit("\nPROGRAM COMPLETED SUCCESSFULLY.")
-            elif token.op == "OUTCH":
-                self.debug("  >>>>>OUTPUT [", end='')
-                print(chr(self.stack.popleft()), end='')
-                self.debug("]")
-            elif token.op == "OUTNUM":
-                self.debug("  >>>>>OUTPUT [", end='')
-                print(self.stack.popleft(), end='')
-                self.debug("]")
-            elif token.op == "INCH":
-                addr = self.stack.popleft()
-                data = ord(self.user_input())
-                self.heap[addr] = data
-                self.debug(f"  Read character {data} into heap at addr {addr}")
-            elif token.op == "INNUM":
-                addr = self.stack.popleft()
-                data = int(self.user_input())
-                self.heap[addr] = data
-                self.debug(f"  Read character {data} into heap at addr {addr}")
+                reads, change = pure[arg]
+            elif op in ("COPY", "SLIDE"):
+                if arg < 0:
+                    return None
+                reads = arg + 1
+                change = 1 if op == "COPY" else -arg
             else:
-                # this is only possible if I miscoded something
-                exit(f"SYNTAX ERROR: BAD TOKEN: {token.op} {token.arg}")
+                reads = Verifier.NEEDS.get(op, 0)
+                change = Verifier.EFFECTS.get(op, 0)
+            lowest = min(lowest, height - reads)
+            height += change
+            if op != "JUMP":
+                work.append((i + 1, height))
+            if op in ("JUMP", "JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN"):
+                work.append((arg, height))
+        if effect is None:
+            return None
+        return (-lowest, effect)
+
+    def find_blocks(self):
+        # Splits the program into basic blocks: runs of instructions
+        # that are only ever entered at the top and left at the bottom.
+        # A block starts at the beginning of the program, at every MARK
+        # (anything can jump there) and after every flow control operation
+        # (where a conditional jump falls through, or a RETURN comes back to).
+        # Returns the sorted list of instruction indices that start a block.
+        flow = self.FLOW_OPS
+        starts = {0}
+        for i, token in enumerate(self.tokens):
+            if token.op == "MARK":
+                starts.add(i)
+            elif token.op in flow:
+                starts.add(i + 1)
+        n = len(self.tokens)
+        return sorted(start for start in starts if start < n)
+
+    def compile_program(self):
+        # Generates the Python source of one function per basic block, and
+        # compiles them.  Returns a list with one entry per instruction, which
+        # is the block function starting there (or None).  Each block function
+        # runs its block and returns the index of the next instruction, just
+        # like a handler would.
+        starts = self.find_blocks()
+        ends = starts[1:] + [len(self.opcodes)]
+        lines = ["def make_blocks(stack, heap, return_addrs, vm):"]
+        lines.extend(BlockCompiler.PRELUDE)
+        lines.append("    blocks = {}")
+        # remember which instruction every generated line belongs to, so
+        # that errors can be reported against the right instruction
+        line_instructions = self.compiled_lines["<whitespace>"] = {}
+        for start, end in zip(starts, ends):
+            lines.append(f"    def block_{start}({BlockCompiler.PARAMS}):")
+            block = BlockCompiler(self, start, end)
+            for line, i in zip(block.compile(), block.instructions):
+                lines.append("        " + line)
+                line_instructions[len(lines)] = i
+            lines.append(f"    blocks[{start}] = block_{start}")
+        lines.append("    return blocks")
 
-            self.debug("  stack is now: ", showstack=True)
-            # move index to the next token and loop again
-            i += 1
+        self.debug(f"Compiling {len(starts)} blocks ...")
+        namespace = {}
+        exec(compile("\n".join(lines), "<whitespace>", "exec"), namespace)
+        blocks = namespace["make_blocks"](self.stack, self.heap, self.return_addrs, self)
+        funcs = [None] * len(self.opcodes)
+        for start, func in blocks.items():
+            funcs[start] = func
+        return funcs
+
+    def execute_compiled(self):
+        # Runs the program as compiled basic blocks (see compile_program).
+        funcs = self.compile_program()
+        self.debug("Executing ...\n")
+        n = len(funcs)
+        i = 0
+        try:
+            while i < n:
+                i = funcs[i]()
+        except IndexError as e:
+            self.stack_underflow(self.compiled_instruction(e, i))
+        except ValueError as e:
+            self.runtime_error(self.compiled_instruction(e, i), str(e))
+        except ZeroDivisionError as e:
+            self.runtime_error(self.compiled_instruction(e, i), "DIVISION BY ZERO")
+
+    def compiled_instruction(self, e, i):
+        # Returns the index of the instruction whose compiled code raised the
+        # exception e, while running the block (or trace, see Jit) that
+        # starts at instruction #i.
+        tb = e.__traceback__
+        while tb is not None:
+            lines = self.compiled_lines.get(tb.tb_frame.f_code.co_filename)
+            if lines is not None:
+                i = lines.get(tb.tb_lineno, i)
+            tb = tb.tb_next
+        return i
 
     test_code = (
         "-----BEGIN-SUBROUTINE-TO-OUTPUT-A-SPACE"
@@ -422,14 +2202,1056 @@ class WhitespaceVM:
 
     expected_results = "6 11 33 16 2 1 16 31 16 112 99 0 99 -2"
 
+class Verifier:
+    # A static check of a program, made when it is loaded.  The program is
+    # split into basic blocks (see WhitespaceVM.find_blocks), and a pass over
+    # its control flow works out, for every block, the least number of items
+    # the stack can hold when the block starts, and the least number of
+    # subroutine calls that can be in progress then, over every path that
+    # leads there.  A CALL leads to its label, and to the instruction after
+    # it, which the subroutine comes back to with the stack changed by its
+    # effect: the least change in the size of the stack from its start to
+    # any RETURN it gets to (see sub_effect).  The effects of subroutines
+    # that call each other are worked out together, until none changes.
+    #
+    # A block is safe when that least stack is enough for every instruction
+    # in the block, so none of them can run out of stack.  Safe blocks run
+    # without the checks that COPY and SLIDE otherwise need.  The verifier
+    # also finds undefined and unused labels, blocks that can't be reached,
+    # RETURNs that may have no caller and blocks that may run off the end of
+    # the program.  It only needs the tokens, so it can check a program that
+    # doesn't link (for --describe).
+
+    # the items every operation reads from the stack, and what it does to
+    # the size of the stack (COPY and SLIDE depend on their argument)
+    NEEDS = {"DUPLICATE": 1, "SWAP": 2, "DISCARD": 1, "ADD": 2, "SUBTRACT": 2,
+             "MULTIPLY": 2, "DIVIDE": 2, "MODULO": 2, "STORE": 2, "RETRIEVE": 1,
+             "JUMPZERO": 1, "JUMPNEG": 1, "OUTCH": 1, "OUTNUM": 1, "INCH": 1,
+             "INNUM": 1, "ADD_IMM": 1, "MUL_IMM": 1, "DUP_JZ": 1, "DUP_JN": 1}
+    EFFECTS = {"PUSH": 1, "DUPLICATE": 1, "COPY": 1, "DISCARD": -1, "ADD": -1,
+               "SUBTRACT": -1, "MULTIPLY": -1, "DIVIDE": -1, "MODULO": -1,
+               "STORE": -2, "JUMPZERO": -1, "JUMPNEG": -1, "OUTCH": -1,
+               "OUTNUM": -1, "INCH": -1, "INNUM": -1, "LOAD_IMM": 1}
+    WIDEN = 8   # lower a block's least stack to 0 after this many updates
+
+    def __init__(self, vm):
+        self.vm = vm
+        tokens = vm.tokens
+        n = len(tokens)
+        self.labels = {}                # label --> index of its MARK
+        for i, token in enumerate(tokens):
+            if token.op == "MARK":
+                self.labels.setdefault(token.arg, i)
+        used = set()
+        self.undefined = []             # instructions using an undefined label
+        for i, token in enumerate(tokens):
+            if token.op in vm.LABEL_OPS and token.op != "MARK":
+                used.add(token.arg)
+                if token.arg not in self.labels:
+                    self.undefined.append(i)
+        self.unused = [label for label in self.labels if label not in used]
+
+        self.starts = vm.find_blocks()
+        self.ends = self.starts[1:] + [n]
+        self.block_of = {start: b for b, start in enumerate(self.starts)}
+        self.needs = []                 # per block: least stack it needs at its start
+        self.effects = []               # per block: what it does to the size of the stack
+        for start, end in zip(self.starts, self.ends):
+            need, effect = self.block_effect(tokens[start:end])
+            self.needs.append(need)
+            self.effects.append(effect)
+        # subroutine (its first block) --> its effect: None when it never
+        # returns, -inf when there's no telling
+        self.sub_effects = {}
+        # per block: the least stack (None when it can't be reached), and
+        # the least calls in progress
+        self.depths = [None] * len(self.starts)
+        self.calls = [None] * len(self.starts)
+        self.falls_off = []             # blocks that may run off the end of the program
+        self.bad_returns = []           # blocks ending in a RETURN that may have no caller
+        if self.starts:
+            self.find_sub_effects()
+            self.analyse()
+
+    def block_effect(self, tokens):
+        # Returns the least stack the instructions need, and what they do to
+        # the size of the stack.
+        need = 0
+        depth = 0   # relative to the start
+        for token in tokens:
+            op = token.op
+            if op in ("COPY", "SLIDE"):
+                if token.arg < 0:
+                    return float("inf"), 0  # always fails
+                reads = token.arg + 1
+                effect = 1 if op == "COPY" else -token.arg
+            else:
+                reads = self.NEEDS.get(op, 0)
+                effect = self.EFFECTS.get(op, 0)
+            need = max(need, reads - depth)
+            depth += effect
+        return need, depth
+
+    def successors(self, b, depth, calls):
+        # Returns the blocks that block b can lead to when it starts with
+        # depth items on the stack (at least), as (block, depth, calls)
+        # with the least stack and calls in progress on the way.  A RETURN
+        # leads nowhere: the CALL it goes back to takes care of that.
+        vm = self.vm
+        if self.needs[b] == float("inf"):
+            return []   # always fails
+        out = max(depth, self.needs[b]) + self.effects[b]
+        last = vm.tokens[self.ends[b] - 1]
+        nxt = [(b + 1, out, calls)] if b + 1 < len(self.starts) else []
+        target = None
+        if last.op in vm.LABEL_OPS and last.arg in self.labels:
+            target = self.block_of[self.labels[last.arg]]
+        if last.op == "CALL":
+            if target is None:
+                return []
+            found = [(target, out, calls + 1)]
+            effect = self.sub_effects.get(target)
+            if effect is not None and nxt:
+                found.append((b + 1, max(0, out + effect), calls))
+            return found
+        if last.op in ("RETURN", "ENDPROGRAM"):
+            return []
+        if last.op == "JUMP":
+            return [] if target is None else [(target, out, calls)]
+        if last.op in ("JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN") and target is not None:
+            return [(target, out, calls)] + nxt
+        return nxt
+
+    def sub_effect(self, sub, callees):
+        # Returns the effect of the subroutine starting at block sub, given
+        # the effects in self.sub_effects of the subroutines it calls (which
+        # it adds to callees).  This is the same walk as analyse(), but with
+        # the stack counted from the start of the subroutine, so it can go
+        # below 0.
+        vm = self.vm
+        tokens = vm.tokens
+        rel = {sub: 0}      # block --> least stack, relative to the start
+        updates = {}
+        effect = None
+        work = [sub]
+        while work:
+            b = work.pop()
+            if self.needs[b] == float("inf"):
+                continue
+            out = rel[b] + self.effects[b]
+            last = tokens[self.ends[b] - 1]
+            found = []
+            if last.op == "RETURN":
+                effect = out if effect is None else min(effect, out)
+            elif last.op == "CALL":
+                if last.arg in self.labels:
+                    target = self.block_of[self.labels[last.arg]]
+                    callees.add(target)
+                    called = self.sub_effects.get(target)
+                    if called is not None and b + 1 < len(self.starts):
+                        found.append((b + 1, out + called))
+            else:
+                found = [(s, out) for s, _, _ in self.successors(b, rel[b], 0)]
+            for s, depth in found:
+                if s not in rel:
+                    rel[s] = depth
+                elif depth < rel[s]:
+                    updates[s] = updates.get(s, 0) + 1
+                    # the stack can keep shrinking around a loop
+                    rel[s] = float("-inf") if updates[s] > self.WIDEN else depth
+                else:
+                    continue
+                work.append(s)
+        return effect
+
+    def find_sub_effects(self):
+        # Works out the effect of every subroutine.  They start out never
+        # returning, and only go down from there as the effects of the
+        # subroutines they call go down, so this ends, once the effects that
+        # keep going down (recursion that eats the stack) are set to -inf.
+        subs = {self.block_of[self.labels[token.arg]] for token in self.vm.tokens
+                if token.op == "CALL" and token.arg in self.labels}
+        callers = {sub: set() for sub in subs}
+        changes = dict.fromkeys(subs, 0)
+        work = list(subs)
+        while work:
+            sub = work.pop()
+            callees = set()
+            effect = self.sub_effect(sub, callees)
+            for callee in callees:
+                callers[callee].add(sub)
+            if effect == self.sub_effects.get(sub):
+                continue
+            changes[sub] += 1
+            self.sub_effects[sub] = float("-inf") if changes[sub] > self.WIDEN else effect
+            work.extend(callers[sub])
+
+    def analyse(self):
+        depths = self.depths
+        calls = self.calls
+        updates = [0] * len(self.starts)
+        depths[0] = 0
+        calls[0] = 0
+        work = [0]
+        while work:
+            b = work.pop()
+            for s, depth, c in self.successors(b, depths[b], calls[b]):
+                if depths[s] is None:
+                    depths[s] = depth
+                    calls[s] = c
+                elif depth < depths[s] or c < calls[s]:
+                    updates[s] += 1
+                    # the calls can't drop below 0, but the stack can keep
+                    # shrinking around a loop
+                    depths[s] = 0 if updates[s] > self.WIDEN else min(depths[s], depth)
+                    calls[s] = min(calls[s], c)
+                else:
+                    continue
+                work.append(s)
+
+        tokens = self.vm.tokens
+        for b, end in enumerate(self.ends):
+            if depths[b] is None:
+                continue
+            last = tokens[end - 1].op
+            if last == "RETURN" and calls[b] == 0:
+                self.bad_returns.append(b)
+            if end == len(tokens) and last not in ("JUMP", "RETURN", "ENDPROGRAM"):
+                self.falls_off.append(b)
+
+    def safe_blocks(self):
+        return [depth is not None and depth >= need
+                for depth, need in zip(self.depths, self.needs)]
+
+    def safe_instructions(self):
+        # Returns, for every instruction, whether it is in a safe block.
+        safe = []
+        for ok, start, end in zip(self.safe_blocks(), self.starts, self.ends):
+            safe.extend([ok] * (end - start))
+        return safe
+
+    def report(self, file):
+        vm = self.vm
+        tokens = vm.tokens
+        safe = self.safe_blocks()
+        unreachable = self.depths.count(None)
+        print(f"\nVERIFIER: {len(self.starts)} blocks, {safe.count(True)} safe, "
+              f"{len(self.starts) - safe.count(True) - unreachable} may run out of stack, "
+              f"{unreachable} unreachable", file=file)
+        for b, (start, end) in enumerate(zip(self.starts, self.ends)):
+            if self.depths[b] is None:
+                status = "unreachable"
+            else:
+                status = "safe" if safe[b] else "MAY RUN OUT OF STACK"
+                status = f"stack >= {self.depths[b]}, needs {self.needs[b]} : {status}"
+            print(f"  #{start}-#{end - 1} {status}", file=file)
+        for i in self.undefined:
+            print(f"  UNDEFINED LABEL AT INSTRUCTION #{i} : {tokens[i].op} "
+                  f"{vm.shown_arg(tokens[i])}", file=file)
+        for label in self.unused:
+            print(f"  UNUSED LABEL : {vm.label_name(label)}", file=file)
+        for b in self.bad_returns:
+            print(f"  RETURN AT INSTRUCTION #{self.ends[b] - 1} MAY HAVE NO CALLER", file=file)
+        for b in self.falls_off:
+            print(f"  THE BLOCK AT #{self.starts[b]} MAY RUN OFF THE END OF THE PROGRAM", file=file)
+
+class Memo:
+    # Memoizes the pure subroutines of the program (see
+    # WhitespaceVM.pure_subroutines).  A CALL of one of them looks the
+    # items the subroutine reads up in a cache first.  On a hit the stack
+    # gets the results straight away; otherwise the subroutine runs here, to
+    # its RETURN, and its results go in the cache.  The cache keeps the
+    # MEMO_SIZE results used last.
+    #
+    # Everything else stays the same as in the interpreter: a hit adds
+    # the steps the call took to vm.steps, and isn't taken when the calls
+    # it made would now nest too deep.  Like the traces of the JIT, the
+    # calls only run as many steps as vm.budget has left.  When that runs
+    # out in the middle of a subroutine, the calls running raise
+    # Preempted, the interpreter carries on with them, and their results
+    # aren't kept.  A subroutine that hits less than a tenth of the time
+    # over its first MEMO_TRIAL calls isn't memoized from then on.
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.results = OrderedDict()    # (subroutine, its inputs) --> (its results,
+                                        # steps, how much deeper its calls nested)
+        self.plain = {}                 # memoized CALL --> the interpreter's handler
+        self.sites = {}                 # subroutine --> its CALLs
+        self.calls = {}                 # subroutine --> calls looked up
+        self.hits = {}                  # subroutine --> calls found in the cache
+        self.given_up = set()           # subroutines no longer memoized
+        self.active = 0                 # memoized calls running
+        self.unmemoized = 0             # calls made without memoizing
+        self.deepest = 0                # deepest call made by the memoized calls running
+        self.abandoned = 0              # calls left to the interpreter
+        for i, op in enumerate(vm.opcodes):
+            if vm.OPNAMES[op] == "CALL" and vm.operands[i] in vm.pure:
+                self.plain[i] = vm.funcs[i]
+                self.sites.setdefault(vm.operands[i], []).append(i)
+                vm.funcs[i] = self.call
+        for sub in self.sites:
+            self.calls[sub] = 0
+            self.hits[sub] = 0
+        self.handlers = list(vm.funcs)  # the handlers the subroutines run with
+        self.done = len(vm.funcs)       # the return address that ends a memoized call
+
+    def memoized(self, i):
+        # Returns whether instruction #i is a memoized CALL.
+        return i in self.plain and self.vm.operands[i] not in self.given_up
+
+    def call(self, i, arg):
+        # The handler of a memoized CALL.
+        vm = self.vm
+        stack = vm.stack
+        return_addrs = vm.return_addrs
+        inputs, effect = vm.pure[arg]
+        base = len(stack) - inputs
+        depth = len(return_addrs)
+        if arg in self.given_up or base < 0 or self.active >= MEMO_MAX_DEPTH:
+            self.unmemoized += 1
+            return self.plain[i](i, arg)
+        key = (arg, tuple(stack[base:]))
+        self.calls[arg] += 1
+        found = self.results.get(key)
+        if found is not None:
+            results, steps, deeper = found
+            if steps <= vm.budget and depth + deeper < vm.max_call_depth:
+                self.results.move_to_end(key)
+                self.hits[arg] += 1
+                stack[base:] = results
+                vm.steps += steps - 1   # the caller counts the CALL
+                vm.budget -= steps
+                self.deepest = max(self.deepest, depth + deeper)
+                self.review(arg)
+                return i + 1
+        if depth >= vm.max_call_depth:
+            vm.call_too_deep(i)
+
+        # run the subroutine here, until it returns to self.done
+        handlers = self.handlers
+        args = vm.args
+        done = self.done
+        start_steps = vm.steps
+        outer_deepest = self.deepest
+        unmemoized = self.unmemoized
+        self.deepest = depth
+        self.active += 1
+        return_addrs.append(done)
+        count = 1   # the CALL, which comes out of the budget too (as on a hit)
+        vm.budget -= 1
+        j = arg
+        returned = False
+        failed = None
+        try:
+            while j != done:
+                if vm.budget <= 0:
+                    raise Preempted(j)
+                vm.budget -= 1
+                j = handlers[j](j, args[j])
+                count += 1
+            returned = True
+        except Preempted:
+            self.abandoned += 1
+            raise
+        except (IndexError, ValueError, ZeroDivisionError) as e:
+            failed = e
+        finally:
+            self.active -= 1
+            vm.steps += count - 1
+            deepest = self.deepest
+            self.deepest = max(outer_deepest, deepest)
+            if not returned:
+                # the interpreter carries on from here (or reports the
+                # error), so it needs to know where to return to, and
+                # doesn't count this CALL
+                return_addrs[depth] = i + 1
+                vm.steps += 1
+        if failed is not None:
+            vm.instruction_failed(failed, j)
+        if self.unmemoized == unmemoized and len(stack) == base + inputs + effect:
+            self.results[key] = (tuple(stack[base:]), vm.steps - start_steps + 1,
+                                 deepest - depth)
+            if len(self.results) > MEMO_SIZE:
+                self.results.popitem(last=False)
+        self.review(arg)
+        return i + 1
+
+    def review(self, sub):
+        # Stops memoizing subroutine sub if it hasn't paid off over its
+        # first MEMO_TRIAL calls.
+        if self.calls[sub] == MEMO_TRIAL and self.hits[sub] * 10 < MEMO_TRIAL:
+            self.given_up.add(sub)
+            for i in self.sites[sub]:
+                self.vm.funcs[i] = self.handlers[i] = self.plain[i]
+
+    def stats(self):
+        calls = sum(self.calls.values())
+        hits = sum(self.hits.values())
+        return (f"memo: {len(self.sites)} pure subroutines called, {calls} calls looked up, "
+                f"{hits} hits ({100 * hits / max(1, calls):.1f}%), "
+                f"{len(self.results)} results kept, {len(self.given_up)} subroutines given up, "
+                f"{self.abandoned} calls left to the interpreter")
+
+class Jit:
+    # The tracing JIT (see --jit).  It counts how often every loop runs, that
+    # is how often a jump back to its head is taken.  Once a loop has run
+    # JIT_THRESHOLD times, the JIT records the path its next iteration takes
+    # and compiles it (see TraceCompiler), and the trace replaces the
+    # handler of the loop head in vm.funcs.  Everything else stays in the
+    # interpreter, so a program only pays for compiling the code it spends
+    # its time in.
+    #
+    # An iteration that reads input, ends the program, makes a memoized
+    # call (see Memo) or runs more than JIT_MAX_TRACE instructions can't be
+    # traced.  The JIT gives up on a loop after JIT_ATTEMPTS such
+    # iterations.
+
+    BRANCHES = ("JUMP", "JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN")
+    UNTRACEABLE = ("INCH", "INNUM", "ENDPROGRAM")
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.handlers = list(vm.funcs)  # the interpreter's handler of every instruction
+        self.names = [vm.OPNAMES[op] for op in vm.opcodes]
+        self.counts = {}                # loop head --> iterations left before it is traced
+        self.attempts = {}              # loop head --> iterations that couldn't be traced
+        self.traces = {}                # loop head --> length of its trace
+        self.given_up = 0               # loops that couldn't be traced
+        for i, name in enumerate(self.names):
+            if name in self.BRANCHES and vm.operands[i] <= i:
+                self.counts[vm.operands[i]] = JIT_THRESHOLD
+                vm.funcs[i] = self.counter(vm.funcs[i])
+
+    def counter(self, handler):
+        # Returns the handler of a jump back to a loop head, wrapped to count
+        # the times the jump is taken.
+        counts = self.counts
+        funcs = self.vm.funcs
+
+        def count(i, arg):
+            j = handler(i, arg)
+            if j == arg and arg in counts:
+                counts[arg] -= 1
+                if not counts[arg]:
+                    del counts[arg]
+                    funcs[arg] = self.recorder(arg)
+            return j
+        return count
+
+    def recorder(self, head):
+        # Returns a handler for the loop head that runs the next iteration
+        # of the loop one instruction at a time, recording its path, and
+        # then puts the compiled trace in place of itself.
+        vm = self.vm
+        handlers = self.handlers
+        names = self.names
+        args = vm.args
+        n = len(vm.opcodes)
+
+        def record(i, arg):
+            if vm.budget < JIT_MAX_TRACE:
+                return handlers[i](i, arg)  # it could run past the limits
+            vm.funcs[head] = handlers[head]
+            path = []
+            j = i
+            try:
+                while not path or j != head:
+                    if (j >= n or len(path) >= JIT_MAX_TRACE or names[j] in self.UNTRACEABLE
+                            or vm.memo is not None and vm.memo.memoized(j)):
+                        break
+                    path.append(j)
+                    j = handlers[j](j, args[j])
+            except (IndexError, ValueError, ZeroDivisionError) as e:
+                vm.instruction_failed(e, path[-1])
+            # run_for() counts this handler as one step
+            vm.steps += len(path) - 1
+            vm.budget -= len(path)
+            if path and j == head:
+                vm.funcs[head] = TraceCompiler(vm, path).function()
+                self.traces[head] = len(path)
+            else:
+                self.attempts[head] = self.attempts.get(head, 0) + 1
+                if self.attempts[head] < JIT_ATTEMPTS:
+                    self.counts[head] = JIT_THRESHOLD
+                else:
+                    self.given_up += 1
+            return j
+        return record
+
+    def stats(self):
+        return (f"jit: {len(self.traces)} traces compiled "
+                f"({sum(self.traces.values())} instructions), {self.given_up} loops given up")
+
+class BlockCompiler:
+    # Generates the Python statements for one basic block of a linked
+    # WhitespaceVM program.
+    #
+    # Values pushed inside the block live in local variables (or are plain
+    # constants) on a "virtual stack" instead of going through the real
+    # stack.  Only values the block needs from below what it pushed itself
+    # are popped off the real stack, and whatever is left on the virtual
+    # stack is pushed onto the real stack when the block ends.  Every
+    # operation is still carried out in program order, so output, input and
+    # heap accesses happen exactly as they would in the interpreter.
+
+    def __init__(self, vm, start, end):
+        self.vm = vm
+        self.start = start
+        self.end = end
+        self.lines = []     # generated statements
+        self.instructions = [] # the instruction each statement belongs to
+        self.virtual = []   # expressions of the values on the virtual stack
+        self.temps = 0      # number of local variables used so far
+
+    def temp(self, expr):
+        # Stores expr in a new local variable and returns its name.
+        name = f"t{self.temps}"
+        self.temps += 1
+        self.lines.append(f"{name} = {expr}")
+        return name
+
+    def pop(self):
+        # Returns an expression for the top of the stack, and removes it.
+        if self.virtual:
+            return self.virtual.pop()
+        return self.temp("pop()")
+
+    def push(self, expr):
+        self.virtual.append(expr)
+
+    def peek(self, n):
+        # Returns an expression for the item n places below the top of the
+        # stack, without removing anything.
+        if n < 0:
+            self.lines.append("raise IndexError")
+            return "0"
+        if n < len(self.virtual):
+            return self.virtual[-1 - n]
+        return self.temp(f"stack[{len(self.virtual) - n - 1}]")
+
+    def retrieve(self, addr):
+        # Returns a local variable holding the heap cell at addr (see PagedHeap).
+        heap = self.vm.heap
+        return self.temp(f"page_get({addr} >> {heap.shift}, zero_page)[{addr} & {heap.mask}]")
+
+    def store(self, addr, val):
+        # Stores val in the heap cell at addr (see PagedHeap).
+        heap = self.vm.heap
+        self.lines.append("try:")
+        self.lines.append(f"    pages[{addr} >> {heap.shift}][{addr} & {heap.mask}] = {val}")
+        self.lines.append("except (KeyError, OverflowError):")
+        self.lines.append(f"    heap.store({addr}, {val})")
+
+    def flush(self):
+        # Moves the virtual stack onto the real stack.
+        for expr in self.virtual:
+            self.lines.append(f"push({expr})")
+        self.virtual = []
+
+    def compile(self):
+        # Returns the statements of the block, as a list of lines.
+        for i in range(self.start, self.end):
+            self.instructions.extend([i - 1] * (len(self.lines) - len(self.instructions)))
+            self.instruction(i)
+        if not self.lines or not self.lines[-1].startswith("return"):
+            self.flush()
+            self.lines.append(f"return {self.end}")
+        self.instructions.extend([self.end - 1] * (len(self.lines) - len(self.instructions)))
+        return self.lines
+
+    def instruction(self, i):
+        # Generates the statements of instruction #i.
+        vm = self.vm
+        op = vm.OPNAMES[vm.opcodes[i]]
+        arg = vm.operands[i]
+        if op == "PUSH":
+            self.push(f"({arg})" if arg < 0 else repr(arg))
+        elif op == "DUPLICATE":
+            self.push(self.peek(0))
+        elif op == "COPY":
+            self.push(self.peek(arg))
+        elif op == "SWAP":
+            data0 = self.pop()
+            data1 = self.pop()
+            self.push(data0)
+            self.push(data1)
+        elif op == "DISCARD":
+            if self.virtual:
+                self.virtual.pop()
+            else:
+                self.lines.append("pop()")
+        elif op == "SLIDE":
+            if arg < 0:
+                self.lines.append("raise IndexError")
+            data = self.pop()
+            while arg > 0 and self.virtual:
+                self.virtual.pop()
+                arg -= 1
+            if arg > 0:
+                if not vm.safe[i]:
+                    self.lines.append(f"if len(stack) < {arg}: raise IndexError")
+                self.lines.append(f"del stack[-{arg}:]")
+            self.push(data)
+        elif op in self.ARITHMETIC:
+            data1 = self.pop()
+            data0 = self.pop()
+            self.push(self.temp(f"{data0} {self.ARITHMETIC[op]} {data1}"))
+        elif op == "STORE":
+            val = self.pop()
+            addr = self.pop()
+            self.store(addr, val)
+        elif op == "RETRIEVE":
+            self.push(self.retrieve(self.pop()))
+        elif op == "ADD_IMM":
+            self.push(self.temp(f"{self.pop()} + ({arg})"))
+        elif op == "MUL_IMM":
+            self.push(self.temp(f"{self.pop()} * ({arg})"))
+        elif op == "LOAD_IMM":
+            self.push(self.retrieve(repr(arg)))
+        elif op == "MARK":
+            pass
+        elif op == "CALL":
+            self.flush()
+            self.lines.append(f"if len(return_addrs) >= {vm.max_call_depth}: "
+                              f"vm.call_too_deep({i})")
+            self.lines.append(f"return_addrs.append({i + 1})")
+            self.lines.append(f"return {arg}")
+        elif op == "JUMP":
+            self.flush()
+            self.lines.append(f"return {arg}")
+        elif op in ("JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN"):
+            cond = self.pop() if op.startswith("JUMP") else self.peek(0)
+            self.flush()
+            test = "==" if op in ("JUMPZERO", "DUP_JZ") else "<"
+            self.lines.append(f"return {arg} if {cond} {test} 0 else {i + 1}")
+        elif op == "RETURN":
+            self.flush()
+            self.lines.append("return return_addrs.pop()")
+        elif op == "ENDPROGRAM":
+            self.flush()
+            self.lines.append("vm.ended = True")
+            self.lines.append(f"return {len(vm.opcodes)}")
+        elif op == "OUTCH":
+            c = self.pop()
+            if vm.io.direct:
+                self.lines.append(f"if 0 <= {c} < 128 and len(out) < {vm.io.buffer_size}: "
+                                  f"out.append({c})")
+                self.lines.append(f"else: io.write_char({c})")
+            else:
+                self.lines.append(f"io.write_char({c})")
+        elif op == "OUTNUM":
+            self.lines.append(f"io.write_num({self.pop()})")
+        elif op == "INCH":
+            addr = self.pop()
+            self.store(addr, self.temp("io.read_char()"))
+        elif op == "INNUM":
+            addr = self.pop()
+            self.store(addr, self.temp("io.read_num()"))
+
+    ARITHMETIC = {"ADD": "+", "SUBTRACT": "-", "MULTIPLY": "*", "DIVIDE": "//", "MODULO": "%"}
+
+    # the names the generated code uses: set up once, in the function that
+    # makes the compiled functions (which takes stack, heap, return_addrs and
+    # vm), and passed to each of them as defaults, so they're fast locals
+    PRELUDE = [
+        "    push = stack.append",
+        "    pop = stack.pop",
+        "    pages = heap.pages",
+        "    page_get = pages.get",
+        "    zero_page = heap.zero_page",
+        "    io = vm.io",
+        "    out = io.out",
+    ]
+    PARAMS = ("push=push, pop=pop, stack=stack, heap=heap, pages=pages, page_get=page_get, "
+              "zero_page=zero_page, return_addrs=return_addrs, io=io, out=out, vm=vm")
+
+class TraceCompiler(BlockCompiler):
+    # Generates the Python function for a trace recorded by the Jit: the
+    # path a loop took through the program, from its head back to its head,
+    # which may run through jumps, taken or not, and into subroutines and
+    # back.  The function runs the path over and over.  Every conditional
+    # jump and RETURN on the path becomes a guard, which leaves the trace
+    # (pushing the virtual stack onto the real stack) when the program goes
+    # another way than it did when the trace was recorded.
+    #
+    # A trace only runs as many iterations as vm.budget has steps left for
+    # (at most JIT_ITERATIONS), so that execute() can still check its limits,
+    # and adds the instructions it ran to vm.steps.  Once the budget is used
+    # up it raises Preempted, and if the budget is too small for even one
+    # iteration, the handler it replaced runs the loop head instead.  When an
+    # instruction fails, the ones run before it are counted too.
+
+    def __init__(self, vm, path):
+        super().__init__(vm, path[0], path[0])
+        self.path = path
+        self.positions = []     # the place on the path of the instruction of each statement
+
+    def exit(self, p, target):
+        # Generates the statements that leave the trace from instruction #p
+        # of the path, to instruction #target, as the body of an if.
+        for expr in self.virtual:
+            self.lines.append(f"    push({expr})")
+        self.lines.append(f"    vm.steps += n * {len(self.path)} + {p}")
+        self.lines.append(f"    vm.budget -= n * {len(self.path)} + {p + 1}")
+        self.lines.append(f"    return {target}")
+
+    def compile(self):
+        # Returns the statements of one iteration of the trace, as a list of
+        # lines, which run with the iteration number in n.
+        vm = self.vm
+        path = self.path
+        prev = path[0]
+        for p, i in enumerate(path):
+            self.instructions.extend([prev] * (len(self.lines) - len(self.instructions)))
+            self.positions.extend([max(0, p - 1)] * (len(self.lines) - len(self.positions)))
+            prev = i
+            op = vm.OPNAMES[vm.opcodes[i]]
+            arg = vm.operands[i]
+            nxt = path[p + 1] if p + 1 < len(path) else path[0]
+            if op == "JUMP":
+                pass
+            elif op in ("JUMPZERO", "JUMPNEG", "DUP_JZ", "DUP_JN"):
+                cond = self.pop() if op.startswith("JUMP") else self.peek(0)
+                test = "==" if op in ("JUMPZERO", "DUP_JZ") else "<"
+                if arg == i + 1:
+                    continue    # both ways lead to the same place
+                if nxt == arg:
+                    self.lines.append(f"if not {cond} {test} 0:")
+                    self.exit(p, i + 1)
+                else:
+                    self.lines.append(f"if {cond} {test} 0:")
+                    self.exit(p, arg)
+            elif op == "CALL":
+                self.lines.append(f"if len(return_addrs) >= {vm.max_call_depth}: "
+                                  f"vm.call_too_deep({i})")
+                self.lines.append(f"return_addrs.append({i + 1})")
+            elif op == "RETURN":
+                addr = self.temp("return_addrs.pop()")
+                self.lines.append(f"if {addr} != {nxt}:")
+                self.exit(p, addr)
+            else:
+                self.instruction(i)
+        self.flush()
+        self.instructions.extend([prev] * (len(self.lines) - len(self.instructions)))
+        self.positions.extend([len(path) - 1] * (len(self.lines) - len(self.positions)))
+        return self.lines
+
+    def function(self):
+        # Compiles the trace, and returns its function: a handler for the
+        # loop head (see WhitespaceVM.make_handlers).
+        vm = self.vm
+        head = self.path[0]
+        size = len(self.path)
+        filename = f"<trace #{head}>"
+        lines = ["def make_trace(stack, heap, return_addrs, vm, interpret, positions):"]
+        lines.extend(self.PRELUDE)
+        lines.extend([
+            f"    def trace(i, arg, {self.PARAMS}, interpret=interpret):",
+            f"        iterations = min({JIT_ITERATIONS}, vm.budget // {size})",
+            "        if not iterations:",
+            "            return interpret(i, arg)",
+            "        try:",
+            "            for n in range(iterations):",
+        ])
+        line_instructions = vm.compiled_lines[filename] = {}
+        line_positions = {}
+        for line, i, p in zip(self.compile(), self.instructions, self.positions):
+            lines.append("                " + line)
+            line_instructions[len(lines)] = i
+            line_positions[len(lines)] = p
+        if not line_positions:
+            lines.append("                pass")  # a loop of nothing but jumps and marks
+        lines.extend([
+            "        except (IndexError, ValueError, ZeroDivisionError) as e:",
+            f"            vm.steps += n * {size} + positions[e.__traceback__.tb_lineno]",
+            "            raise",
+            f"        vm.budget -= iterations * {size}",
+            f"        if vm.budget < {size}:",
+            f"            vm.steps += iterations * {size}",
+            f"            raise Preempted({head})",
+            f"        vm.steps += iterations * {size} - 1",
+            f"        return {head}",
+            "    return trace",
+        ])
+        namespace = {"Preempted": Preempted}
+        exec(compile("\n".join(lines), filename, "exec"), namespace)
+        return namespace["make_trace"](vm.stack, vm.heap, vm.return_addrs, vm,
+                                       vm.jit.handlers[head], line_positions)
+
+# -------------------------------LIBRARY
+def load(source, optimize=False, cache_dir=None):
+    # Loads the Whitespace program source (a string) and returns it as a
+    # Program, which run() can then run any number of times.  Raises a
+    # WhitespaceError when the program doesn't load.
+    vm = WhitespaceVM(source)
+    vm.optimize_flag = optimize
+    if cache_dir:
+        vm.cache = ProgramCache(cache_dir)
+    vm.load()
+    return vm.program()
+
+def run(source, stdin=b"", max_steps=None, heap_size=None, optimize=False, time_limit=None):
+    # Runs a Whitespace program in this process, and returns a Result with
+    # its output, rather than writing to stdout and exiting like the command
+    # line does.  source is either the code (a string) or a Program returned
+    # by load().  stdin is the program's input (as bytes).  max_steps limits
+    # the number of instructions it may execute, time_limit the seconds it
+    # may run for, and heap_size the number of heap cells it may use
+    # (rounded up to whole pages).  With optimize the peephole optimizer runs
+    # first (a Program is already optimized, or not, by load()).
+    max_pages = None
+    if heap_size is not None:
+        max_pages = max(1, -(-heap_size // HEAP_PAGE_SIZE))
+    io = WhitespaceIO(BytesIO(stdin), None)
+    result = Result()
+    try:
+        if isinstance(source, Program):
+            vm = WhitespaceVM("", HEAP_PAGE_SIZE, max_pages, io)
+            vm.use_program(source)
+        else:
+            vm = WhitespaceVM(source, HEAP_PAGE_SIZE, max_pages, io)
+            vm.optimize_flag = optimize
+            vm.load()
+        vm.execute(max_steps, time_limit)
+    except WhitespaceError as e:
+        result.status = 1
+        result.error = e
+    result.output = bytes(io.out)
+    result.steps = vm.steps
+    result.ended = vm.ended
+    return result
+
+async def run_async(source, reader=None, writer=None, quantum=QUANTUM, max_steps=None,
+                    heap_size=None, optimize=False):
+    # The coroutine version of run(), for hosting many (interactive)
+    # programs in one event loop.  The program reads its input from reader
+    # and writes its output to writer (see AsyncIO), and lets the other
+    # tasks run after every quantum instructions and while it waits for
+    # input.  The Result has whatever output wasn't written to writer.
+    max_pages = None
+    if heap_size is not None:
+        max_pages = max(1, -(-heap_size // HEAP_PAGE_SIZE))
+    io = AsyncIO(reader, writer)
+    result = Result()
+    try:
+        if isinstance(source, Program):
+            vm = WhitespaceVM("", HEAP_PAGE_SIZE, max_pages, io)
+            vm.use_program(source)
+        else:
+            vm = WhitespaceVM(source, HEAP_PAGE_SIZE, max_pages, io)
+            vm.optimize_flag = optimize
+            vm.load()
+        await vm.execute_async(quantum, max_steps)
+    except WhitespaceError as e:
+        result.status = 1
+        result.error = e
+    result.output = bytes(io.out)
+    result.steps = vm.steps
+    result.ended = vm.ended
+    return result
+
+def read_manifest(filename):
+    # Reads the jobs of a batch manifest: one job per line, giving the
+    # program file, and optionally the file holding its input and the file
+    # holding the output expected from it (- when there's no input file, but
+    # there is an expected output).  Blank lines and lines starting with #
+    # are skipped, and paths are relative to the manifest.  Returns a list
+    # of (program, input, expected) tuples, with None for a missing file.
+    base = os.path.dirname(filename)
+    jobs = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) > 3:
+                raise ValueError(f"{filename}, line {number}: too many fields")
+            fields += [None] * (3 - len(fields))
+            jobs.append(tuple(os.path.join(base, field) if field not in (None, "-") else None
+                              for field in fields))
+    return jobs
+
+tokenize_source = b""   # the source, in a worker of WhitespaceVM.tokenize_chunked()
+
+def init_tokenize_worker(source):
+    # Runs in every worker process of WhitespaceVM.tokenize_chunked(), to
+    # hand it the source (which forked workers share with their parent).
+    global tokenize_source
+    tokenize_source = source
+
+def scan_tokens(text, pos, stops=None, ends=None):
+    # Reads the tokens of text, a chunk of source as tokenize_chunk() has
+    # it, from position pos until one doesn't match: the last one of the
+    # chunk, cut short, or a syntax error.  Returns their opcodes (as bytes),
+    # their arguments and the position reached.  The position after every
+    # token goes into the list ends, if given.  With stops (position -->
+    # number of tokens), reading stops at the first of its positions it
+    # gets to, and that number is returned too (otherwise None).
+    match = WhitespaceVM.TOKEN_RE.match
+    groups = WhitespaceVM.TOKEN_GROUPS
+    ops = bytearray()
+    args = []
+    while True:
+        m = match(text, pos)
+        if m is None:
+            return bytes(ops), args, pos, None
+        group = m.lastindex
+        opcode, kind, n = groups[group]
+        ops.append(opcode)
+        if kind == "number":
+            token = m.group(group)
+            num = int(token[n+1:-1] or "0", 2)
+            args.append(-num if token[n] == "1" else num)
+        elif kind == "label":
+            args.append(int("1" + m.group(group)[n:-1], 2))
+        else:
+            args.append("")
+        pos = m.end()
+        if ends is not None:
+            ends.append(pos)
+        elif stops is not None and pos in stops:
+            return bytes(ops), args, pos, stops[pos]
+
+def tokenize_chunk(job):
+    # Tokenizes the bytes from start to end of the source, in a worker of
+    # WhitespaceVM.tokenize_chunked().  Where the first token of a chunk
+    # starts depends on how the chunk before ends, so the chunk is
+    # tokenized from a few candidate positions: its start, the next three
+    # characters (where an operation cut short would end) and just after
+    # each of the first three LFs (where an argument would).  Tokenizing
+    # from different positions soon falls into step, so every candidate but
+    # the start is only followed until it gets to the end of a token found
+    # from the start.
+    #
+    # Returns the chunk up to the last candidate, whether that is all of it,
+    # and for every candidate (ops, args, joined, tail): the tokens found
+    # from there; how many of the tokens found from the start come before
+    # the rest of them, which are the same (None when they aren't); and the
+    # start of a token to be finished by the next chunk (None for a syntax
+    # error).
+    start, end = job
+    text = tokenize_source[start:end].translate(WHITESPACE_BITS, COMMENT_BYTES).decode("ascii")
+
+    def tail(pos):
+        rest = text[pos:]
+        return rest if not rest or WhitespaceVM.TOKEN_START_RE.fullmatch(rest) else None
+
+    ends = []
+    ops, args, pos, _ = scan_tokens(text, 0, ends=ends)
+    results = {0: (ops, args, None, tail(pos))}
+    stops = {pos: n for n, pos in enumerate(ends, 1)}
+    candidates = {1, 2, 3}
+    lf = -1
+    for _ in range(3):
+        lf = text.find(LF, lf + 1)
+        if lf < 0:
+            break
+        candidates.add(lf + 1)
+    for pos in sorted(candidates):
+        if pos > len(text):
+            continue
+        if pos in stops:
+            results[pos] = (b"", [], stops[pos], results[0][3])
+            continue
+        ops, args, end, joined = scan_tokens(text, pos, stops)
+        results[pos] = (ops, args, joined, results[0][3] if joined is not None else tail(end))
+    head = max(results)
+    return text[:head], head == len(text), results
+
+batch_programs = {}     # program file --> Program (or why it didn't load)
+
+def init_batch_worker(programs):
+    # Runs in every worker process of a batch, to hand it the loaded programs.
+    batch_programs.update(programs)
+
+def run_batch_job(job):
+    # Runs one job of a batch, in a worker process.  Returns a dictionary
+    # with the outcome, ready to be written out as JSON.
+    number, (program, inputfile, expected), max_steps, time_limit = job
+    record = {"job": number, "program": program, "input": inputfile,
+              "expected": expected, "status": "error", "passed": None,
+              "steps": 0, "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    try:
+        stdin = b""
+        if inputfile is not None:
+            with open(inputfile, "rb") as f:
+                stdin = f.read()
+        if expected is not None:
+            with open(expected, "rb") as f:
+                expected = f.read()
+    except OSError as e:
+        record["error"] = f"could not read {e.filename}"
+        return record
+    loaded = batch_programs[program]
+    if isinstance(loaded, str):
+        record["error"] = loaded
+        return record
+    result = run(loaded, stdin, max_steps, time_limit=time_limit)
+    record["seconds"] = round(time.perf_counter() - start, 6)
+    record["steps"] = result.steps
+    if result.error is not None:
+        record["error"] = str(result.error)
+    else:
+        record["status"] = "ok"
+    if expected is not None:
+        record["passed"] = result.error is None and result.output == expected
+    return record
+
+def run_batch(manifest, processes=None, max_steps=None, time_limit=None,
+              ordered=True, optimize=False, cache_dir=None, file=sys.stdout):
+    # Runs all the jobs of a batch manifest (see read_manifest) over a pool
+    # of processes, writing one line of JSON per job to file (in manifest
+    # order when ordered, otherwise as they finish).  Every distinct program
+    # is loaded once, here, before the workers start.  Returns a summary
+    # dictionary.
+    jobs = read_manifest(manifest)
+    programs = {}
+    for program, _, _ in jobs:
+        if program in programs:
+            continue
+        try:
+            with open(program) as f:
+                source = f.read()
+            programs[program] = load(source, optimize, cache_dir)
+        except OSError:
+            programs[program] = f"could not read {program}"
+        except WhitespaceError as e:
+            programs[program] = str(e)
+
+    start = time.perf_counter()
+    summary = {"jobs": len(jobs), "programs": len(programs), "ok": 0, "errors": 0,
+               "passed": 0, "failed": 0, "steps": 0}
+    work = [(number, job, max_steps, time_limit) for number, job in enumerate(jobs)]
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(work) // (4 * processes)))
+    with multiprocessing.Pool(processes, init_batch_worker, (programs,)) as pool:
+        if ordered:
+            records = pool.imap(run_batch_job, work, chunksize)
+        else:
+            records = pool.imap_unordered(run_batch_job, work, chunksize)
+        for record in records:
+            print(json.dumps(record), file=file, flush=not ordered)
+            summary["ok" if record["status"] == "ok" else "errors"] += 1
+            if record["passed"] is not None:
+                summary["passed" if record["passed"] else "failed"] += 1
+            summary["steps"] += record["steps"]
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["jobs_per_second"] = round(len(jobs) / elapsed, 1) if elapsed else None
+    summary["steps_per_second"] = round(summary["steps"] / elapsed) if elapsed else None
+    return summary
+
 # -------------------------------MAIN PROGRAM
 def main():
     # Handle command arguments
     purpose_string = "whitespace.py - execute a program in the Whitespace programming language\n"
     usage_string = (
-        "usage: whitespace.py [--debug | --describe] filename\n"
-        "usage: whitespace.py [--debug | --describe] -\n"
-        "usage: whitespace.py [--debug | --describe] --test\n"
+        "usage: whitespace.py [options] filename\n"
+        "usage: whitespace.py [options] -\n"
+        "usage: whitespace.py [options] --test\n"
+        "usage: whitespace.py [options] --batch MANIFEST\n"
         "usage: whitespace.py --help\n"
         "\n"
         "Options:\n"
@@ -437,22 +3259,206 @@ def main():
         "  -                       Get the Whitespace source from STDIN (overrides filename)\n"
         "  --test                  Runs unit tests (overrides filename and -)\n"
         "  --debug                 Turns on verbose debugging\n"
+        "  --trace-file FILE       Writes the debugging output to FILE (implies --debug)\n"
+        "  --trace-from LABEL      Only traces instructions after the program reaches\n"
+        "                          the MARK of LABEL, written like S and T, as shown by\n"
+        "                          --describe (implies --debug)\n"
+        "  --trace-to LABEL        Stops tracing when the program reaches the MARK of\n"
+        "                          LABEL (implies --debug)\n"
         "  --describe              Describes the given Whitespace code.  Does not "
         "execute the program.\n"
+        "                          Also reports what the verifier found: the blocks\n"
+        "                          that may run out of stack, unreachable code, and\n"
+        "                          undefined or unused labels.\n"
+        "  --compile               Compiles the program into Python functions (one per\n"
+        "                          basic block) before running it.  Faster for long runs.\n"
+        "  --jit                   Compiles the loops the program spends its time in\n"
+        "                          while it runs, and interprets the rest\n"
+        "  --no-memo               Doesn't keep the results of pure subroutines (ones\n"
+        "                          that don't use the heap or do I/O) to reuse them\n"
+        "  --memo-stats            Reports how often kept results were reused (on\n"
+        "                          STDERR)\n"
+        "  --optimize              Runs a peephole optimizer over the program first.  Use\n"
+        "                          with --describe to see the optimized program.\n"
+        "  --heap-page-size N      The heap is allocated in pages of N cells as it is\n"
+        "                          used (a power of two, default 512)\n"
+        "  --heap-max-pages N      Fail when a program needs more than N heap pages\n"
+        "                          (default no limit)\n"
+        "  --heap-stats            Reports heap usage when the program ends\n"
+        "  --max-call-depth N      Fail when subroutine calls nest deeper than N\n"
+        "                          (default 1000000)\n"
+        "  --input FILE            Read the program's input from FILE instead of STDIN\n"
+        "                          (or the terminal, when the source comes from STDIN)\n"
+        "  --record FILE           Writes every byte of input the program takes and its\n"
+        "                          output, with the step each happened at, to FILE (runs\n"
+        "                          the interpreter: not with --compile, --jit, --debug\n"
+        "                          or --profile)\n"
+        "  --replay FILE           Runs the program on the input recorded in FILE, checks\n"
+        "                          its output against the recording as it goes, and\n"
+        "                          reports whether the run matched (on STDERR)\n"
+        "  --profile               Reports where the program spent its time (on STDERR).\n"
+        "                          Not with --debug.\n"
+        "  --profile-sample N      When profiling, only look at every N-th instruction\n"
+        "                          (implies --profile)\n"
+        "  --profile-json FILE     Also writes the profile to FILE as JSON (implies\n"
+        "                          --profile)\n"
+        "  --cache                 Keeps loaded programs in a cache, so they start faster\n"
+        "                          the next time (in ~/.cache/whitespace)\n"
+        "  --cache-dir DIR         Keeps the cache in DIR (implies --cache)\n"
+        "  --timing                Reports how long loading and running took (on STDERR)\n"
+        "  --batch MANIFEST        Runs all the jobs listed in MANIFEST (lines of: program\n"
+        "                          [input|- [expected output]]) in parallel, and writes\n"
+        "                          their results as JSON lines, then a summary on STDERR\n"
+        "  --jobs N                Number of processes for --batch, and for tokenizing\n"
+        "                          programs of 4 MB and up (default: one per CPU)\n"
+        "  --max-steps N           Stops the program (or every --batch job) after N\n"
+        "                          instructions\n"
+        "  --checkpoint FILE       Writes a snapshot of the run to FILE every few million\n"
+        "                          instructions, and when --max-steps or --time-limit\n"
+        "                          stops it\n"
+        "  --checkpoint-every N    Writes the snapshots every N instructions (default\n"
+        f"                          {CHECKPOINT_EVERY})\n"
+        "  --resume FILE           Carries on the run from the snapshot in FILE.  Give it\n"
+        "                          the same program, options and input: the input used\n"
+        "                          before the snapshot is skipped.  --max-steps counts\n"
+        "                          from the snapshot on.  Output written after the\n"
+        "                          snapshot was taken is written again.\n"
+        "  --time-limit SECONDS    Stops the program (or every --batch job) after SECONDS\n"
+        "                          seconds\n"
+        "  --unordered             Writes --batch results as they finish, rather than in\n"
+        "                          the order of the manifest\n"
         "  --help                  Prints this help info\n"
         )
     testarg = False
     debugarg = False
     describearg = False
+    compilearg = False
+    jitarg = False
+    memoarg = True
+    memostatsarg = False
+    optimizearg = False
+    heapstatsarg = False
+    heappagesize = HEAP_PAGE_SIZE
+    heapmaxpages = None
+    maxcalldepth = MAX_CALL_DEPTH
+    inputfile = ""
+    recordfile = ""
+    replayfile = ""
+    checkpointfile = ""
+    checkpointevery = CHECKPOINT_EVERY
+    resumefile = ""
+    tracefile = ""
+    profilearg = False
+    profilesample = 1
+    profilejson = ""
+    cachedir = ""
+    timingarg = False
+    batchfile = ""
+    batchjobs = None
+    maxsteps = None
+    timelimit = None
+    orderedarg = True
+    tracefrom = None
+    traceto = None
     stdinarg = False
     filename = ""
-    for arg in sys.argv[1:]:
+
+    def number_arg(arg, args):
+        # Returns the number following option arg on the command line.
+        try:
+            return int(next(args))
+        except (StopIteration, ValueError):
+            print(f"{sys.argv[0]}: error: option {arg} needs a number\n")
+            print(usage_string)
+            exit()
+
+    def text_arg(arg, args):
+        # Returns the filename or label following option arg on the command line.
+        value = next(args, "")
+        if not value:
+            print(f"{sys.argv[0]}: error: option {arg} needs a value\n")
+            print(usage_string)
+            exit()
+        return value
+
+    args = iter(sys.argv[1:])
+    for arg in args:
         if arg == "--debug":
             debugarg = True
         elif arg == "--describe":
             describearg = True
         elif arg == "--test":
             testarg = True
+        elif arg == "--compile":
+            compilearg = True
+        elif arg == "--jit":
+            jitarg = True
+        elif arg == "--no-memo":
+            memoarg = False
+        elif arg == "--memo-stats":
+            memostatsarg = True
+        elif arg == "--optimize":
+            optimizearg = True
+        elif arg == "--heap-page-size":
+            heappagesize = number_arg(arg, args)
+        elif arg == "--heap-max-pages":
+            heapmaxpages = number_arg(arg, args)
+        elif arg == "--heap-stats":
+            heapstatsarg = True
+        elif arg == "--max-call-depth":
+            maxcalldepth = number_arg(arg, args)
+        elif arg == "--input":
+            inputfile = text_arg(arg, args)
+        elif arg == "--record":
+            recordfile = text_arg(arg, args)
+        elif arg == "--replay":
+            replayfile = text_arg(arg, args)
+        elif arg == "--trace-file":
+            tracefile = text_arg(arg, args)
+            debugarg = True
+        elif arg == "--trace-from":
+            tracefrom = text_arg(arg, args)
+            debugarg = True
+        elif arg == "--trace-to":
+            traceto = text_arg(arg, args)
+            debugarg = True
+        elif arg == "--profile":
+            profilearg = True
+        elif arg == "--profile-sample":
+            profilesample = max(1, number_arg(arg, args))
+            profilearg = True
+        elif arg == "--profile-json":
+            profilejson = text_arg(arg, args)
+            profilearg = True
+        elif arg == "--cache":
+            cachedir = cachedir or os.path.join(
+                os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "whitespace")
+        elif arg == "--cache-dir":
+            cachedir = text_arg(arg, args)
+        elif arg == "--timing":
+            timingarg = True
+        elif arg == "--batch":
+            batchfile = text_arg(arg, args)
+        elif arg == "--jobs":
+            batchjobs = max(1, number_arg(arg, args))
+        elif arg == "--max-steps":
+            maxsteps = number_arg(arg, args)
+        elif arg == "--checkpoint":
+            checkpointfile = text_arg(arg, args)
+        elif arg == "--checkpoint-every":
+            checkpointevery = max(1, number_arg(arg, args))
+        elif arg == "--resume":
+            resumefile = text_arg(arg, args)
+        elif arg == "--time-limit":
+            value = text_arg(arg, args)
+            try:
+                timelimit = float(value)
+            except ValueError:
+                print(f"{sys.argv[0]}: error: option {arg} needs a number\n")
+                print(usage_string)
+                exit()
+        elif arg == "--unordered":
+            orderedarg = False
         elif arg == "--help":
             print(purpose_string)
             print(usage_string)
@@ -465,10 +3471,28 @@ def main():
             exit()
         else:
             filename = arg
+    if batchfile:
+        try:
+            summary = run_batch(batchfile, batchjobs, maxsteps, timelimit, orderedarg,
+                                optimizearg, cachedir)
+        except (OSError, ValueError) as e:
+            exit(f"{sys.argv[0]}: error: {e}")
+        print(json.dumps(summary), file=sys.stderr)
+        exit(1 if summary["errors"] or summary["failed"] else 0)
     if not testarg and not stdinarg and filename == "":
             print(f"{sys.argv[0]}: error: bad usage, must specify --test or - or a filename\n")
             print(usage_string)
             exit()
+    if recordfile and (compilearg or jitarg or debugarg or profilearg):
+        exit(f"{sys.argv[0]}: error: --record only works with the interpreter")
+    if replayfile and (recordfile or inputfile):
+        exit(f"{sys.argv[0]}: error: --replay takes the input from the recording")
+    if profilearg and debugarg:
+        exit(f"{sys.argv[0]}: error: --profile doesn't work with --debug")
+    if (maxsteps is not None or timelimit is not None or checkpointfile or resumefile) and \
+            (compilearg or debugarg or profilearg):
+        exit(f"{sys.argv[0]}: error: --max-steps, --time-limit, --checkpoint and --resume "
+             "only work with the interpreter")
 
 
     # Get the source code
@@ -478,14 +3502,9 @@ def main():
         if not describearg:
             print("Running unit tests.  Expected results are:")
             print(WhitespaceVM.expected_results)
-            print("Actual results are:")
+            print("Actual results are:", flush=True)
     elif stdinarg:
         source_code = sys.stdin.read()
-        # Was running into an EOF error when doing sys.stdin.read() followed by
-        # an input().  The solution below came from stackexchange, but I don't know
-        # if it works on windows.
-        sys.stdin.close()
-        sys.stdin = open(os.ctermid())
     else:
         try:
             with open(filename) as f:
@@ -493,11 +3512,114 @@ def main():
         except IOError:
             exit(f"{sys.argv[0]}: error: Could not open file {filename}")
 
+    # Get the snapshot to carry on from
+    snapshot = None
+    if resumefile:
+        try:
+            snapshot = Checkpoints.read(resumefile)
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {resumefile}")
+        except ValueError as e:
+            exit(f"{sys.argv[0]}: error: {resumefile}: {e}")
+        if snapshot["program"] != source_hash(source_code):
+            exit(f"{sys.argv[0]}: error: {resumefile} is a snapshot of another program")
+        if snapshot["optimize"] != optimizearg:
+            exit(f"{sys.argv[0]}: error: {resumefile} was taken "
+                 f"{'with' if snapshot['optimize'] else 'without'} --optimize")
+        heappagesize = snapshot["page_size"]
+
+    # Get the program's input
+    recorder = None
+    replayer = None
+    if replayfile:
+        try:
+            with open(replayfile) as f:
+                replayer = IOReplayer(f, sys.stdout.buffer, source_code)
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {replayfile}")
+        except ValueError as e:
+            exit(f"{sys.argv[0]}: error: {replayfile}: {e}")
+    elif inputfile:
+        try:
+            program_input = open(inputfile, "rb")
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {inputfile}")
+    elif stdinarg:
+        # The source code used up stdin, so read the input from the terminal
+        # (if there is one).
+        try:
+            program_input = open(os.ctermid(), "rb")
+        except OSError:
+            program_input = None
+    else:
+        program_input = sys.stdin.buffer
+    if replayer is not None:
+        io = replayer
+    elif recordfile:
+        try:
+            recorder = IORecorder(program_input, sys.stdout.buffer, open(recordfile, "w"),
+                                  source_code)
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {recordfile}")
+        io = recorder
+    else:
+        io = WhitespaceIO(program_input, sys.stdout.buffer)
+
     # Execute the Whitespace source code
-    vm = WhitespaceVM(source_code)
+    try:
+        vm = WhitespaceVM(source_code, heappagesize, heapmaxpages, io)
+    except ValueError as e:
+        exit(f"{sys.argv[0]}: error: {e}")
     vm.debug_flag = debugarg
+    vm.trace_from = tracefrom
+    vm.profile_flag = profilearg
+    vm.profile_sample = profilesample
+    vm.profile_json = profilejson
+    vm.timing_flag = timingarg
+    if cachedir:
+        vm.cache = ProgramCache(cachedir)
+    vm.trace_to = traceto
+    if tracefile:
+        try:
+            vm.debug_file = open(tracefile, "w")
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {tracefile}")
     vm.describe_flag = describearg
-    vm.run()
+    vm.compile_flag = compilearg
+    vm.jit_flag = jitarg
+    vm.memo_flag = memoarg
+    vm.memo_stats_flag = memostatsarg
+    vm.optimize_flag = optimizearg
+    vm.heap_stats_flag = heapstatsarg
+    vm.max_call_depth = maxcalldepth
+    vm.load_processes = batchjobs
+    vm.max_steps = maxsteps
+    vm.time_limit = timelimit
+    if checkpointfile:
+        vm.checkpoints = Checkpoints(checkpointfile)
+    vm.checkpoint_every = checkpointevery
+    vm.resume_from = snapshot
+    error = None
+    try:
+        vm.run()
+    except WhitespaceError as e:
+        error = e
+    if recorder is not None:
+        recorder.finish(vm.ended, error)
+    if replayer is not None:
+        difference = replayer.difference(vm.ended, error)
+        steps = "" if compilearg or debugarg or profilearg else f"{vm.steps} steps, "
+        print(f"\nreplay: {steps}{replayer.recorded_steps} recorded: "
+              f"{'differs, ' + difference if difference else 'matches the recording'}",
+              file=sys.stderr)
+    if error is not None:
+        if checkpointfile and isinstance(error, (StepLimitExceeded, TimeLimitExceeded)):
+            print(f"{sys.argv[0]}: carry on with --resume {checkpointfile}", file=sys.stderr)
+        exit(str(error))
+    if replayer is not None and difference:
+        exit(1)
+    if vm.ended:
+        exit("\nPROGRAM COMPLETED SUCCESSFULLY.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+import whitespace as ws
+import mkws
+from io import BytesIO
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+# ------------------------------ CONSTANTS
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+# the ways of running a program that the suite compares:
+# (name, optimize, mode, memo), where mode is "interpret", "compile" or "jit"
+# and memo is whether the pure subroutines are memoized
+ENGINES = (
+    ("interpreter", False, "interpret", False),
+    ("optimize", True, "interpret", False),
+    ("compile", False, "compile", False),
+    ("optimize+compile", True, "compile", False),
+    ("jit", False, "jit", False),
+    ("optimize+jit", True, "jit", False),
+    ("memo", False, "interpret", True),
+)
+
+# -------------------------------CLASSES
+class LegacyTokenizerVM(ws.WhitespaceVM):
+    # The original tokenizer: strip the comments, then at every position try
+    # each entry of OPERATIONS in turn.  Kept here only so that the new
+    # tokenizer can be benchmarked (and checked) against it.
+
+    def strip_comments(self):
+        self.code = "".join([ch for ch in self.code if ch in (ws.SPACE, ws.TAB, ws.LF)])
+
+    def parse_arg(self, operation):
+        if operation in self.LABEL_OPS:
+            label = ""
+            while self.ip < len(self.code) and self.code[self.ip] != ws.LF:
+                label += self.code[self.ip]
+                self.ip += 1
+            label = self.unwhite(label)
+            self.ip += 1
+            return ws.label_id(label)
+
+        elif operation in self.NUMBER_OPS:
+            num = 0
+            mult = 0
+            if self.code[self.ip] == ws.SPACE:
+                mult = 1
+            elif self.code[self.ip] == ws.TAB:
+                mult = -1
+            else:
+                exit("SYNTAX ERROR : BAD SIGN")
+
+            self.ip = self.ip + 1
+            while self.ip < len(self.code) and self.code[self.ip] != ws.LF:
+                num = num << 1
+                if self.code[self.ip] == ws.TAB:
+                    num = num | 1
+                self.ip = self.ip + 1
+            self.ip = self.ip + 1
+
+            return num * mult
+        else:
+            return ""
+
+    def is_op(self, candidate):
+        if len(self.code) - self.ip < len(candidate):
+            return False
+        elif self.code[self.ip:self.ip+len(candidate)] == candidate:
+            self.ip = self.ip + len(candidate)
+            return True
+        else:
+            return False
+
+    def tokenize(self):
+        self.strip_comments()
+        while self.ip < len(self.code):
+            found = False
+            for name, opchars in self.OPERATIONS.items():
+                if self.is_op(opchars):
+                    arg = self.parse_arg(name)
+                    self.tokens.append(self.Token(name, arg))
+                    found = True
+                    break
+            if not found:
+                exit("SYNTAX ERROR : BAD OPERATION")
+
+# -------------------------------FUNCTIONS
+def generate_program(size):
+    # Builds a Whitespace program of roughly size characters by repeating
+    # the unit test program with renamed labels (so that the copies don't
+    # share labels) and a comment after every operation, so that the result
+    # has plenty of labels, numbers and comments to chew on.
+    vm = ws.WhitespaceVM(ws.WhitespaceVM.test_code)
+    vm.tokenize()
+    copies = []
+    total = 0
+    n = 0
+    while total < size:
+        # every bit of n as a space followed by the bit, then a tab, so that
+        # no copy's tag is the start of another's
+        tag = "".join([ws.SPACE + (ws.TAB if bit == "1" else ws.SPACE)
+                       for bit in bin(n)[2:]]) + ws.TAB
+        parts = []
+        for token in vm.tokens:
+            parts.append(vm.OPERATIONS[token.op])
+            if token.op in vm.LABEL_OPS:
+                label = ws.label_text(token.arg).replace("S", ws.SPACE).replace("T", ws.TAB)
+                parts.append(tag + label + ws.LF)
+            elif token.op in vm.NUMBER_OPS:
+                sign = ws.TAB if token.arg < 0 else ws.SPACE
+                digits = bin(abs(token.arg))[2:].replace("0", ws.SPACE).replace("1", ws.TAB)
+                parts.append(sign + digits + ws.LF)
+            parts.append(f"--{token.op.lower()}--")
+        copy = "".join(parts)
+        copies.append(copy)
+        total += len(copy)
+        n += 1
+    return "".join(copies)
+
+def time_tokenizer(vmclass, code, repeat, processes=None):
+    # Returns the best time of repeat runs, and the tokens of the last run.
+    # With processes, times the chunked tokenizer over that many processes.
+    best = None
+    for _ in range(repeat):
+        vm = vmclass(code)
+        start = time.perf_counter()
+        if processes:
+            vm.tokenize_chunked(processes)
+        else:
+            vm.tokenize()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, vm.tokens
+
+def time_load(code, repeat, processes=None):
+    # Returns the best time of repeat loads (tokenizing and linking), and
+    # the VM of the last one.  With processes, tokenizes in chunks over that
+    # many processes.
+    best = None
+    for _ in range(repeat):
+        vm = ws.WhitespaceVM(code)
+        start = time.perf_counter()
+        if processes:
+            vm.tokenize_chunked(processes)
+        else:
+            vm.tokenize()
+        vm.scan_labels()
+        vm.link()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, vm
+
+def bench_tokenizer(code, repeat, processes):
+    print(f"source size: {len(code)} characters")
+    new_time, new_tokens = time_tokenizer(ws.WhitespaceVM, code, repeat)
+    old_time, old_tokens = time_tokenizer(LegacyTokenizerVM, code, repeat)
+    chunked_time, chunked_tokens = time_tokenizer(ws.WhitespaceVM, code, repeat, processes)
+    one_time, _ = time_tokenizer(ws.WhitespaceVM, code, repeat, 1)
+    new = [(t.op, t.arg) for t in new_tokens]
+    same = new == [(t.op, t.arg) for t in old_tokens]
+    same_chunked = new == [(t.op, t.arg) for t in chunked_tokens]
+    print(f"tokens: {len(new_tokens)}  (identical to legacy tokenizer: {same}, "
+          f"to chunked tokenizer: {same_chunked})")
+    print(f"legacy tokenizer: {old_time:9.4f}s  {len(code) / old_time / 1e6:8.2f} MB/s")
+    print(f"trie tokenizer:   {new_time:9.4f}s  {len(code) / new_time / 1e6:8.2f} MB/s")
+    print(f"chunked tokenizer ({processes} processes): "
+          f"{chunked_time:9.4f}s  {len(code) / chunked_time / 1e6:8.2f} MB/s")
+    print(f"speedup: {old_time / new_time:.1f}x, chunked {old_time / chunked_time:.1f}x "
+          f"({one_time / chunked_time:.1f}x the chunked tokenizer in one process)")
+    if not same or not same_chunked:
+        exit(f"{sys.argv[0]}: error: tokenizers disagree")
+    # and tokenizing together with linking, which doesn't run in parallel
+    load_time, vm = time_load(code, repeat)
+    chunked_load_time, chunked_vm = time_load(code, repeat, processes)
+    print(f"load (tokenize and link): {load_time:9.4f}s, chunked over {processes} "
+          f"processes {chunked_load_time:9.4f}s  ({load_time / chunked_load_time:.1f}x)")
+    if (vm.opcodes, vm.operands) != (chunked_vm.opcodes, chunked_vm.operands):
+        exit(f"{sys.argv[0]}: error: chunked tokenizer links differently")
+
+def suite_programs(size):
+    # Returns the programs of the benchmark suite, as (name, code, input,
+    # engines) tuples: every bench/*.mkws program, assembled by mkws.py, and
+    # a generated program of size characters to give the tokenizer some
+    # work.  Only a sliver of the generated program runs, and the compiler
+    # would spend ages compiling all of it, so that one isn't run by the
+    # compile engines.
+    programs = []
+    for filename in sorted(glob.glob(os.path.join(BENCH_DIR, "*.mkws"))):
+        with open(filename) as f:
+            code = "".join(mkws.WhitespaceConverter().convert(f))
+        name = os.path.splitext(os.path.basename(filename))[0]
+        programs.append((name, code, b"", ENGINES))
+    interpreters = [engine for engine in ENGINES if engine[2] != "compile"]
+    programs.append(("generated", generate_program(size), b"x5\n", interpreters))
+    return programs
+
+def run_engine(code, stdin, optimize, mode, memo):
+    # Loads and runs code once.  Returns the seconds spent loading, the
+    # seconds spent running, the number of instructions executed (not
+    # counted by the compiler, 0 then) and the output.
+    io = ws.WhitespaceIO(BytesIO(stdin), None)
+    vm = ws.WhitespaceVM(code, io=io)
+    vm.optimize_flag = optimize
+    vm.jit_flag = mode == "jit"
+    vm.memo_flag = memo
+    start = time.perf_counter()
+    vm.load()
+    loaded = time.perf_counter()
+    if mode == "compile":
+        vm.execute_compiled()
+    else:
+        vm.execute()
+    return loaded - start, time.perf_counter() - loaded, vm.steps, bytes(io.out)
+
+def peak_memory(code, stdin, optimize, mode, memo):
+    # Returns the most memory (in bytes) allocated while loading and running
+    # code.  Tracing allocations slows everything down, so this is a run of
+    # its own.
+    tracemalloc.start()
+    try:
+        run_engine(code, stdin, optimize, mode, memo)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def git_commit():
+    # Returns the commit the benchmarked code is at, if we can tell.
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(size, repeat, json_file):
+    # Runs every program of the suite with every engine, repeat times, and
+    # reports the best load and run times.  Instructions per second are
+    # worked out from the number of instructions the plain interpreter
+    # executes, so that the engines can be compared.
+    results = []
+    print(f"{'program':12} {'engine':18} {'load s':>9} {'run s':>9} "
+          f"{'Minstr/s':>9} {'peak MB':>9}  output")
+    for name, code, stdin, engines in suite_programs(size):
+        steps = None
+        expected = None
+        for engine, optimize, mode, memo in engines:
+            try:
+                runs = [run_engine(code, stdin, optimize, mode, memo) for _ in range(repeat)]
+            except ws.WhitespaceError as e:
+                exit(f"{sys.argv[0]}: error: {name} ({engine}): {e}")
+            load = min(run[0] for run in runs)
+            elapsed = min(run[1] for run in runs)
+            if steps is None:
+                steps = runs[0][2]
+                expected = runs[0][3]
+            same = runs[0][3] == expected
+            peak = peak_memory(code, stdin, optimize, mode, memo)
+            rate = steps / elapsed if elapsed else 0.0
+            print(f"{name:12} {engine:18} {load:9.4f} {elapsed:9.4f} "
+                  f"{rate / 1e6:9.2f} {peak / 1e6:9.2f}  {'ok' if same else 'DIFFERS'}",
+                  flush=True)
+            results.append({"program": name, "engine": engine, "size": len(code),
+                            "load_seconds": load, "run_seconds": elapsed,
+                            "instructions": steps, "instructions_per_second": rate,
+                            "peak_memory": peak, "output_ok": same})
+    if json_file:
+        with open(json_file, "w") as f:
+            json.dump({"commit": git_commit(), "python": sys.version.split()[0],
+                       "repeat": repeat, "results": results}, f, indent=1)
+
+# -------------------------------MAIN PROGRAM
+def main():
+    # Handle command arguments
+    purpose_string = "wsbench.py - benchmark the Whitespace interpreter.\n"
+    usage_string = (
+        "usage: wsbench.py [--size N] [--repeat N] [--jobs N] [filename]\n"
+        "usage: wsbench.py --suite [--size N] [--repeat N] [--json FILE]\n"
+        "\n"
+        "Options:\n"
+        "  filename                A Whitespace program to tokenize.  When omitted, a\n"
+        "                          program is generated from the unit test code.\n"
+        "  --suite                 Instead of the tokenizers, benchmarks the programs in\n"
+        "                          bench/ (and a generated one) with every engine, and\n"
+        "                          reports load time, instructions per second and peak\n"
+        "                          memory\n"
+        "  --json FILE             With --suite, also writes the results to FILE as JSON\n"
+        "  --size N                Size in characters of the generated program\n"
+        "                          (default 1000000)\n"
+        "  --repeat N              Number of timed runs, the best one is reported\n"
+        "                          (default 3)\n"
+        "  --jobs N                Number of processes of the chunked tokenizer\n"
+        "                          (default: one per CPU)\n"
+        "  --help                  Prints this help info\n"
+        )
+
+    filename = ""
+    size = 1000000
+    repeat = 3
+    jobs = os.cpu_count() or 1
+    suitearg = False
+    jsonfile = ""
+    args = iter(sys.argv[1:])
+    try:
+        for arg in args:
+            if arg == "--help":
+                print(purpose_string)
+                print(usage_string)
+                exit()
+            elif arg == "--size":
+                size = int(next(args))
+            elif arg == "--repeat":
+                repeat = max(1, int(next(args)))
+            elif arg == "--jobs":
+                jobs = max(1, int(next(args)))
+            elif arg == "--suite":
+                suitearg = True
+            elif arg == "--json":
+                jsonfile = next(args)
+            elif arg[0] == "-":
+                print(f"{sys.argv[0]}: error: unknown option {arg}\n")
+                print(usage_string)
+                exit()
+            else:
+                filename = arg
+    except (StopIteration, ValueError):
+        print(f"{sys.argv[0]}: error: option {arg} needs a number\n")
+        print(usage_string)
+        exit()
+
+    if suitearg:
+        bench_suite(size, repeat, jsonfile)
+        return
+    if filename:
+        try:
+            with open(filename) as f:
+                code = f.read()
+        except IOError:
+            exit(f"{sys.argv[0]}: error: Could not open file {filename}")
+    else:
+        code = generate_program(size)
+
+    bench_tokenizer(code, repeat, jobs)
+
+if __name__ == "__main__":
+    main()
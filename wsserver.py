@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+import whitespace as ws
+from collections import deque
+from io import BytesIO
+import gc
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import stat
+import struct
+import sys
+import time
+import traceback
+# ------------------------------ CONSTANTS
+SOCKET_PATH = "/tmp/wsserver.sock"
+RECV_SIZE = 65536
+BENCH_WINDOW = 64       # requests a load generator client keeps in flight
+MAX_QUEUED = 1024       # records of a connection waiting for replies before it stops being read
+SELECT_TIMEOUT = 0.1    # seconds between checks whether to stop serving
+WORKER_DIED = (json.dumps({"status": 1, "output": "", "steps": 0,
+                           "error": "SERVER ERROR : THE WORKER RUNNING THIS INPUT DIED"})
+               .encode("ascii") + b"\n")
+
+# -------------------------------CLASSES
+class Connection:
+    # A client connection, as the server sees it.  Every record it sends
+    # gets a slot in replies, in order, which holds None until a worker has
+    # answered the record.  Answered slots at the front move to out, the
+    # bytes still to send.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = b""          # the start of a record still coming in
+        self.replies = deque()      # [reply or None] for every record not sent yet
+        self.out = b""              # replies still to send
+        self.reading = True         # whether the client may send more
+        self.closed = False
+        self.events = 0             # what the selector watches the socket for
+
+class Worker:
+    # A worker process, and the server's end of the socket it reads records
+    # from and writes replies to.
+
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.sock = sock
+        self.conn = None            # the connection of the record it is running ...
+        self.slot = None            # ... and the slot of its reply
+        self.reply = b""            # the part of the reply received so far
+
+class Server:
+    # Serves a program on a Unix socket.  This process accepts the
+    # connections, splits what they send into records, and hands the records
+    # out one at a time to whichever worker process is free, so that the
+    # records of one connection are spread over all the workers.  The
+    # replies go back to each client in the order of its records.  A worker
+    # that dies is replaced, and the record it was running gets an error as
+    # its reply.
+    #
+    # The program is loaded, and a VM set up to run it, before forking, so
+    # the workers share its tokens, opcodes and handlers with this process
+    # through copy-on-write memory.  Each worker then runs every record on
+    # that same VM, only emptying its stack, heap and I/O in between.
+
+    def __init__(self, program, path, workers, max_steps=None, time_limit=None):
+        self.vm = ws.WhitespaceVM(io=ws.WhitespaceIO())
+        self.vm.use_program(program)
+        self.vm.prepare()
+        self.path = path
+        self.max_steps = max_steps
+        self.time_limit = time_limit
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.workers = {}           # pid --> Worker
+        self.idle = []              # the workers waiting for a record
+        self.tasks = deque()        # (connection, slot, record) waiting for a worker
+        self.listener = listen(path)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, (self.accept, None))
+        # keep the garbage collector from touching (and so copying) the
+        # pages of everything loaded so far
+        gc.freeze()
+        for _ in range(workers):
+            self.spawn()
+
+    def spawn(self):
+        # Forks a new worker.
+        sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # the worker only keeps its own end of its own socket, so
+                # that a connection or a sibling's socket closed by the
+                # server is closed for good
+                sock.close()
+                for conn in self.connections:
+                    conn.sock.close()
+                for key in list(self.selector.get_map().values()):
+                    key.fileobj.close()
+                worker(child_sock, self.vm, self.max_steps, self.time_limit)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        child_sock.close()
+        new = Worker(pid, sock)
+        self.workers[pid] = new
+        self.idle.append(new)
+        self.selector.register(sock, selectors.EVENT_READ, (self.from_worker, new))
+
+    def serve(self, done=None):
+        # Serves until done() returns true, or for ever without done.
+        while done is None or not done():
+            for key, events in self.selector.select(SELECT_TIMEOUT):
+                handler, target = key.data
+                handler(target, events)
+            self.dispatch()
+
+    def accept(self, target, events):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        conn = Connection(sock)
+        self.connections.add(conn)
+        self.watch(conn)
+
+    def watch(self, conn):
+        # Has the selector watch the connection for what it is waiting for
+        # now, and closes it once it is done.  A client stops being read
+        # while MAX_QUEUED of its records are waiting for their replies.
+        events = 0
+        if conn.reading and len(conn.replies) < MAX_QUEUED:
+            events |= selectors.EVENT_READ
+        if conn.out:
+            events |= selectors.EVENT_WRITE
+        if events == conn.events:
+            pass
+        elif not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, (self.serve_connection, conn))
+        else:
+            self.selector.modify(conn.sock, events, (self.serve_connection, conn))
+        conn.events = events
+        if not conn.reading and not conn.replies and not conn.out:
+            self.close(conn)
+
+    def close(self, conn):
+        if conn.events:
+            self.selector.unregister(conn.sock)
+            conn.events = 0
+        conn.sock.close()
+        conn.closed = True
+        self.connections.discard(conn)
+
+    def serve_connection(self, conn, events):
+        # Every line received is the input of one run of the program
+        # (newline included) and gets one line back.  Replies are written
+        # as soon as they're ready, so clients which pipeline their requests
+        # don't pay a round trip each.
+        try:
+            if events & selectors.EVENT_WRITE:
+                sent = conn.sock.send(conn.out)
+                conn.out = conn.out[sent:]
+            if events & selectors.EVENT_READ:
+                self.receive(conn)
+        except OSError:
+            self.close(conn)    # the client went away
+            return
+        self.watch(conn)
+
+    def receive(self, conn):
+        data = conn.sock.recv(RECV_SIZE)
+        if not data:
+            conn.reading = False
+            if conn.pending:
+                self.add_task(conn, conn.pending)
+            conn.pending = b""
+            return
+        records = (conn.pending + data).split(b"\n")
+        conn.pending = records.pop()
+        for record in records:
+            self.add_task(conn, record + b"\n")
+
+    def add_task(self, conn, record):
+        slot = [None]
+        conn.replies.append(slot)
+        self.tasks.append((conn, slot, record))
+
+    def dispatch(self):
+        # Hands the records waiting out to the workers that are free.
+        while self.tasks and self.idle:
+            conn, slot, record = self.tasks.popleft()
+            if conn.closed:
+                continue
+            worker = self.idle.pop()
+            worker.conn = conn
+            worker.slot = slot
+            worker.sock.sendall(struct.pack("!I", len(record)) + record)
+
+    def from_worker(self, worker, events):
+        # Reads (the rest of) a reply from a worker, or replaces it if it
+        # has died.
+        try:
+            data = worker.sock.recv(RECV_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self.replace(worker)
+            return
+        worker.reply += data
+        if worker.reply.endswith(b"\n"):
+            self.answered(worker, worker.reply)
+            worker.reply = b""
+            self.idle.append(worker)
+
+    def answered(self, worker, reply):
+        # Puts the reply in its slot, and sends the replies that are now
+        # ready, in order.
+        conn = worker.conn
+        worker.slot[0] = reply
+        worker.conn = worker.slot = None
+        if conn.closed:
+            return
+        while conn.replies and conn.replies[0][0] is not None:
+            conn.out += conn.replies.popleft()[0]
+        self.watch(conn)
+
+    def replace(self, worker):
+        self.selector.unregister(worker.sock)
+        worker.sock.close()
+        os.waitpid(worker.pid, 0)
+        del self.workers[worker.pid]
+        if worker in self.idle:
+            self.idle.remove(worker)
+        if worker.slot is not None:
+            self.answered(worker, WORKER_DIED)
+        self.spawn()
+
+    def stop(self):
+        # Stops the workers and closes everything.
+        for pid, worker in self.workers.items():
+            worker.sock.close()
+            os.kill(pid, signal.SIGTERM)
+        for pid in self.workers:
+            os.waitpid(pid, 0)
+        self.workers = {}
+        for conn in list(self.connections):
+            conn.sock.close()
+        self.connections = set()
+        self.selector.close()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+# -------------------------------FUNCTIONS
+def answer(vm, record, max_steps, time_limit):
+    # Runs the program of vm from the start with one input record, and
+    # returns the reply: a line of JSON with the output (as latin-1, so any
+    # bytes survive), the status, the number of steps and the error, if any.
+    vm.reset(BytesIO(record))
+    error = None
+    try:
+        vm.execute(max_steps, time_limit)
+    except ws.WhitespaceError as e:
+        error = e
+    reply = {"status": 0 if error is None else 1, "output": vm.io.out.decode("latin-1"),
+             "steps": vm.steps, "error": str(error) if error is not None else None}
+    return json.dumps(reply).encode("ascii") + b"\n"
+
+def worker(sock, vm, max_steps, time_limit):
+    # The loop of a worker process: read a record from the server (its
+    # length, then the record), and send back the reply, until the server
+    # closes the socket.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # the server stops us
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    stream = sock.makefile("rb")
+    while True:
+        header = stream.read(4)
+        if len(header) < 4:
+            return
+        (size,) = struct.unpack("!I", header)
+        sock.sendall(answer(vm, stream.read(size), max_steps, time_limit))
+
+def listen(path):
+    # Returns a socket listening on the Unix socket path.  A socket left
+    # behind there by a server that has gone is replaced, but not one that
+    # a server still answers on, nor anything that isn't a socket.
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise OSError(f"{path} exists and isn't a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                pass
+            else:
+                raise OSError(f"a server is already listening on {path}")
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    return listener
+
+def client(job):
+    # A load generator client: sends count requests (cycling through the
+    # records) over one connection, keeping up to BENCH_WINDOW of them in
+    # flight.  Returns the number of replies received.
+    path, records, count = job
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        replies = 0
+        sent = 0
+        buffered = b""
+        while replies < count:
+            if sent < count and sent - replies < BENCH_WINDOW:
+                n = min(BENCH_WINDOW - (sent - replies), count - sent)
+                conn.sendall(b"".join([records[(sent + k) % len(records)] for k in range(n)]))
+                sent += n
+            data = conn.recv(RECV_SIZE)
+            if not data:
+                break
+            buffered += data
+            replies += buffered.count(b"\n")
+            buffered = buffered[buffered.rfind(b"\n") + 1:]
+    return replies
+
+def bench(program, path, worker_counts, records, clients, requests, max_steps, time_limit):
+    # The load generator: for every number of workers, starts a server, has
+    # clients processes send requests requests between them, and reports
+    # the requests per second.  The clients run on the same machine, so they
+    # compete with the workers for the CPUs.
+    print(f"{clients} clients, {requests} requests, {multiprocessing.cpu_count()} CPUs")
+    print("workers   requests/s")
+    per_client = [requests // clients + (1 if k < requests % clients else 0)
+                  for k in range(clients)]
+    # the clients are forked before the servers, so that they don't hold
+    # on to the servers' sockets
+    with multiprocessing.Pool(clients) as pool:
+        for workers in worker_counts:
+            server = Server(program, path, workers, max_steps, time_limit)
+            try:
+                start = time.perf_counter()
+                replies = pool.map_async(client, [(path, records, count)
+                                                  for count in per_client])
+                server.serve(replies.ready)
+                replies = sum(replies.get())
+                elapsed = time.perf_counter() - start
+            finally:
+                server.stop()
+            print(f"{workers:7} {replies / elapsed:12.1f}", flush=True)
+
+# -------------------------------MAIN PROGRAM
+def main():
+    # Handle command arguments
+    purpose_string = ("wsserver.py - serve a Whitespace program to many inputs from a pool of\n"
+                      "pre-forked worker processes.\n")
+    usage_string = (
+        "usage: wsserver.py [options] filename\n"
+        "usage: wsserver.py --help\n"
+        "\n"
+        "Options:\n"
+        "  filename                The Whitespace program to serve.  Clients connect to\n"
+        "                          the socket and send one input per line, and get one\n"
+        "                          line of JSON back for each (status, output, steps,\n"
+        "                          error).\n"
+        f"  --socket PATH           The Unix socket to listen on (default {SOCKET_PATH})\n"
+        "  --workers N             Number of worker processes (default: one per CPU)\n"
+        "  --max-steps N           Stops every run after N instructions\n"
+        "  --time-limit SECONDS    Stops every run after SECONDS seconds\n"
+        "  --optimize              Runs the peephole optimizer on the program first\n"
+        "  --bench N,N,...         Instead of serving, runs the load generator against\n"
+        "                          each of these numbers of workers, and reports the\n"
+        "                          requests per second\n"
+        "  --records FILE          The inputs the load generator sends, one per line\n"
+        "                          (default: a single empty line)\n"
+        "  --clients N             Number of load generator clients (default 4)\n"
+        "  --requests N            Number of requests per load generator run\n"
+        "                          (default 10000)\n"
+        "  --help                  Prints this help info\n"
+        )
+
+    filename = ""
+    path = SOCKET_PATH
+    workers = multiprocessing.cpu_count()
+    max_steps = None
+    time_limit = None
+    optimize = False
+    worker_counts = None
+    recordsfile = ""
+    clients = 4
+    requests = 10000
+    args = iter(sys.argv[1:])
+    try:
+        for arg in args:
+            if arg == "--help":
+                print(purpose_string)
+                print(usage_string)
+                exit()
+            elif arg == "--socket":
+                path = next(args)
+            elif arg == "--workers":
+                workers = max(1, int(next(args)))
+            elif arg == "--max-steps":
+                max_steps = int(next(args))
+            elif arg == "--time-limit":
+                time_limit = float(next(args))
+            elif arg == "--optimize":
+                optimize = True
+            elif arg == "--bench":
+                worker_counts = [max(1, int(n)) for n in next(args).split(",")]
+            elif arg == "--records":
+                recordsfile = next(args)
+            elif arg == "--clients":
+                clients = max(1, int(next(args)))
+            elif arg == "--requests":
+                requests = max(1, int(next(args)))
+            elif arg[0] == "-":
+                print(f"{sys.argv[0]}: error: unknown option {arg}\n")
+                print(usage_string)
+                exit()
+            else:
+                filename = arg
+    except (StopIteration, ValueError):
+        print(f"{sys.argv[0]}: error: option {arg} needs a value\n")
+        print(usage_string)
+        exit()
+    if not filename:
+        print(f"{sys.argv[0]}: error: bad usage, must specify a filename\n")
+        print(usage_string)
+        exit()
+
+    try:
+        with open(filename) as f:
+            source_code = f.read()
+    except IOError:
+        exit(f"{sys.argv[0]}: error: Could not open file {filename}")
+    try:
+        program = ws.load(source_code, optimize)
+    except ws.WhitespaceError as e:
+        exit(str(e))
+
+    if worker_counts is not None:
+        records = [b"\n"]
+        if recordsfile:
+            try:
+                with open(recordsfile, "rb") as f:
+                    records = [line if line.endswith(b"\n") else line + b"\n" for line in f]
+            except IOError:
+                exit(f"{sys.argv[0]}: error: Could not open file {recordsfile}")
+            if not records:
+                exit(f"{sys.argv[0]}: error: {recordsfile} holds no records")
+        try:
+            bench(program, path, worker_counts, records, clients, requests, max_steps,
+                  time_limit)
+        except OSError as e:
+            exit(f"{sys.argv[0]}: error: {e}")
+        return
+
+    try:
+        server = Server(program, path, workers, max_steps, time_limit)
+    except OSError as e:
+        exit(f"{sys.argv[0]}: error: {e}")
+    print(f"serving {filename} on {path} with {workers} workers", file=sys.stderr)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()